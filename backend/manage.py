@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Doloop maintenance commands
+
+Usage: python manage.py <command> [options]
+"""
+
+import asyncio
+import os
+import time
+from datetime import datetime
+from typing import List, Optional
+
+import typer
+from bson import ObjectId
+from fastapi.responses import JSONResponse
+from motor.motor_asyncio import AsyncIOMotorClient
+from pydantic import TypeAdapter
+from pymongo import monitoring
+
+import server
+
+cli = typer.Typer(help="Doloop backend maintenance commands")
+
+
+@cli.command("reconcile-counters")
+def reconcile_counters(
+    owner_id: Optional[str] = typer.Option(None, help="Only reconcile loops owned by this user id"),
+    batch_size: int = typer.Option(500, help="Loops recounted per aggregation"),
+):
+    """Recompute the denormalized total_tasks/completed_tasks counters on loops"""
+    reconciled = asyncio.run(server.reconcile_loop_counters(owner_id=owner_id, batch_size=batch_size))
+    typer.echo(f"Reconciled task counters for {reconciled} loops")
+
+
+@cli.command("ensure-indexes")
+def ensure_indexes():
+    """Create any missing indexes declared in server.INDEXES and drop server.OBSOLETE_INDEXES"""
+    asyncio.run(server.ensure_indexes())
+    typer.echo("Indexes ensured")
+
+
+@cli.command("index-stats")
+def index_stats():
+    """Report how often each index has been used since its mongod started"""
+    stats = asyncio.run(server.get_index_stats())
+    for collection_name, indexes in stats.items():
+        typer.echo(collection_name)
+        for index in sorted(indexes, key=lambda row: row["ops"], reverse=True):
+            typer.echo(f"  {index['name']:<24} {index['ops']:>12} ops since {index['since']:%Y-%m-%d %H:%M}")
+
+
+@cli.command("backfill-reset-schedule")
+def backfill_reset_schedule(batch_size: int = typer.Option(500, help="Loops updated per bulk write")):
+    """Give daily/weekly loops created before scheduled resets a next_reset_at, and every loop a timezone"""
+    scheduled = asyncio.run(server.backfill_next_resets(batch_size=batch_size))
+    typer.echo(f"Scheduled resets or set timezones for {scheduled} loops")
+
+
+@cli.command("backfill-task-owners")
+def backfill_task_owners(batch_size: int = typer.Option(500, help="Loops whose tasks are updated per bulk write")):
+    """Stamp tasks created before tasks carried owner_id with their loop's owner"""
+    backfilled = asyncio.run(server.backfill_task_owners(batch_size=batch_size))
+    typer.echo(f"Backfilled owner_id on {backfilled} tasks")
+
+
+@cli.command("purge-deleted-loops")
+def purge_deleted_loops():
+    """Purge every loop soft-deleted past retention, with its tasks, now (what purge_worker does)"""
+
+    async def run():
+        while await server.purge_expired_loops() >= server.PURGE_BATCH_SIZE:
+            pass
+
+    asyncio.run(run())
+    stats = server.purge_stats
+    typer.echo(
+        f"Purged {stats['loops_purged']} loops and {stats['tasks_purged']} tasks, "
+        f"{stats['bytes_reclaimed'] / 1024 / 1024:.1f} MiB of documents"
+    )
+
+
+@cli.command("purge-orphans")
+def purge_orphans(batch_size: int = typer.Option(500, help="Loop ids checked per query and tasks deleted per batch")):
+    """Delete tasks whose loop no longer exists (left behind by the old TTL expiry of deleted loops)"""
+    deleted, reclaimed = asyncio.run(server.purge_orphaned_tasks(batch_size=batch_size))
+    typer.echo(f"Deleted {deleted} orphaned tasks, {reclaimed / 1024 / 1024:.1f} MiB of documents")
+
+
+@cli.command("ai-worker")
+def ai_worker(concurrency: int = typer.Option(server.AI_JOB_WORKERS or 4, help="Jobs processed at once")):
+    """Process queued AI jobs outside the API (run API pods with AI_JOB_WORKERS=0)"""
+
+    async def run():
+        await asyncio.gather(*[server.ai_job_worker() for _ in range(concurrency)])
+
+    typer.echo(f"Processing AI jobs with {concurrency} workers as {server.INSTANCE_ID}")
+    asyncio.run(run())
+
+
+class CommandCounter(monitoring.CommandListener):
+    """Counts commands sent to mongod, i.e. client/server round-trips"""
+
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+@cli.command("bench-reorder")
+def bench_reorder(
+    sizes: List[int] = typer.Option([10, 100, 1000, 5000], "--size", help="List lengths to reorder"),
+):
+    """Show that reordering costs the same number of round-trips at any list length"""
+
+    async def run():
+        counter = CommandCounter()
+        bench_client = AsyncIOMotorClient(server.mongo_url, event_listeners=[counter])
+        collection = bench_client[f"{os.environ['DB_NAME']}_bench"]["reorder"]
+        try:
+            for size in sizes:
+                await collection.delete_many({})
+                object_ids = [ObjectId() for _ in range(size)]
+                await collection.insert_many([{"_id": object_id, "order": i} for i, object_id in enumerate(object_ids)])
+
+                counter.count = 0
+                started = time.perf_counter()
+                await server.apply_order(collection, list(reversed(object_ids)))
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                typer.echo(f"{size:>6} items  {counter.count:>3} round-trips  {elapsed_ms:>8.1f} ms")
+        finally:
+            await collection.drop()
+            bench_client.close()
+
+    asyncio.run(run())
+
+
+@cli.command("bench-serialization")
+def bench_serialization(
+    tasks: int = typer.Option(1000, help="Tasks in the serialized loop"),
+    rounds: int = typer.Option(50, help="Serializations timed per path"),
+):
+    """Compare the response_model path of GET /loops/{id}/tasks with the FAST_JSON path"""
+    loop_id = str(ObjectId())
+    now = datetime.utcnow()
+    docs = [
+        {
+            "_id": ObjectId(),
+            "loop_id": loop_id,
+            "description": f"Task number {i}",
+            "type": "recurring",
+            "tags": ["home", "daily"],
+            "notes": "Remember to check the list",
+            "attachments": [],
+            "status": "completed" if i % 3 == 0 else "pending",
+            "completed_at": now if i % 3 == 0 else None,
+            "created_at": now,
+            "updated_at": now,
+            "order": i,
+        }
+        for i in range(tasks)
+    ]
+    adapter = TypeAdapter(List[server.TaskResponse])
+
+    def response_model_path():
+        # What FastAPI does with response_model: build models, validate them, dump, json.dumps
+        responses = [server.build_task_response(doc) for doc in docs]
+        return JSONResponse(adapter.dump_python(adapter.validate_python(responses), mode="json")).body
+
+    def fast_path():
+        return server.FastJSONResponse([server.build_task_dict(doc) for doc in docs]).body
+
+    encoder = "orjson" if server.orjson is not None else "json"
+    for name, path in (("response_model", response_model_path), (f"fast ({encoder})", fast_path)):
+        size = len(path())
+        started = time.perf_counter()
+        for _ in range(rounds):
+            path()
+        elapsed_ms = (time.perf_counter() - started) * 1000 / rounds
+        typer.echo(f"{name:<16} {elapsed_ms:>8.2f} ms per response  {size:>9} bytes")
+
+
+if __name__ == "__main__":
+    cli()
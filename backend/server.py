@@ -1,21 +1,48 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Header, Query, Request, Response, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, TEXT, IndexModel, ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import CollectionInvalid, DuplicateKeyError, OperationFailure
 import os
+import base64
+import copy
+import hashlib
+import hmac
+import ipaddress
+import json
 import logging
+import random
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional
+from urllib.parse import urlsplit, urlunsplit
+from pydantic import AfterValidator, BaseModel, Field, EmailStr, ValidationError
+from typing import Annotated, List, Optional
 import uuid
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 import jwt
 import bcrypt
+import requests
+from requests.adapters import HTTPAdapter
 from bson import ObjectId
+from bson.errors import InvalidId
 import asyncio
 from emergentintegrations.llm.chat import LlmChat, UserMessage
 
+try:
+    import orjson
+except ImportError:  # optional: FAST_JSON falls back to the standard json module
+    orjson = None
+
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -36,12 +63,326 @@ JWT_SECRET = "doloop-secret-key-change-in-production"  # TODO: Use environment v
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24 * 7  # 7 days
 
+# Authenticated-user cache (saves a users lookup on every request)
+USER_CACHE_TTL_SECONDS = int(os.environ.get('USER_CACHE_TTL_SECONDS', 60))
+USER_CACHE_MAX_SIZE = int(os.environ.get('USER_CACHE_MAX_SIZE', 10000))
+# Trust the identity claims embedded in the token and skip the users lookup entirely
+AUTH_STATELESS = os.environ.get('AUTH_STATELESS', 'false').lower() == 'true'
+# Shared secret for GET /api/metrics, sent as X-Metrics-Token; the endpoint is off without one
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# Soft-deleted loops are kept this long before they are removed
+DELETED_LOOP_RETENTION_DAYS = 30
+# Background purge of expired loops and their tasks (one replica, lease-protected, rate-limited)
+PURGE_WORKER = os.environ.get('PURGE_WORKER', 'true').lower() == 'true'
+PURGE_INTERVAL_SECONDS = int(os.environ.get('PURGE_INTERVAL_SECONDS', 300))
+PURGE_BATCH_SIZE = int(os.environ.get('PURGE_BATCH_SIZE', 500))
+PURGE_MAX_DELETES_PER_SECOND = float(os.environ.get('PURGE_MAX_DELETES_PER_SECOND', 1000))
+
+# Password hashing (bcrypt runs on its own thread pool, never on the event loop)
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 4))
+# Hash/verify calls allowed to wait or run at once before new ones get a 429
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', 64))
+
+# How daily/weekly loop resets are executed:
+#   scheduler - a background sweep resets every due loop (one replica, lease-protected)
+#   lazy      - a due loop is reset when it is next read by get_loops/get_tasks
+#   off       - only manual reloops
+RESET_MODE = os.environ.get('RESET_MODE', 'scheduler').lower()
+RESET_SCHEDULER_INTERVAL_SECONDS = int(os.environ.get('RESET_SCHEDULER_INTERVAL_SECONDS', 60))
+RESET_BATCH_SIZE = int(os.environ.get('RESET_BATCH_SIZE', 500))
+# Only the replica holding a lease runs a background job; it expires if that replica dies
+LEASE_SECONDS = int(os.environ.get('LEASE_SECONDS', 120))
+INSTANCE_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
 # AI Configuration
 EMERGENT_LLM_KEY = os.environ.get('EMERGENT_LLM_KEY')
+LLM_PROVIDER = "openai"
+LLM_MODEL = "gpt-4o-mini"
+# LlmChat only returns finished replies, so streamed generation calls an OpenAI-compatible chat
+# completions endpoint directly; without LLM_STREAM_API_KEY it falls back to one-chunk replies
+LLM_STREAM_URL = os.environ.get('LLM_STREAM_URL', 'https://api.openai.com/v1/chat/completions')
+LLM_STREAM_API_KEY = os.environ.get('LLM_STREAM_API_KEY')
+# Identical prompts are answered from a response cache: in-memory LRU, optionally backed by Mongo
+LLM_CACHE_TTL_SECONDS = int(os.environ.get('LLM_CACHE_TTL_SECONDS', 24 * 60 * 60))
+LLM_CACHE_MAX_SIZE = int(os.environ.get('LLM_CACHE_MAX_SIZE', 1000))
+LLM_CACHE_PERSISTENT = os.environ.get('LLM_CACHE_PERSISTENT', 'false').lower() == 'true'
+# Warm chat clients kept per model, and the cap on LLM calls in flight per worker
+LLM_POOL_SIZE = int(os.environ.get('LLM_POOL_SIZE', 8))
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', 16))
+# Resilience: per-attempt deadline, jittered retries on transient errors, circuit breaker
+LLM_TIMEOUT_SECONDS = float(os.environ.get('LLM_TIMEOUT_SECONDS', 20))
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', 2))
+LLM_RETRY_BASE_DELAY_SECONDS = float(os.environ.get('LLM_RETRY_BASE_DELAY_SECONDS', 0.5))
+LLM_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('LLM_BREAKER_FAILURE_THRESHOLD', 5))
+LLM_BREAKER_RESET_SECONDS = float(os.environ.get('LLM_BREAKER_RESET_SECONDS', 30))
+# Queued AI jobs: worker tasks per process (0 = this process only accepts jobs), fairness and retries
+AI_JOB_WORKERS = int(os.environ.get('AI_JOB_WORKERS', 2))
+AI_JOBS_PER_USER_LIMIT = int(os.environ.get('AI_JOBS_PER_USER_LIMIT', 2))
+AI_JOB_MAX_ATTEMPTS = int(os.environ.get('AI_JOB_MAX_ATTEMPTS', 3))
+# Hosts job callbacks may be sent to (comma-separated; empty = any host with a public address)
+AI_JOB_CALLBACK_HOSTS = {
+    host.strip().lower() for host in os.environ.get('AI_JOB_CALLBACK_HOSTS', '').split(',') if host.strip()
+}
+AI_JOB_LOCK_SECONDS = int(os.environ.get('AI_JOB_LOCK_SECONDS', 300))
+AI_JOB_POLL_SECONDS = float(os.environ.get('AI_JOB_POLL_SECONDS', 1))
+# How often each worker fails running jobs that ran out of attempts after their workers died
+AI_JOB_SWEEP_SECONDS = float(os.environ.get('AI_JOB_SWEEP_SECONDS', 30))
+AI_JOB_RETENTION_DAYS = int(os.environ.get('AI_JOB_RETENTION_DAYS', 7))
+# How long the last good reply per prompt/loop is kept to answer with while the provider is down
+LLM_FALLBACK_TTL_SECONDS = int(os.environ.get('LLM_FALLBACK_TTL_SECONDS', 7 * 24 * 60 * 60))
+# Prompt compaction: estimated tokens the task list of a loop prompt may use, and per-task length cap
+LLM_PROMPT_TASK_TOKEN_BUDGET = int(os.environ.get('LLM_PROMPT_TASK_TOKEN_BUDGET', 1500))
+LLM_TASK_MAX_CHARS = int(os.environ.get('LLM_TASK_MAX_CHARS', 120))
+
+# Live updates: one change stream per process fanned out per loop over SSE (needs a replica set)
+LIVE_UPDATES = os.environ.get('LIVE_UPDATES', 'false').lower() == 'true'
+LIVE_BUFFER_SIZE = int(os.environ.get('LIVE_BUFFER_SIZE', 2000))
+LIVE_QUEUE_SIZE = int(os.environ.get('LIVE_QUEUE_SIZE', 200))
+LIVE_HEARTBEAT_SECONDS = float(os.environ.get('LIVE_HEARTBEAT_SECONDS', 15))
+# Delta sync: how long deletions and applied offline mutations are remembered
+SYNC_TOMBSTONE_RETENTION_DAYS = int(os.environ.get('SYNC_TOMBSTONE_RETENTION_DAYS', 30))
+SYNC_MUTATION_RETENTION_DAYS = int(os.environ.get('SYNC_MUTATION_RETENTION_DAYS', 7))
+# A mutation claimed, or a change number reserved, by a request that died is given up on once this old
+SYNC_PENDING_SECONDS = int(os.environ.get('SYNC_PENDING_SECONDS', 60))
+# Completion history: time-series events are kept this long (0 = forever); daily rollups are kept
+TASK_EVENT_RETENTION_DAYS = int(os.environ.get('TASK_EVENT_RETENTION_DAYS', 0))
+# List endpoints serialize documents straight to JSON bytes, skipping response_model validation
+FAST_JSON = os.environ.get('FAST_JSON', 'false').lower() == 'true'
 
 # Security
 security = HTTPBearer()
 
+# Indexes ensured at startup, per collection
+INDEXES = {
+    "users": [
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+    ],
+    "loops": [
+        IndexModel(
+            [("owner_id", ASCENDING), ("is_deleted", ASCENDING), ("deleted_at", ASCENDING)],
+            name="owner_deleted_at"
+        ),
+        IndexModel([("owner_id", ASCENDING), ("is_favorite", ASCENDING)], name="owner_favorite"),
+        IndexModel([("owner_id", ASCENDING), ("order", ASCENDING), ("_id", ASCENDING)], name="owner_order"),
+        IndexModel([("next_reset_at", ASCENDING)], name="next_reset_at", sparse=True),
+        IndexModel([("owner_id", ASCENDING), ("seq", ASCENDING)], name="owner_seq"),
+        IndexModel(
+            [("owner_id", ASCENDING), ("name", TEXT), ("description", TEXT)],
+            name="owner_text",
+            weights={"name": 3, "description": 1}
+        ),
+        IndexModel([("is_deleted", ASCENDING), ("deleted_at", ASCENDING)], name="deleted_purge", sparse=True),
+    ],
+    "ai_jobs": [
+        IndexModel([("status", ASCENDING), ("priority", -1), ("created_at", ASCENDING)], name="status_priority"),
+        IndexModel([("owner_id", ASCENDING), ("status", ASCENDING)], name="owner_status"),
+        IndexModel(
+            [("finished_at", ASCENDING)],
+            name="finished_at_ttl",
+            expireAfterSeconds=AI_JOB_RETENTION_DAYS * 24 * 60 * 60
+        ),
+    ],
+    "llm_cache": [
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "llm_usage": [
+        IndexModel([("owner_id", ASCENDING), ("day", ASCENDING)], name="owner_day"),
+    ],
+    "tasks": [
+        IndexModel([("loop_id", ASCENDING), ("order", ASCENDING)], name="loop_order"),
+        IndexModel([("loop_id", ASCENDING), ("status", ASCENDING)], name="loop_status"),
+        IndexModel([("loop_id", ASCENDING), ("updated_at", ASCENDING)], name="loop_updated"),
+        IndexModel(
+            [("owner_id", ASCENDING), ("description", TEXT), ("notes", TEXT)],
+            name="owner_text",
+            weights={"description": 3, "notes": 1}
+        ),
+        IndexModel([("owner_id", ASCENDING), ("tags", ASCENDING)], name="owner_tags"),
+        IndexModel(
+            [("owner_id", ASCENDING), ("status", ASCENDING), ("due_date", ASCENDING), ("_id", ASCENDING)],
+            name="owner_status_due"
+        ),
+    ],
+    "task_events": [
+        IndexModel([("meta.owner_id", ASCENDING), ("meta.loop_id", ASCENDING), ("at", ASCENDING)], name="meta_at"),
+    ],
+    "completion_rollups": [
+        IndexModel([("owner_id", ASCENDING), ("day", ASCENDING)], name="owner_day"),
+        IndexModel([("owner_id", ASCENDING), ("loop_id", ASCENDING), ("day", ASCENDING)], name="owner_loop_day"),
+    ],
+    "tombstones": [
+        IndexModel([("owner_id", ASCENDING), ("seq", ASCENDING)], name="owner_seq"),
+        IndexModel(
+            [("deleted_at", ASCENDING)],
+            name="deleted_at_ttl",
+            expireAfterSeconds=SYNC_TOMBSTONE_RETENTION_DAYS * 24 * 60 * 60
+        ),
+    ],
+    "sync_mutations": [
+        IndexModel(
+            [("created_at", ASCENDING)],
+            name="created_at_ttl",
+            expireAfterSeconds=SYNC_MUTATION_RETENTION_DAYS * 24 * 60 * 60
+        ),
+    ],
+}
+
+# Indexes replaced by the ones above, dropped by ensure_indexes
+OBSOLETE_INDEXES = {
+    # A TTL expiry removed loops but left their tasks behind; the purge worker replaced it.
+    # Delta sync selects by change number now, not by the wall clock (owner_modified, owner_deleted_at)
+    "loops": ["deleted_at_ttl", "owner_deleted", "owner_modified"],
+    "tombstones": ["owner_deleted_at"],
+}
+
+class TTLCache:
+    """Bounded in-process LRU cache whose entries expire after ttl seconds"""
+    
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+    
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        
+        self._entries.move_to_end(key)
+        return value
+    
+    def set(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+    
+    def pop(self, key):
+        self._entries.pop(key, None)
+    
+    def clear(self):
+        self._entries.clear()
+    
+    def __len__(self):
+        return len(self._entries)
+
+user_cache = TTLCache(USER_CACHE_MAX_SIZE, USER_CACHE_TTL_SECONDS)
+
+class PasswordHasher:
+    """Runs bcrypt on a bounded thread pool and sheds load once too many calls are pending"""
+    
+    def __init__(self, workers: int, max_pending: int, rounds: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.rounds = rounds
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+    
+    async def _run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=429,
+                detail="Too many authentication requests, please retry shortly",
+                headers={"Retry-After": "1"}
+            )
+        
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+    
+    async def hash(self, password: str) -> bytes:
+        return await self._run(lambda: bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(self.rounds)))
+    
+    async def verify(self, password: str, password_hash: bytes) -> bool:
+        return await self._run(bcrypt.checkpw, password.encode('utf-8'), password_hash)
+    
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "rounds": self.rounds,
+            "pending": self.pending,
+            "queued": max(0, self.pending - self.workers),
+            "max_pending": self.max_pending,
+            "completed": self.completed,
+            "rejected": self.rejected
+        }
+    
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING, BCRYPT_ROUNDS)
+
+llm_cache = TTLCache(LLM_CACHE_MAX_SIZE, LLM_CACHE_TTL_SECONDS)
+llm_cache_stats = {"hits": 0, "misses": 0}
+llm_fallbacks = TTLCache(LLM_CACHE_MAX_SIZE, LLM_FALLBACK_TTL_SECONDS)
+llm_call_stats = {
+    "calls": 0, "retries": 0, "timeouts": 0, "failures": 0, "fallbacks": 0,
+    "prompt_tokens": 0, "response_tokens": 0
+}
+
+class CircuitBreaker:
+    """Fails fast after repeated failures, then lets a single trial call through after reset_seconds"""
+    
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+    
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+    
+    def allow(self):
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        return False
+    
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+    
+    def record_failure(self):
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+    
+    def release_trial(self):
+        """Give back a trial call that ended without a verdict, e.g. because it was cancelled"""
+        self._trial_in_flight = False
+    
+    def stats(self):
+        return {"state": self.state, "failures": self.failures, "failure_threshold": self.failure_threshold}
+
+llm_breaker = CircuitBreaker(LLM_BREAKER_FAILURE_THRESHOLD, LLM_BREAKER_RESET_SECONDS)
+
+class LlmUnavailable(Exception):
+    """The LLM provider is failing or the circuit breaker is open"""
+
 # Helper to convert ObjectId to string
 def str_object_id(obj):
     if isinstance(obj, dict):
@@ -51,19 +392,34 @@ def str_object_id(obj):
     return obj
 
 # Pydantic Models
+def validate_timezone(value: str):
+    try:
+        ZoneInfo(value)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Unknown timezone: {value}")
+    return value
+
+TimezoneName = Annotated[str, AfterValidator(validate_timezone)]
+
 class UserCreate(BaseModel):
     email: EmailStr
     password: str
     name: str
+    timezone: TimezoneName = "UTC"
 
 class UserLogin(BaseModel):
     email: EmailStr
     password: str
 
+class UserUpdate(BaseModel):
+    name: Optional[str] = None
+    timezone: Optional[TimezoneName] = None
+
 class UserResponse(BaseModel):
     id: str
     email: str
     name: str
+    timezone: str = "UTC"
     created_at: datetime
 
 class AuthResponse(BaseModel):
@@ -89,8 +445,7 @@ class LoopResponse(BaseModel):
     total_tasks: int = 0
     completed_tasks: int = 0
 
-class TaskCreate(BaseModel):
-    loop_id: str
+class TaskBatchItem(BaseModel):
     description: str
     type: str = Field(..., pattern="^(recurring|one-time)$")
     assigned_user_id: Optional[str] = None
@@ -100,6 +455,12 @@ class TaskCreate(BaseModel):
     notes: Optional[str] = None
     attachments: Optional[List[dict]] = []
 
+class TaskCreate(TaskBatchItem):
+    loop_id: str
+
+class TaskBatchCreateRequest(BaseModel):
+    tasks: List[TaskBatchItem] = Field(..., min_length=1, max_length=500)
+
 class TaskResponse(BaseModel):
     id: str
     loop_id: str
@@ -129,12 +490,49 @@ class AISuggestTasksRequest(BaseModel):
 class AIOptimizeLoopRequest(BaseModel):
     loop_id: str
 
+class AIJobRequest(BaseModel):
+    kind: str = Field(..., pattern="^(optimize-loop|suggest-tasks)$")
+    loop_id: str
+    context: Optional[str] = None
+    priority: int = Field(5, ge=0, le=9)
+    callback_url: Optional[str] = Field(None, pattern="^https?://")
+
+class AIJobResponse(BaseModel):
+    id: str
+    kind: str
+    loop_id: str
+    status: str
+    priority: int
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+class SyncMutation(BaseModel):
+    # Client-generated; replays of an applied id return the stored result, and later
+    # mutations in the batch may use a create's id in place of the new loop/task id
+    id: str = Field(..., min_length=1, max_length=100)
+    op: str = Field(
+        ...,
+        pattern="^(create_loop|update_loop|delete_loop|reloop|toggle_favorite|create_task|update_task|complete_task|delete_task)$"
+    )
+    loop_id: Optional[str] = None
+    task_id: Optional[str] = None
+    data: dict = {}
+
+class SyncMutationsRequest(BaseModel):
+    mutations: List[SyncMutation] = Field(..., min_length=1, max_length=200)
+
 class FavoriteToggleRequest(BaseModel):
     loop_id: str
 
 class LoopReorderRequest(BaseModel):
     loop_ids: List[str]
 
+class TaskReorderRequest(BaseModel):
+    task_ids: List[str]
+
 class LoopUpdate(BaseModel):
     name: Optional[str] = None
     description: Optional[str] = None
@@ -150,13 +548,17 @@ class TaskUpdate(BaseModel):
     notes: Optional[str] = None
     attachments: Optional[List[dict]] = None
 
+class TaskBatchUpdateItem(TaskUpdate):
+    id: str
+
+class TaskBatchUpdateRequest(BaseModel):
+    updates: List[TaskBatchUpdateItem] = Field(..., min_length=1, max_length=500)
+
+class TaskBatchIdsRequest(BaseModel):
+    task_ids: List[str] = Field(..., min_length=1, max_length=500)
+
 # AI Helper Functions
-async def get_ai_chat():
-    """Initialize AI chat with system message for Doloop context"""
-    chat = LlmChat(
-        api_key=EMERGENT_LLM_KEY,
-        session_id=f"doloop-{uuid.uuid4()}",
-        system_message="""You are an AI assistant helping users with Doloop, a loop-based task management app. 
+AI_SYSTEM_MESSAGE = """You are an AI assistant helping users with Doloop, a loop-based task management app. 
 
 Doloop helps users create "loops" which are collections of recurring tasks that reset periodically (daily, weekly, or manually). 
 
@@ -168,17 +570,1933 @@ When helping users:
 5. Consider the loop type: recurring tasks reset when loop resets, one-time tasks are archived when completed
 
 Always respond in JSON format as specified in the request."""
-    ).with_model("openai", "gpt-4o-mini")
+
+def create_ai_chat(provider: str, model: str):
+    """Initialize AI chat with system message for Doloop context"""
+    chat = LlmChat(
+        api_key=EMERGENT_LLM_KEY,
+        session_id=f"doloop-{uuid.uuid4()}",
+        system_message=AI_SYSTEM_MESSAGE
+    ).with_model(provider, model)
     
     return chat
 
+class LlmClientPool:
+    """Reuses warm chat clients per model and bounds the number of in-flight LLM calls
+    
+    A client is checked out by one request at a time. Its conversation history is rewound
+    to the system prompt on return, so no request ever sees another request's messages;
+    clients whose history can't be rewound, or whose call failed, are discarded instead.
+    """
+    
+    def __init__(self, factory, max_idle: int, max_concurrency: int):
+        self._factory = factory
+        self._idle = {}
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_idle = max_idle
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.waiting = 0
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+    
+    def _checkout(self, provider: str, model: str):
+        idle = self._idle.setdefault((provider, model), [])
+        if idle:
+            self.reused += 1
+            return idle.pop()
+        
+        self.created += 1
+        chat = self._factory(provider, model)
+        history = getattr(chat, "messages", None)
+        return chat, (len(history) if isinstance(history, list) else None)
+    
+    def _checkin(self, provider: str, model: str, chat, baseline: Optional[int], healthy: bool):
+        idle = self._idle.setdefault((provider, model), [])
+        if not healthy or baseline is None or len(idle) >= self.max_idle:
+            self.discarded += 1
+            return
+        
+        del chat.messages[baseline:]
+        idle.append((chat, baseline))
+    
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one of the max_concurrency LLM call slots, for calls that don't go through a client"""
+        self.waiting += 1
+        async with self._semaphore:
+            self.waiting -= 1
+            self.in_flight += 1
+            try:
+                yield
+            finally:
+                self.in_flight -= 1
+    
+    @asynccontextmanager
+    async def client(self, provider: str = LLM_PROVIDER, model: str = LLM_MODEL):
+        async with self.slot():
+            chat, baseline = self._checkout(provider, model)
+            healthy = False
+            try:
+                yield chat
+                healthy = True
+            finally:
+                self._checkin(provider, model, chat, baseline, healthy)
+    
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "max_concurrency": self.max_concurrency,
+            "idle": {f"{provider}/{model}": len(idle) for (provider, model), idle in self._idle.items()},
+            "created": self.created,
+            "reused": self.reused,
+            "discarded": self.discarded
+        }
+
+llm_pool = LlmClientPool(create_ai_chat, LLM_POOL_SIZE, LLM_MAX_CONCURRENCY)
+
+def llm_cache_key(prompt: str, scope: str = ""):
+    """Content address for a prompt: model + scope + prompt with case and whitespace normalized"""
+    normalized = " ".join(prompt.split()).lower()
+    return hashlib.sha256(f"{LLM_PROVIDER}/{LLM_MODEL}\n{scope}\n{normalized}".encode('utf-8')).hexdigest()
+
+def loop_state_hash(loop, tasks):
+    """Fingerprint of the loop/task state a loop-scoped prompt is built from; edits change it"""
+    state = [
+        str(loop["_id"]),
+        loop.get("name"),
+        loop.get("description"),
+        loop.get("reset_rule"),
+        [(str(task["_id"]), task["description"], task["type"], task.get("order")) for task in tasks]
+    ]
+    return hashlib.sha256(json.dumps(state, default=str).encode('utf-8')).hexdigest()
+
+def estimate_tokens(text: str):
+    """Rough token count for budgeting: ~4 characters per token for English text"""
+    return (len(text) + 3) // 4
+
+def compact_task_lines(tasks, format_line, token_budget: int = LLM_PROMPT_TASK_TOKEN_BUDGET):
+    """Render a loop's tasks as prompt lines: duplicates collapsed, long descriptions truncated,
+    and the list cut off once it would exceed token_budget
+    
+    format_line(number, description, task_type) renders one line; repeated tasks get a "(xN)" suffix.
+    """
+    entries = OrderedDict()
+    for task in tasks:
+        description = " ".join(task["description"].split())
+        if len(description) > LLM_TASK_MAX_CHARS:
+            description = description[:LLM_TASK_MAX_CHARS - 1].rstrip() + "…"
+        key = (description.lower(), task.get("type"))
+        if key in entries:
+            entries[key]["count"] += 1
+        else:
+            entries[key] = {"description": description, "type": task.get("type"), "count": 1}
+    
+    lines = []
+    used = 0
+    remaining = len(tasks)
+    for entry in entries.values():
+        line = format_line(len(lines) + 1, entry["description"], entry["type"])
+        if entry["count"] > 1:
+            line += f" (x{entry['count']})"
+        cost = estimate_tokens(line) + 1
+        if used + cost > token_budget:
+            lines.append(f"(+{remaining} more tasks not shown)")
+            break
+        lines.append(line)
+        used += cost
+        remaining -= entry["count"]
+    return lines
+
+async def record_llm_usage(owner_id: Optional[str], prompt: str, response: Optional[str] = None):
+    """Add one AI request to the owner's daily usage row; response=None records a cache hit"""
+    prompt_tokens = estimate_tokens(prompt) if response is not None else 0
+    response_tokens = estimate_tokens(response) if response is not None else 0
+    llm_call_stats["prompt_tokens"] += prompt_tokens
+    llm_call_stats["response_tokens"] += response_tokens
+    if not owner_id:
+        return
+    
+    day = datetime.utcnow().strftime("%Y-%m-%d")
+    try:
+        await db.llm_usage.update_one(
+            {"_id": f"{owner_id}:{day}"},
+            {
+                "$setOnInsert": {"owner_id": owner_id, "day": day},
+                "$inc": {
+                    "calls": 1 if response is not None else 0,
+                    "cache_hits": 0 if response is not None else 1,
+                    "prompt_tokens": prompt_tokens,
+                    "response_tokens": response_tokens,
+                },
+            },
+            upsert=True
+        )
+    except Exception as e:
+        # Usage accounting must never fail the AI request itself
+        logger.warning(f"Failed to record LLM usage for {owner_id}: {e}")
+
+async def get_cached_llm_response(key: str):
+    data = llm_cache.get(key)
+    if data is None and LLM_CACHE_PERSISTENT:
+        doc = await db.llm_cache.find_one({"_id": key, "expires_at": {"$gt": datetime.utcnow()}})
+        if doc:
+            data = doc["response"]
+            llm_cache.set(key, data)
+    return data
+
+async def store_llm_response(key: str, data):
+    llm_cache.set(key, data)
+    if LLM_CACHE_PERSISTENT:
+        await db.llm_cache.update_one(
+            {"_id": key},
+            {"$set": {
+                "response": data,
+                "model": f"{LLM_PROVIDER}/{LLM_MODEL}",
+                "expires_at": datetime.utcnow() + timedelta(seconds=LLM_CACHE_TTL_SECONDS)
+            }},
+            upsert=True
+        )
+
+def build_generate_loop_prompt(request: AILoopRequest):
+    return f"""Create a loop for: "{request.description}"
+Category: {request.category or 'general'}
+
+Generate a JSON response with this exact structure:
+{{
+    "name": "Loop name (max 50 chars)",
+    "description": "Brief description",
+    "color": "#{request.category and '#FFC93A' if request.category == 'personal' else '#FF5999' if request.category == 'work' else '#00CAD1' if request.category == 'shared' else '#FFC93A'}",
+    "reset_rule": "daily|weekly|manual",
+    "tasks": [
+        {{
+            "description": "Task description (max 50 chars)",
+            "type": "recurring|one-time"
+        }}
+    ]
+}}
+
+Make 5-8 practical, actionable tasks. Consider what would make sense to repeat."""
+
+class JsonArrayItemParser:
+    """Incrementally pulls complete items out of one top-level array in a streamed JSON object
+    
+    feed() accepts reply text in arbitrary chunks and returns the elements of the array stored
+    under `key` (e.g. "tasks") that became complete, so each can be used before the reply ends.
+    """
+    
+    def __init__(self, key: str):
+        self.key = key
+        self.text = ""
+        self._pos = 0
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._last_string = None
+        self._pending_key = None
+        self._array_depth = None
+        self._item_start = None
+    
+    def feed(self, chunk: str):
+        self.text += chunk
+        items = []
+        
+        while self._pos < len(self.text):
+            i, c = self._pos, self.text[self._pos]
+            self._pos += 1
+            
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    self._last_string = self.text[self._string_start + 1:i]
+                continue
+            
+            if c == '"':
+                self._in_string = True
+                self._string_start = i
+            elif c == ":" and len(self._stack) == 1:
+                self._pending_key = self._last_string
+            elif c == ",":
+                self._pending_key = None
+            elif c in "{[":
+                if self._array_depth is not None and len(self._stack) == self._array_depth:
+                    self._item_start = i
+                if c == "[" and self._stack == ["{"] and self._pending_key == self.key:
+                    self._array_depth = 2
+                self._stack.append(c)
+            elif c in "}]" and self._stack:
+                self._stack.pop()
+                if self._array_depth is not None and len(self._stack) == self._array_depth and self._item_start is not None:
+                    items.append(json.loads(self.text[self._item_start:i + 1]))
+                    self._item_start = None
+                elif self._array_depth is not None and len(self._stack) < self._array_depth:
+                    self._array_depth = None
+        
+        return items
+
+# HTTP statuses worth retrying: timeouts, conflicts, rate limits and server-side failures
+TRANSIENT_LLM_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+def llm_error_status(error: BaseException):
+    """The HTTP status a provider error carries, if any"""
+    for attr in ("status_code", "status", "http_status"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    value = getattr(getattr(error, "response", None), "status_code", None)
+    return value if isinstance(value, int) else None
+
+def iter_chat_completion_deltas(prompt: str, stopped: threading.Event):
+    """Blocking: POST a streaming chat completion and yield its content deltas as they arrive"""
+    with requests.post(
+        LLM_STREAM_URL,
+        headers={"Authorization": f"Bearer {LLM_STREAM_API_KEY}"},
+        json={
+            "model": LLM_MODEL,
+            "stream": True,
+            "messages": [
+                {"role": "system", "content": AI_SYSTEM_MESSAGE},
+                {"role": "user", "content": prompt}
+            ]
+        },
+        stream=True,
+        # The read timeout bounds the gap between chunks, not the whole reply
+        timeout=(10, LLM_TIMEOUT_SECONDS)
+    ) as response:
+        response.raise_for_status()
+        for line in response.iter_lines(decode_unicode=True):
+            if stopped.is_set():
+                return
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                return
+            choices = json.loads(data).get("choices") or []
+            delta = (choices[0].get("delta") or {}).get("content") if choices else None
+            if delta:
+                yield delta
+
+async def stream_chat_completion(prompt: str):
+    """Yield iter_chat_completion_deltas' deltas from a worker thread without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stopped = threading.Event()
+    done = object()
+    
+    def produce():
+        try:
+            for delta in iter_chat_completion_deltas(prompt, stopped):
+                loop.call_soon_threadsafe(queue.put_nowait, delta)
+            loop.call_soon_threadsafe(queue.put_nowait, done)
+        except Exception as e:
+            loop.call_soon_threadsafe(queue.put_nowait, e)
+    
+    producer = loop.run_in_executor(None, produce)
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # A consumer that stops early (e.g. the client disconnected) ends the provider stream too
+        stopped.set()
+    await producer
+
+# HTTP statuses worth retrying: timeouts, conflicts, rate limits and server-side failures
+TRANSIENT_LLM_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+def llm_error_status(error: BaseException):
+    """The HTTP status a provider error carries, if any"""
+    for attr in ("status_code", "status", "http_status"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    value = getattr(getattr(error, "response", None), "status_code", None)
+    return value if isinstance(value, int) else None
+
+def is_transient_llm_error(error: Exception):
+    # Check wrapped errors too: client libraries often re-raise transport failures as their own type
+    while error is not None:
+        if isinstance(error, (asyncio.TimeoutError, ConnectionError, OSError)):
+            return True
+        if llm_error_status(error) in TRANSIENT_LLM_STATUS_CODES:
+            return True
+        error = error.__cause__
+    return False
+
+async def call_llm(prompt: str):
+    """Send one prompt through the client pool with a deadline, jittered retries and the circuit breaker"""
+    trial = llm_breaker.state == "half_open"
+    if not llm_breaker.allow():
+        raise LlmUnavailable("AI provider circuit is open")
+    llm_call_stats["calls"] += 1
+    
+    try:
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            try:
+                async with llm_pool.client() as chat:
+                    response = await asyncio.wait_for(
+                        chat.send_message(UserMessage(text=prompt)), timeout=LLM_TIMEOUT_SECONDS
+                    )
+                llm_breaker.record_success()
+                return response
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    llm_call_stats["timeouts"] += 1
+                if not is_transient_llm_error(e):
+                    # The provider answered; a bad request isn't a sign it is degraded
+                    llm_breaker.record_success()
+                    raise
+                if attempt == LLM_MAX_RETRIES:
+                    llm_call_stats["failures"] += 1
+                    llm_breaker.record_failure()
+                    raise LlmUnavailable(f"AI provider failed after {attempt + 1} attempts: {e}") from e
+            
+            # Full jitter: spread retries so a provider blip doesn't cause synchronized retry bursts
+            llm_call_stats["retries"] += 1
+            await asyncio.sleep(random.uniform(0, LLM_RETRY_BASE_DELAY_SECONDS * 2 ** attempt))
+    finally:
+        # A cancelled trial records no verdict; without this the breaker would stay half-open forever
+        if trial:
+            llm_breaker.release_trial()
+
+async def stream_llm_text(prompt: str, scope: str = "", owner_id: Optional[str] = None):
+    """Yield a prompt's reply text in chunks as the provider produces them
+    
+    Cached replies are replayed as one chunk. If streaming isn't configured, the circuit
+    breaker isn't closed, or the stream fails before its first token, the reply comes from
+    call_llm (with its retries and breaker) as one chunk instead.
+    """
+    cached = await get_cached_llm_response(llm_cache_key(prompt, scope))
+    if cached is not None:
+        llm_cache_stats["hits"] += 1
+        await record_llm_usage(owner_id, prompt)
+        yield json.dumps(cached)
+        return
+    llm_cache_stats["misses"] += 1
+    
+    if LLM_STREAM_API_KEY and llm_breaker.state == "closed":
+        parts = []
+        try:
+            async with llm_pool.slot():
+                async for delta in stream_chat_completion(prompt):
+                    parts.append(delta)
+                    yield delta
+        except Exception as e:
+            # Once text has been sent it can't be taken back, so only a silent failure falls back
+            if parts:
+                raise
+            logger.warning(f"AI stream failed before its first token, answering without streaming: {e}")
+        else:
+            llm_call_stats["calls"] += 1
+            await record_llm_usage(owner_id, prompt, "".join(parts))
+            return
+    
+    response = await call_llm(prompt)
+    await record_llm_usage(owner_id, prompt, response)
+    yield response
+
+async def ask_llm(
+    prompt: str,
+    scope: str = "",
+    fallback_key: Optional[str] = None,
+    fallback: Optional[dict] = None,
+    owner_id: Optional[str] = None
+):
+    """Send a prompt and parse its JSON reply, answering repeats from the response cache
+    
+    While the provider is unavailable, answers with the last good reply stored under
+    fallback_key (default: the cache key), else the `fallback` template, else a 503.
+    Fallback answers carry "fallback": true. Token usage is recorded against owner_id.
+    """
+    key = llm_cache_key(prompt, scope)
+    fallback_key = fallback_key or key
+    cached = await get_cached_llm_response(key)
+    if cached is not None:
+        llm_cache_stats["hits"] += 1
+        await record_llm_usage(owner_id, prompt)
+        return copy.deepcopy(cached)
+    llm_cache_stats["misses"] += 1
+    
+    try:
+        response = await call_llm(prompt)
+        await record_llm_usage(owner_id, prompt, response)
+    except LlmUnavailable as e:
+        logger.warning(f"Serving AI fallback: {e}")
+        last_good = llm_fallbacks.get(fallback_key)
+        if last_good is None and fallback is None:
+            raise HTTPException(status_code=503, detail="AI service is temporarily unavailable")
+        llm_call_stats["fallbacks"] += 1
+        return {**copy.deepcopy(last_good if last_good is not None else fallback), "fallback": True}
+    
+    # Parse AI response
+    try:
+        ai_data = json.loads(response)
+    except ValueError:
+        raise HTTPException(status_code=500, detail="AI response parsing failed")
+    
+    await store_llm_response(key, ai_data)
+    llm_fallbacks.set(fallback_key, ai_data)
+    return copy.deepcopy(ai_data)
+
+# AI Task Functions (shared by the request handlers and the job workers)
+async def suggest_tasks_for_loop(loop, context: Optional[str] = None):
+    """AI-powered task suggestions for an existing loop"""
+    loop_id = str(loop["_id"])
+    
+    # Get existing tasks; only the fields the prompt and its cache scope use
+    existing_tasks = await db.tasks.find(
+        {"loop_id": loop_id}, {"description": 1, "type": 1, "order": 1}
+    ).sort("order", 1).to_list(None)
+    task_lines = compact_task_lines(existing_tasks, lambda number, description, task_type: f"- {description}")
+    
+    prompt = f"""Suggest additional tasks for this loop:
+Name: {loop['name']}
+Description: {loop.get('description', '')}
+Reset Rule: {loop['reset_rule']}
+Context: {context or ''}
+
+Existing tasks:
+{chr(10).join(task_lines)}
+
+Generate a JSON response with 3-5 new task suggestions:
+{{
+    "suggestions": [
+        {{
+            "description": "Task description (max 50 chars)",
+            "type": "recurring|one-time",
+            "reason": "Brief explanation why this task fits"
+        }}
+    ]
+}}
+
+Don't duplicate existing tasks. Focus on gaps or improvements."""
+
+    return await ask_llm(
+        prompt,
+        scope=loop_state_hash(loop, existing_tasks),
+        fallback_key=f"suggest-tasks:{loop_id}",
+        fallback={"suggestions": []},
+        owner_id=loop["owner_id"]
+    )
+
+async def optimize_loop(loop):
+    """AI-powered loop optimization suggestions"""
+    loop_id = str(loop["_id"])
+    tasks = await db.tasks.find(
+        {"loop_id": loop_id}, {"description": 1, "type": 1, "order": 1}
+    ).sort("order", 1).to_list(None)
+    task_lines = compact_task_lines(
+        tasks, lambda number, description, task_type: f"{number}. {description} ({task_type})"
+    )
+    
+    prompt = f"""Analyze and optimize this loop:
+Name: {loop['name']}
+Description: {loop.get('description', '')}
+Reset Rule: {loop['reset_rule']}
+
+Tasks (in current order):
+{chr(10).join(task_lines)}
+
+Generate optimization suggestions in JSON:
+{{
+    "improvements": [
+        {{
+            "type": "reorder|add|remove|modify",
+            "suggestion": "Specific improvement suggestion",
+            "reason": "Why this would help"
+        }}
+    ],
+    "efficiency_score": 85,
+    "summary": "Overall assessment and key recommendations"
+}}
+
+Focus on logical task ordering, missing steps, redundancies, and time efficiency."""
+
+    return await ask_llm(
+        prompt,
+        scope=loop_state_hash(loop, tasks),
+        fallback_key=f"optimize-loop:{loop_id}",
+        fallback={
+            "improvements": [],
+            "efficiency_score": None,
+            "summary": "AI optimization is temporarily unavailable. Please try again shortly."
+        },
+        owner_id=loop["owner_id"]
+    )
+
+# AI job kinds: kind -> coroutine(loop, payload) producing the job result
+AI_JOB_HANDLERS = {
+    "suggest-tasks": lambda loop, payload: suggest_tasks_for_loop(loop, payload.get("context")),
+    "optimize-loop": lambda loop, payload: optimize_loop(loop),
+}
+
+def build_ai_job_response(job):
+    return AIJobResponse(
+        id=str(job["_id"]),
+        kind=job["kind"],
+        loop_id=job["payload"]["loop_id"],
+        status=job["status"],
+        priority=job["priority"],
+        result=job.get("result"),
+        error=job.get("error"),
+        created_at=job["created_at"],
+        started_at=job.get("started_at"),
+        finished_at=job.get("finished_at")
+    )
+
+async def claim_ai_job():
+    """Atomically take the highest-priority runnable job from a user below their running-job limit"""
+    now = datetime.utcnow()
+    busy_owners = [
+        row["_id"]
+        async for row in db.ai_jobs.aggregate([
+            {"$match": {"status": "running", "locked_until": {"$gt": now}}},
+            {"$group": {"_id": "$owner_id", "running": {"$sum": 1}}},
+            {"$match": {"running": {"$gte": AI_JOBS_PER_USER_LIMIT}}}
+        ])
+    ]
+    
+    return await db.ai_jobs.find_one_and_update(
+        {
+            # Running jobs whose lock expired were abandoned by a dead worker
+            "$or": [{"status": "queued"}, {"status": "running", "locked_until": {"$lte": now}}],
+            "attempts": {"$lt": AI_JOB_MAX_ATTEMPTS},
+            "owner_id": {"$nin": busy_owners}
+        },
+        {
+            "$set": {
+                "status": "running",
+                "worker": INSTANCE_ID,
+                # Unique per claim: workers in one process share INSTANCE_ID, and a re-claim of
+                # an expired job must fence off the worker that lost it
+                "claim": uuid.uuid4().hex,
+                "started_at": now,
+                "locked_until": now + timedelta(seconds=AI_JOB_LOCK_SECONDS),
+                "updated_at": now
+            },
+            "$inc": {"attempts": 1}
+        },
+        sort=[("priority", -1), ("created_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def check_callback_url(url: str):
+    """Raise ValueError unless url is safe to POST job results to; returns the address to use
+    
+    Guards against server-side request forgery: the host must be on AI_JOB_CALLBACK_HOSTS
+    (when set) and every address it resolves to must be public, so callbacks can't reach
+    loopback, private networks or cloud metadata endpoints.
+    """
+    parsed = urlsplit(url)
+    host = (parsed.hostname or "").lower()
+    if parsed.scheme not in ("http", "https") or not host:
+        raise ValueError("Invalid callback URL")
+    if AI_JOB_CALLBACK_HOSTS and host not in AI_JOB_CALLBACK_HOSTS:
+        raise ValueError("Callback host is not allowed")
+    
+    try:
+        port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        addresses = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (socket.gaierror, ValueError):
+        raise ValueError("Callback host could not be resolved")
+    
+    for address_info in addresses:
+        address = ipaddress.ip_address(address_info[4][0].split("%")[0])
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if not address.is_global:
+            raise ValueError("Callback URL must resolve to a public address")
+    return addresses[0][4][0]
+
+class PinnedHostAdapter(HTTPAdapter):
+    """Verifies TLS and sends SNI for `hostname` while the URL itself names an IP address"""
+    
+    def __init__(self, hostname: str, **kwargs):
+        self.hostname = hostname
+        super().__init__(**kwargs)
+    
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["server_hostname"] = self.hostname
+        kwargs["assert_hostname"] = self.hostname
+        super().init_poolmanager(*args, **kwargs)
+
+def post_callback(url: str, address: str, payload: dict):
+    """POST payload to url, connecting to the address check_callback_url vetted
+    
+    Letting requests resolve the host again would allow DNS rebinding: a second lookup can
+    answer with a private address the check never saw.
+    """
+    parsed = urlsplit(url)
+    host = f"[{address}]" if ":" in address else address
+    target = parsed._replace(netloc=f"{host}:{parsed.port}" if parsed.port else host)
+    host_header = parsed.hostname if not parsed.port else f"{parsed.hostname}:{parsed.port}"
+    
+    with requests.Session() as session:
+        # Environment proxies would resolve the hostname themselves
+        session.trust_env = False
+        session.mount(f"{parsed.scheme}://", PinnedHostAdapter(parsed.hostname))
+        return session.post(
+            urlunsplit(target), json=payload, headers={"Host": host_header}, timeout=10, allow_redirects=False
+        )
+
+async def finish_ai_job(job, result=None, error: Optional[str] = None):
+    now = datetime.utcnow()
+    finished = await db.ai_jobs.find_one_and_update(
+        # Only the claim still holding the job may finish it
+        {"_id": job["_id"], "status": "running", "claim": job["claim"]},
+        {
+            "$set": {
+                "status": "failed" if error else "completed",
+                "result": result,
+                "error": error,
+                "finished_at": now,
+                "updated_at": now
+            },
+            "$unset": {"locked_until": ""}
+        },
+        return_document=ReturnDocument.AFTER
+    )
+    
+    if finished and finished.get("callback_url"):
+        payload = jsonable_encoder(build_ai_job_response(finished))
+        try:
+            # Checked again at delivery: the host's DNS may have changed since the job was queued
+            address = await check_callback_url(finished["callback_url"])
+            await asyncio.to_thread(post_callback, finished["callback_url"], address, payload)
+        except Exception as e:
+            logger.warning(f"AI job {job['_id']} webhook delivery failed: {e}")
+
+async def process_ai_job(job):
+    loop = await db.loops.find_one({"_id": ObjectId(job["payload"]["loop_id"]), "owner_id": job["owner_id"]})
+    if not loop:
+        await finish_ai_job(job, error="Loop not found")
+        return
+    
+    try:
+        result = await AI_JOB_HANDLERS[job["kind"]](loop, job["payload"])
+    except HTTPException as e:
+        await finish_ai_job(job, error=e.detail)
+    except Exception as e:
+        logger.exception(f"AI job {job['_id']} failed")
+        await finish_ai_job(job, error=str(e))
+    else:
+        await finish_ai_job(job, result=result)
+
+async def fail_abandoned_ai_jobs():
+    """Give up on running jobs whose lock expired after their last allowed attempt"""
+    now = datetime.utcnow()
+    await db.ai_jobs.update_many(
+        {"status": "running", "locked_until": {"$lte": now}, "attempts": {"$gte": AI_JOB_MAX_ATTEMPTS}},
+        {
+            "$set": {
+                "status": "failed",
+                "error": "Job abandoned after repeated worker failures",
+                "finished_at": now,
+                "updated_at": now
+            },
+            "$unset": {"locked_until": ""}
+        }
+    )
+
+async def ai_job_worker():
+    """Background loop: claim and run AI jobs one at a time"""
+    next_sweep = 0.0
+    while True:
+        try:
+            # On a timer rather than when idle, so abandoned jobs are failed under steady load too
+            if time.monotonic() >= next_sweep:
+                next_sweep = time.monotonic() + AI_JOB_SWEEP_SECONDS
+                await fail_abandoned_ai_jobs()
+            
+            job = await claim_ai_job()
+            if job is None:
+                await asyncio.sleep(AI_JOB_POLL_SECONDS)
+                continue
+            await process_ai_job(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("AI job worker iteration failed")
+            await asyncio.sleep(AI_JOB_POLL_SECONDS)
+
+# Progress Helper Functions
+async def get_task_counts(loop_ids: List[str]):
+    """Return {loop_id: (total_tasks, completed_tasks)} for many loops in one aggregation"""
+    if not loop_ids:
+        return {}
+    
+    pipeline = [
+        {"$match": {"loop_id": {"$in": loop_ids}}},
+        {
+            "$group": {
+                "_id": "$loop_id",
+                "total_tasks": {"$sum": {"$cond": [{"$ne": ["$status", "archived"]}, 1, 0]}},
+                "completed_tasks": {"$sum": {"$cond": [{"$eq": ["$status", "completed"]}, 1, 0]}}
+            }
+        }
+    ]
+    counts = {}
+    async for row in db.tasks.aggregate(pipeline):
+        counts[row["_id"]] = (row["total_tasks"], row["completed_tasks"])
+    return counts
+
+def build_loop_dict(loop, total_tasks: int, completed_tasks: int):
+    """LoopResponse fields as a plain dict, for the FAST_JSON path"""
+    progress = int((completed_tasks / total_tasks * 100) if total_tasks > 0 else 0)
+    
+    return {
+        "id": str(loop["_id"]),
+        "name": loop["name"],
+        "description": loop.get("description"),
+        "color": loop["color"],
+        "owner_id": str(loop["owner_id"]),
+        "reset_rule": loop["reset_rule"],
+        "created_at": loop["created_at"],
+        "updated_at": loop["updated_at"],
+        "progress": progress,
+        "total_tasks": total_tasks,
+        "completed_tasks": completed_tasks
+    }
+
+def build_loop_response(loop, total_tasks: int, completed_tasks: int):
+    return LoopResponse(**build_loop_dict(loop, total_tasks, completed_tasks))
+
+async def refresh_loop_counters(loop_ids: List[str]):
+    """Recompute the denormalized total_tasks/completed_tasks counters from the tasks collection"""
+    if not loop_ids:
+        return {}
+    
+    counts = await get_task_counts(loop_ids)
+    operations = []
+    for loop_id in loop_ids:
+        total_tasks, completed_tasks = counts.get(loop_id, (0, 0))
+        counts[loop_id] = (total_tasks, completed_tasks)
+        operations.append(UpdateOne(
+            {"_id": ObjectId(loop_id)},
+            {"$set": {"total_tasks": total_tasks, "completed_tasks": completed_tasks}}
+        ))
+    
+    await db.loops.bulk_write(operations, ordered=False)
+    return counts
+
+async def reconcile_loop_counters(owner_id: Optional[str] = None, batch_size: int = 500):
+    """Repair the task counters of every loop (or one user's loops) in bounded batches"""
+    query = {"owner_id": owner_id} if owner_id else {}
+    reconciled = 0
+    batch = []
+    
+    async def reconcile(batch):
+        counts = await refresh_loop_counters([str(loop["_id"]) for loop in batch])
+        changed = [
+            loop for loop in batch
+            if (loop.get("total_tasks"), loop.get("completed_tasks")) != counts[str(loop["_id"])]
+        ]
+        # Repaired counters change what clients see, so their cached ETags must go stale
+        if changed:
+            await bump_versions([loop["owner_id"] for loop in changed], [loop["_id"] for loop in changed])
+    
+    async for loop in db.loops.find(query, {"owner_id": 1, "total_tasks": 1, "completed_tasks": 1}):
+        batch.append(loop)
+        if len(batch) >= batch_size:
+            await reconcile(batch)
+            reconciled += len(batch)
+            batch = []
+    
+    if batch:
+        await reconcile(batch)
+        reconciled += len(batch)
+    
+    return reconciled
+
+async def build_loop_responses(loops, build=build_loop_response):
+    """Attach progress to a list of loop documents from their denormalized counters"""
+    # Loops created before counters existed are backfilled once, in a single query
+    missing = [str(loop["_id"]) for loop in loops if "total_tasks" not in loop]
+    counts = await refresh_loop_counters(missing)
+    
+    result = []
+    for loop in loops:
+        if "total_tasks" in loop:
+            total_tasks, completed_tasks = loop["total_tasks"], loop.get("completed_tasks", 0)
+        else:
+            total_tasks, completed_tasks = counts[str(loop["_id"])]
+        result.append(build(loop, total_tasks, completed_tasks))
+    
+    return result
+
+def counted_loop(loop_id: ObjectId):
+    """Filter for a loop whose counters exist, for $inc-ing them
+    
+    Incrementing a missing counter would create it from zero and hide the loop from the
+    read-time backfill in build_loop_responses, so uncounted loops are left for that instead.
+    """
+    return {"_id": loop_id, "total_tasks": {"$exists": True}}
+
+def counter_changes(previous_status: Optional[str], new_status: Optional[str]):
+    """Return the $inc document for a task moving between statuses (None = no task)"""
+    def weights(task_status):
+        if task_status is None:
+            return 0, 0
+        return (0 if task_status == "archived" else 1), (1 if task_status == "completed" else 0)
+    
+    old_total, old_completed = weights(previous_status)
+    new_total, new_completed = weights(new_status)
+    changes = {}
+    if new_total != old_total:
+        changes["total_tasks"] = new_total - old_total
+    if new_completed != old_completed:
+        changes["completed_tasks"] = new_completed - old_completed
+    return changes
+
+# Task Helper Functions
+def build_task_doc(loop_id: str, owner_id: str, task_data: TaskBatchItem, order: int):
+    return {
+        "_id": ObjectId(),
+        "loop_id": loop_id,
+        # Denormalized from the loop so task mutations can check ownership in the same query
+        "owner_id": owner_id,
+        "description": task_data.description,
+        "type": task_data.type,
+        "assigned_user_id": task_data.assigned_user_id,
+        "assigned_email": task_data.assigned_email,
+        "due_date": task_data.due_date,
+        "tags": task_data.tags or [],
+        "notes": task_data.notes,
+        "attachments": task_data.attachments or [],
+        "status": "pending",
+        "created_at": datetime.utcnow(),
+        "updated_at": datetime.utcnow(),
+        "order": order
+    }
+
+def build_task_response(task):
+    return TaskResponse(
+        id=str(task["_id"]),
+        loop_id=task["loop_id"],
+        description=task["description"],
+        type=task["type"],
+        assigned_user_id=task.get("assigned_user_id"),
+        assigned_email=task.get("assigned_email"),
+        due_date=task.get("due_date"),
+        tags=task.get("tags", []),
+        notes=task.get("notes"),
+        attachments=task.get("attachments", []),
+        status=task["status"],
+        completed_at=task.get("completed_at"),
+        created_at=task["created_at"],
+        updated_at=task["updated_at"],
+        order=task["order"]
+    )
+
+def build_task_update(task_data: TaskUpdate):
+    """Build the $set document for a task update (only include provided fields)"""
+    update_data = {"updated_at": datetime.utcnow()}
+    if task_data.description is not None:
+        update_data["description"] = task_data.description
+    if task_data.type is not None:
+        update_data["type"] = task_data.type
+    if task_data.assigned_email is not None:
+        update_data["assigned_email"] = task_data.assigned_email
+    if task_data.due_date is not None:
+        update_data["due_date"] = task_data.due_date
+    if task_data.tags is not None:
+        update_data["tags"] = task_data.tags
+    if task_data.notes is not None:
+        update_data["notes"] = task_data.notes
+    if task_data.attachments is not None:
+        update_data["attachments"] = task_data.attachments
+    return update_data
+
+async def next_task_order(loop_id: str):
+    last_task = await db.tasks.find({"loop_id": loop_id}, {"order": 1}).sort("order", -1).limit(1).to_list(1)
+    return (last_task[0]["order"] + 1) if last_task else 1
+
+async def next_loop_order(owner_id: str):
+    # New loops go last; loops without an order would sort ahead of every ordered one
+    last_loop = await db.loops.find({"owner_id": owner_id}, {"order": 1}).sort("order", -1).limit(1).to_list(1)
+    return (last_loop[0]["order"] + 1) if last_loop and last_loop[0].get("order") is not None else 0
+
+async def apply_order(collection, object_ids: List[ObjectId], start: int = 0):
+    """Set order=position for every id with one unordered bulk_write (one round-trip)"""
+    if not object_ids:
+        return
+    
+    now = datetime.utcnow()
+    operations = [
+        UpdateOne({"_id": object_id}, {"$set": {"order": start + index, "updated_at": now}})
+        for index, object_id in enumerate(object_ids)
+    ]
+    await collection.bulk_write(operations, ordered=False)
+
+async def mutate_owned_task(task_id: str, owner_id: str, mutate):
+    """Run mutate(query) with a query matching the task only if owner_id owns it (one round-trip)
+    
+    When nothing matched, the task is looked up: a missing or foreign task is a 404, and a
+    task created before owner_id was denormalized is verified through its loop, stamped
+    with owner_id, and mutated again. Returns mutate's result, which may still be None
+    (e.g. a status condition in the query didn't hold).
+    """
+    object_id = parse_task_ids([task_id])[0]
+    query = {"_id": object_id, "owner_id": owner_id}
+    result = await mutate(query)
+    if result is not None:
+        return result
+    
+    task = await db.tasks.find_one({"_id": object_id}, {"loop_id": 1, "owner_id": 1})
+    if task and "owner_id" not in task:
+        loop = await db.loops.find_one({"_id": ObjectId(task["loop_id"]), "owner_id": owner_id}, {"_id": 1})
+        if loop:
+            await db.tasks.update_one({"_id": object_id}, {"$set": {"owner_id": owner_id}})
+            return await mutate(query)
+    if not task or task.get("owner_id") != owner_id:
+        raise HTTPException(status_code=404, detail="Task not found")
+    return None
+
+async def backfill_task_owners(batch_size: int = 500):
+    """Copy each loop's owner_id onto its tasks created before tasks carried one"""
+    backfilled = 0
+    operations = []
+    
+    async for loop in db.loops.find({}, {"owner_id": 1}):
+        operations.append(UpdateMany(
+            {"loop_id": str(loop["_id"]), "owner_id": {"$exists": False}},
+            {"$set": {"owner_id": loop["owner_id"]}}
+        ))
+        if len(operations) >= batch_size:
+            result = await db.tasks.bulk_write(operations, ordered=False)
+            backfilled += result.modified_count
+            operations = []
+    
+    if operations:
+        result = await db.tasks.bulk_write(operations, ordered=False)
+        backfilled += result.modified_count
+    
+    return backfilled
+
+def parse_task_ids(task_ids: List[str]):
+    try:
+        return [ObjectId(task_id) for task_id in task_ids]
+    except Exception:
+        raise HTTPException(status_code=404, detail="Task not found")
+
+# Reset Helper Functions
+def compute_next_reset(reset_rule: str, timezone_name: Optional[str], after: datetime):
+    """Next local midnight (daily) or Monday midnight (weekly) after `after`, as naive UTC"""
+    if reset_rule not in ("daily", "weekly"):
+        return None
+    
+    tz = ZoneInfo(timezone_name or "UTC")
+    local_now = after.replace(tzinfo=timezone.utc).astimezone(tz)
+    days_ahead = 1 if reset_rule == "daily" else 7 - local_now.weekday()
+    next_local = datetime.combine(local_now.date() + timedelta(days=days_ahead), datetime.min.time(), tzinfo=tz)
+    
+    return next_local.astimezone(timezone.utc).replace(tzinfo=None)
+
+async def reset_loops(loop_ids: List[str]):
+    """Apply reloop semantics to many loops at once; returns their refreshed task counts"""
+    if not loop_ids:
+        return {}
+    
+    # The counts being reset are the period's result, recorded in the completion history
+    period_counts, loops = await asyncio.gather(
+        get_task_counts(loop_ids),
+        db.loops.find({"_id": {"$in": [ObjectId(loop_id) for loop_id in loop_ids]}}, {"owner_id": 1, "timezone": 1})
+        .to_list(None)
+    )
+    
+    # Reset recurring tasks to pending, archive one-time completed tasks
+    await db.tasks.update_many(
+        {"loop_id": {"$in": loop_ids}, "type": "recurring"},
+        {
+            "$set": {
+                "status": "pending",
+                "updated_at": datetime.utcnow()
+            },
+            "$unset": {"completed_at": ""}
+        }
+    )
+    
+    await db.tasks.update_many(
+        {"loop_id": {"$in": loop_ids}, "type": "one-time", "status": "completed"},
+        {
+            "$set": {
+                "status": "archived",
+                "updated_at": datetime.utcnow()
+            }
+        }
+    )
+    
+    await record_task_events([
+        {
+            "type": "reset",
+            "owner_id": loop["owner_id"],
+            "loop_id": str(loop["_id"]),
+            "timezone": loop.get("timezone"),
+            "total": period_counts.get(str(loop["_id"]), (0, 0))[0],
+            "completed": period_counts.get(str(loop["_id"]), (0, 0))[1]
+        }
+        for loop in loops
+    ])
+    
+    # A reset touches many tasks at once, so recount instead of tracking each transition
+    return await refresh_loop_counters(loop_ids)
+
+async def claim_due_resets(due_loops, now: datetime):
+    """Advance each due loop's next_reset_at with a compare-and-set; returns the loops this caller won
+    
+    Guarding on the old next_reset_at means that of several callers racing the same loop (or a
+    concurrent reset rule change) exactly one wins, so only the winner goes on to reset it.
+    """
+    claims = await asyncio.gather(*[
+        db.loops.update_one(
+            {"_id": loop["_id"], "next_reset_at": loop["next_reset_at"]},
+            {"$set": {
+                "last_reset_at": now,
+                "next_reset_at": compute_next_reset(loop["reset_rule"], loop.get("timezone"), now)
+            }}
+        )
+        for loop in due_loops
+    ])
+    return [loop for loop, claim in zip(due_loops, claims) if claim.modified_count]
+
+async def apply_lazy_resets(loops, now: Optional[datetime] = None):
+    """Reset any just-read loops whose period boundary has passed (RESET_MODE=lazy)
+    
+    Each due loop is claimed with a compare-and-set on its next_reset_at, so when several
+    requests read the same stale loop concurrently exactly one of them performs the reset.
+    Claimed loop documents are updated in place; returns the ids of the loops reset.
+    """
+    now = now or datetime.utcnow()
+    due_loops = [loop for loop in loops if loop.get("next_reset_at") and loop["next_reset_at"] <= now]
+    if not due_loops:
+        return []
+    
+    claimed = await claim_due_resets(due_loops, now)
+    counts = await reset_loops([str(loop["_id"]) for loop in claimed])
+    if claimed:
+        await bump_versions([loop["owner_id"] for loop in claimed], [loop["_id"] for loop in claimed])
+    for loop in claimed:
+        loop["last_reset_at"] = now
+        loop["next_reset_at"] = compute_next_reset(loop["reset_rule"], loop.get("timezone"), now)
+        loop["total_tasks"], loop["completed_tasks"] = counts[str(loop["_id"])]
+        loop["version"] = loop.get("version", 0) + 1
+    
+    return [str(loop["_id"]) for loop in claimed]
+
+async def acquire_lease(name: str, ttl_seconds: int = LEASE_SECONDS):
+    """Take or renew a named lease; False while another replica holds it"""
+    now = datetime.utcnow()
+    try:
+        await db.leases.find_one_and_update(
+            {"_id": name, "$or": [{"holder": INSTANCE_ID}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"holder": INSTANCE_ID, "expires_at": now + timedelta(seconds=ttl_seconds)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+async def release_lease(name: str):
+    await db.leases.delete_one({"_id": name, "holder": INSTANCE_ID})
+
+reset_scheduler_stats = {
+    "sweeps": 0,
+    "loops_reset": 0,
+    "last_batch_size": 0,
+    "last_lag_seconds": 0.0,
+    "last_sweep_at": None,
+    "holds_lease": False
+}
+
+async def run_due_resets(now: Optional[datetime] = None, lease: Optional[str] = None):
+    """Reset one batch of loops whose next_reset_at has passed; returns the batch size
+    
+    With a lease, it is renewed first and nothing is reset (0 is returned) once it's lost.
+    """
+    if lease and not await acquire_lease(lease):
+        logger.warning("Lost the reset scheduler lease, stopping")
+        return 0
+    
+    now = now or datetime.utcnow()
+    due_loops = await db.loops.find(
+        {"next_reset_at": {"$lte": now}, "is_deleted": {"$ne": True}},
+        {"owner_id": 1, "reset_rule": 1, "timezone": 1, "next_reset_at": 1}
+    ).sort("next_reset_at", 1).limit(RESET_BATCH_SIZE).to_list(RESET_BATCH_SIZE)
+    
+    if due_loops:
+        # Claim before resetting, so a loop is never reset (and its history recorded) twice
+        claimed = await claim_due_resets(due_loops, now)
+        if claimed:
+            await reset_loops([str(loop["_id"]) for loop in claimed])
+            await bump_versions([loop["owner_id"] for loop in claimed], [loop["_id"] for loop in claimed])
+        
+        reset_scheduler_stats["loops_reset"] += len(claimed)
+        reset_scheduler_stats["last_lag_seconds"] = (now - due_loops[0]["next_reset_at"]).total_seconds()
+    
+    reset_scheduler_stats["last_batch_size"] = len(due_loops)
+    return len(due_loops)
+
+async def reset_scheduler():
+    """Background loop: while holding the lease, drain due resets every interval"""
+    while True:
+        try:
+            holds_lease = await acquire_lease("reset-scheduler")
+            reset_scheduler_stats["holds_lease"] = holds_lease
+            if holds_lease:
+                # Keep going while batches come back full; a backlog shouldn't wait an interval.
+                # The lease is renewed per batch, so a long backlog doesn't outlive it
+                while await run_due_resets(lease="reset-scheduler") >= RESET_BATCH_SIZE:
+                    pass
+                reset_scheduler_stats["sweeps"] += 1
+                reset_scheduler_stats["last_sweep_at"] = datetime.utcnow()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Scheduled loop reset sweep failed")
+        
+        await asyncio.sleep(RESET_SCHEDULER_INTERVAL_SECONDS)
+
+async def backfill_next_resets(batch_size: int = 500):
+    """Schedule daily/weekly loops created before next_reset_at existed, and give any loop
+    without a timezone (e.g. manual loops from then) its owner's, which history is bucketed by
+    """
+    now = datetime.utcnow()
+    timezones = {}
+    scheduled = 0
+    operations = []
+    
+    async for loop in db.loops.find(
+        {"$or": [
+            {"reset_rule": {"$in": ["daily", "weekly"]}, "next_reset_at": {"$exists": False}},
+            {"timezone": {"$exists": False}}
+        ]},
+        {"reset_rule": 1, "owner_id": 1, "next_reset_at": 1}
+    ):
+        owner_id = loop["owner_id"]
+        if owner_id not in timezones:
+            owner = await db.users.find_one({"_id": ObjectId(owner_id)}, {"timezone": 1})
+            timezones[owner_id] = (owner or {}).get("timezone", "UTC")
+        
+        update = {"timezone": timezones[owner_id]}
+        if loop["reset_rule"] in ("daily", "weekly") and "next_reset_at" not in loop:
+            update["next_reset_at"] = compute_next_reset(loop["reset_rule"], timezones[owner_id], now)
+        operations.append(UpdateOne({"_id": loop["_id"]}, {"$set": update}))
+        if len(operations) >= batch_size:
+            await db.loops.bulk_write(operations, ordered=False)
+            scheduled += len(operations)
+            operations = []
+    
+    if operations:
+        await db.loops.bulk_write(operations, ordered=False)
+        scheduled += len(operations)
+    
+    return scheduled
+
+# Purge Helper Functions
+purge_stats = {
+    "runs": 0,
+    "loops_purged": 0,
+    "tasks_purged": 0,
+    "bytes_reclaimed": 0,
+    "last_run_at": None,
+    "holds_lease": False
+}
+
+async def purge_loop_tasks(loop_id: str, batch_size: int = PURGE_BATCH_SIZE):
+    """Delete a loop's tasks in bounded, paced batches; returns (tasks deleted, BSON bytes deleted)"""
+    deleted = 0
+    reclaimed = 0
+    while True:
+        batch = await db.tasks.aggregate([
+            {"$match": {"loop_id": loop_id}},
+            {"$limit": batch_size},
+            {"$project": {"size": {"$bsonSize": "$$ROOT"}}}
+        ]).to_list(batch_size)
+        if not batch:
+            return deleted, reclaimed
+        
+        result = await db.tasks.delete_many({"_id": {"$in": [task["_id"] for task in batch]}})
+        deleted += result.deleted_count
+        reclaimed += sum(task["size"] for task in batch)
+        # Pace deletes so a large purge doesn't saturate the primary or replication
+        await asyncio.sleep(len(batch) / PURGE_MAX_DELETES_PER_SECOND)
+
+async def purge_expired_loops(now: Optional[datetime] = None, lease: Optional[str] = None):
+    """Permanently remove one batch of loops soft-deleted past retention, tasks first
+    
+    A loop is only deleted after all its tasks are, so an interrupted purge simply picks the
+    same loop up again next run. Progress is checkpointed in purge_checkpoints. With a lease,
+    it is renewed before each loop and the batch stops early once it's lost. Returns the
+    number of loops processed.
+    """
+    now = now or datetime.utcnow()
+    expired = {"is_deleted": True, "deleted_at": {"$lt": now - timedelta(days=DELETED_LOOP_RETENTION_DAYS)}}
+    expired_loops = await db.loops.find(
+        expired, {"owner_id": 1, "deleted_at": 1}
+    ).sort("deleted_at", 1).limit(PURGE_BATCH_SIZE).to_list(PURGE_BATCH_SIZE)
+    
+    processed = 0
+    for loop in expired_loops:
+        if lease and not await acquire_lease(lease):
+            logger.warning("Lost the purge lease mid-batch, stopping")
+            break
+        processed += 1
+        
+        # Claim the loop before touching its tasks; restore_loop leaves claimed loops alone
+        claimed = await db.loops.update_one({"_id": loop["_id"], **expired}, {"$set": {"purging": True}})
+        if not claimed.matched_count:
+            continue
+        
+        await db.purge_checkpoints.update_one(
+            {"_id": "deleted-loops"},
+            {"$set": {"loop_id": loop["_id"], "deleted_at": loop["deleted_at"], "updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+        
+        tasks_deleted, reclaimed = await purge_loop_tasks(str(loop["_id"]))
+        loop_size = await db.loops.aggregate([
+            {"$match": {"_id": loop["_id"]}},
+            {"$project": {"size": {"$bsonSize": "$$ROOT"}}}
+        ]).to_list(1)
+        result = await db.loops.delete_one({"_id": loop["_id"], "is_deleted": True})
+        if result.deleted_count:
+            reclaimed += loop_size[0]["size"] if loop_size else 0
+            purge_stats["loops_purged"] += 1
+            await record_tombstones(loop["owner_id"], "loop", [loop["_id"]])
+            await bump_versions([loop["owner_id"]])
+        
+        purge_stats["tasks_purged"] += tasks_deleted
+        purge_stats["bytes_reclaimed"] += reclaimed
+        await db.purge_checkpoints.update_one(
+            {"_id": "deleted-loops"},
+            {
+                "$unset": {"loop_id": ""},
+                "$inc": {
+                    "loops_purged": result.deleted_count,
+                    "tasks_purged": tasks_deleted,
+                    "bytes_reclaimed": reclaimed
+                }
+            }
+        )
+    
+    return processed
+
+async def purge_orphaned_tasks(batch_size: int = PURGE_BATCH_SIZE):
+    """Delete tasks whose loop no longer exists; returns (tasks deleted, BSON bytes deleted)"""
+    deleted = 0
+    reclaimed = 0
+    loop_ids = []
+    
+    async def purge_batch(loop_ids):
+        nonlocal deleted, reclaimed
+        object_ids = [ObjectId(loop_id) for loop_id in loop_ids if ObjectId.is_valid(loop_id)]
+        existing = {str(loop["_id"]) async for loop in db.loops.find({"_id": {"$in": object_ids}}, {"_id": 1})}
+        for loop_id in loop_ids:
+            if loop_id not in existing:
+                tasks_deleted, bytes_deleted = await purge_loop_tasks(loop_id, batch_size)
+                deleted += tasks_deleted
+                reclaimed += bytes_deleted
+    
+    async for row in db.tasks.aggregate([{"$group": {"_id": "$loop_id"}}]):
+        loop_ids.append(row["_id"])
+        if len(loop_ids) >= batch_size:
+            await purge_batch(loop_ids)
+            loop_ids = []
+    
+    if loop_ids:
+        await purge_batch(loop_ids)
+    
+    return deleted, reclaimed
+
+async def purge_worker():
+    """Background loop: while holding the lease, purge expired loops every interval"""
+    while True:
+        try:
+            holds_lease = await acquire_lease("deleted-loop-purge")
+            purge_stats["holds_lease"] = holds_lease
+            if holds_lease:
+                # The lease is renewed per loop, so a long batch doesn't outlive it
+                while await purge_expired_loops(lease="deleted-loop-purge") >= PURGE_BATCH_SIZE:
+                    pass
+                purge_stats["runs"] += 1
+                purge_stats["last_run_at"] = datetime.utcnow()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Deleted loop purge failed")
+        
+        await asyncio.sleep(PURGE_INTERVAL_SECONDS)
+
+# Pagination Helper Functions
+# Listing limits are optional; without one every matching document is returned
+MAX_PAGE_SIZE = 1000
+
+# Task fields a list request may select with ?fields=; id, loop_id and order are always returned
+TASK_LIST_FIELDS = {
+    "description": None,
+    "type": None,
+    "assigned_user_id": None,
+    "assigned_email": None,
+    "due_date": None,
+    "tags": [],
+    "notes": None,
+    "attachments": [],
+    "status": None,
+    "completed_at": None,
+    "created_at": None,
+    "updated_at": None
+}
+
+def encode_cursor(value, object_id: ObjectId):
+    """Opaque keyset cursor for the (value, _id) of the last item on a page"""
+    if isinstance(value, datetime):
+        value = {"$date": value.isoformat()}
+    raw = json.dumps([value, str(object_id)]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_cursor(cursor: str):
+    try:
+        value, object_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if isinstance(value, dict):
+            value = datetime.fromisoformat(value["$date"])
+        return value, ObjectId(object_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def keyset_filter(field: str, cursor: str):
+    """Match documents sorted after the cursor position on (field, _id), both ascending"""
+    value, object_id = decode_cursor(cursor)
+    if value is None:
+        # Missing/null sorts before every value
+        return {"$or": [{field: {"$ne": None}}, {field: None, "_id": {"$gt": object_id}}]}
+    return {"$or": [{field: {"$gt": value}}, {field: value, "_id": {"$gt": object_id}}]}
+
+async def fetch_page(collection, query: dict, sort_field: str, limit: Optional[int], after: Optional[str],
+                     projection: Optional[dict] = None):
+    """Return (documents, next_cursor) for a keyset-paginated (sort_field, _id) listing"""
+    if after:
+        query = {"$and": [query, keyset_filter(sort_field, after)]}
+    
+    cursor = collection.find(query, projection).sort([(sort_field, 1), ("_id", 1)])
+    if limit is None:
+        return await cursor.to_list(None), None
+    
+    # Read one extra document to learn whether another page exists
+    documents = await cursor.limit(limit + 1).to_list(limit + 1)
+    if len(documents) <= limit:
+        return documents, None
+    
+    documents = documents[:limit]
+    return documents, encode_cursor(documents[-1].get(sort_field), documents[-1]["_id"])
+
+def parse_task_fields(fields: Optional[str]):
+    if fields is None:
+        return None
+    
+    selected = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in selected if field not in TASK_LIST_FIELDS and field not in ("id", "loop_id", "order")]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown task fields: {', '.join(unknown)}")
+    return [field for field in selected if field in TASK_LIST_FIELDS]
+
+def build_task_dict(task, fields: List[str] = TASK_LIST_FIELDS):
+    item = {"id": str(task["_id"]), "loop_id": task["loop_id"], "order": task["order"]}
+    for field in fields:
+        item[field] = task.get(field, TASK_LIST_FIELDS[field])
+    return item
+
+# Fast JSON Serialization
+def json_default(value):
+    """Encode the BSON/Python types stored in our documents that JSON has no type for"""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dump_json(data):
+    """Serialize to JSON bytes with orjson when installed, else the standard json module"""
+    if orjson is not None:
+        return orjson.dumps(data, default=json_default)
+    return json.dumps(data, default=json_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse for content that is already plain dicts/lists of document values"""
+    
+    def render(self, content) -> bytes:
+        return dump_json(content)
+
+# Version Helper Functions (ETags)
+@asynccontextmanager
+async def owner_change(owner_id: str):
+    """Advance the owner's version and yield it as the change number to stamp a write with
+    
+    The number stays reserved until the block exits; delta sync won't hand out a cursor past
+    a reserved number, so a write stamped after a sync has read the version isn't skipped.
+    """
+    token = uuid.uuid4().hex
+    doc = await db.versions.find_one_and_update(
+        {"_id": owner_id},
+        {"$inc": {"version": 1}, "$set": {f"pending.{token}": datetime.utcnow()}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    try:
+        yield doc["version"]
+    finally:
+        await db.versions.update_one({"_id": owner_id}, {"$unset": {f"pending.{token}": ""}})
+
+async def bump_versions(owner_ids: List[str], loop_ids: List[ObjectId] = ()):
+    """Advance the loop-list version of each owner and the task-list version of each loop
+    
+    Call after every write that changes what GET /loops or GET /loops/{id}/tasks returns,
+    otherwise clients polling with the old ETag keep getting 304s. The loops are stamped with
+    their owner's new version as `seq`, which is what delta sync picks changed loops by.
+    """
+    owner_ids = set(owner_ids)
+    loops_by_owner = {owner_id: [] for owner_id in owner_ids}
+    if len(owner_ids) == 1:
+        loops_by_owner[next(iter(owner_ids))] = list(loop_ids)
+    elif loop_ids:
+        async for loop in db.loops.find({"_id": {"$in": list(loop_ids)}}, {"owner_id": 1}):
+            loops_by_owner.setdefault(loop["owner_id"], []).append(loop["_id"])
+    
+    async def bump(owner_id, owner_loop_ids):
+        async with owner_change(owner_id) as seq:
+            if owner_loop_ids:
+                await db.loops.update_many(
+                    {"_id": {"$in": owner_loop_ids}, "owner_id": owner_id},
+                    {"$inc": {"version": 1}, "$set": {"seq": seq}}
+                )
+    
+    await asyncio.gather(*[bump(owner_id, owner_loop_ids) for owner_id, owner_loop_ids in loops_by_owner.items()])
+
+async def get_owner_version(owner_id: str):
+    doc = await db.versions.find_one({"_id": owner_id})
+    return doc["version"] if doc else 0
+
+def make_etag(*parts):
+    """Strong ETag over a version counter plus whatever else selects the representation"""
+    return '"' + hashlib.sha256(json.dumps(parts, default=str).encode('utf-8')).hexdigest()[:24] + '"'
+
+def etag_matches(if_none_match: Optional[str], etag: str):
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+# Sync Helper Functions
+def encode_sync_cursor(started_at: datetime, version: int):
+    raw = json.dumps({"t": started_at.isoformat(), "v": version}).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_sync_cursor(cursor: str):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.fromisoformat(data["t"]), int(data["v"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid sync cursor")
+
+def build_sync_loop_dict(loop, total_tasks: int, completed_tasks: int):
+    """Loop fields plus the list state a client replica needs (order, favorite, soft-deleted)"""
+    return {
+        **build_loop_dict(loop, total_tasks, completed_tasks),
+        "order": loop.get("order"),
+        "is_favorite": loop.get("is_favorite", False),
+        "is_deleted": loop.get("is_deleted", False)
+    }
+
+async def record_tombstones(owner_id: str, kind: str, ids: List):
+    """Remember hard deletes so delta sync can tell clients to drop them"""
+    if not ids:
+        return
+    now = datetime.utcnow()
+    async with owner_change(owner_id) as seq:
+        await db.tombstones.insert_many(
+            [
+                {"owner_id": owner_id, "kind": kind, "id": str(object_id), "seq": seq, "deleted_at": now}
+                for object_id in ids
+            ],
+            ordered=False
+        )
+
+async def apply_owner_lazy_resets(owner_id: str):
+    """Reset an owner's due loops before answering a listing (RESET_MODE=lazy)"""
+    now = datetime.utcnow()
+    due_loops = await db.loops.find(
+        {"owner_id": owner_id, "is_deleted": {"$ne": True}, "next_reset_at": {"$lte": now}}
+    ).to_list(None)
+    await apply_lazy_resets(due_loops, now)
+
+# Live Update Helper Functions
+class LiveSubscriber:
+    """One connected client's view of a loop: a bounded queue of (event_id, event) pairs"""
+    
+    def __init__(self, loop_id: str):
+        self.loop_id = loop_id
+        self.queue = asyncio.Queue(LIVE_QUEUE_SIZE)
+        # Set when the client fell too far behind; it must resync from a fresh GET
+        self.overflowed = False
+
+class LiveFeed:
+    """Fans one change stream on tasks/loops out to the clients subscribed to each loop
+    
+    Events are identified by their change stream resume token and kept in a ring buffer,
+    so a client reconnecting with Last-Event-ID is replayed what it missed if this process
+    still has it, and told to resync otherwise. The stream itself resumes from the last
+    token after errors, so a mongod failover doesn't drop events.
+    """
+    
+    def __init__(self, buffer_size: int):
+        self.subscribers = {}
+        self.buffer = deque(maxlen=buffer_size)
+        self.resume_token = None
+        self.connected = False
+        self.events = 0
+    
+    def subscribe(self, loop_id: str, last_event_id: Optional[str] = None):
+        """Register a subscriber; returns it with the buffered events it missed, or None if it must resync"""
+        subscriber = LiveSubscriber(loop_id)
+        missed = []
+        if last_event_id is not None:
+            ids = [event_id for event_id, _, _ in self.buffer]
+            if last_event_id not in ids:
+                missed = None
+            else:
+                missed = [
+                    (event_id, event) for event_id, event_loop_id, event in list(self.buffer)[ids.index(last_event_id) + 1:]
+                    if event_loop_id == loop_id
+                ]
+        self.subscribers.setdefault(loop_id, set()).add(subscriber)
+        return subscriber, missed
+    
+    def unsubscribe(self, subscriber: LiveSubscriber):
+        subscribers = self.subscribers.get(subscriber.loop_id)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self.subscribers[subscriber.loop_id]
+    
+    def publish(self, change):
+        """Route one change stream document to the subscribers of the loop it belongs to"""
+        routed = route_change(change)
+        if routed is None:
+            return
+        
+        loop_id, event = routed
+        event_id = change["_id"]["_data"]
+        self.buffer.append((event_id, loop_id, event))
+        self.events += 1
+        for subscriber in self.subscribers.get(loop_id, ()):
+            try:
+                subscriber.queue.put_nowait((event_id, event))
+            except asyncio.QueueFull:
+                subscriber.overflowed = True
+    
+    def drop_history(self):
+        """The stream could not resume: buffered events no longer line up, so everyone resyncs"""
+        self.buffer.clear()
+        self.resume_token = None
+        for subscribers in self.subscribers.values():
+            for subscriber in subscribers:
+                subscriber.overflowed = True
+    
+    async def run(self):
+        """Background loop: keep one change stream open, resuming after errors"""
+        pipeline = [{"$match": {"ns.coll": {"$in": ["tasks", "loops"]}}}]
+        while True:
+            try:
+                async with db.watch(
+                    pipeline,
+                    full_document="updateLookup",
+                    full_document_before_change="whenAvailable",
+                    resume_after=self.resume_token
+                ) as stream:
+                    self.connected = True
+                    async for change in stream:
+                        self.publish(change)
+                        self.resume_token = stream.resume_token
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                # 286 ChangeStreamHistoryLost / 280 ChangeStreamFatalError: the token is past the oplog
+                if e.code in (280, 286):
+                    logger.warning(f"Change stream could not resume, clients will resync: {e}")
+                    self.drop_history()
+                else:
+                    logger.exception("Change stream failed")
+            except Exception:
+                logger.exception("Change stream failed")
+            
+            self.connected = False
+            await asyncio.sleep(1)
+    
+    def stats(self):
+        return {
+            "connected": self.connected,
+            "events": self.events,
+            "buffered": len(self.buffer),
+            "loops": len(self.subscribers),
+            "subscribers": sum(len(subscribers) for subscribers in self.subscribers.values())
+        }
+
+def route_change(change):
+    """Map a tasks/loops change stream document to (loop_id, event), or None if it can't be routed
+    
+    Task deletes are routed by their pre-image (MongoDB 6.0+ with changeStreamPreAndPostImages on
+    tasks); without one the delete is skipped, but the loop's own version bump still reaches clients.
+    """
+    operation = change["operationType"]
+    document_id = change["documentKey"]["_id"]
+    document = change.get("fullDocument") or change.get("fullDocumentBeforeChange")
+    
+    if change["ns"]["coll"] == "loops":
+        loop_id = str(document_id)
+        if operation == "delete" or document is None:
+            return loop_id, {"type": "loop", "op": "delete", "id": loop_id}
+        loop = build_loop_dict(document, document.get("total_tasks", 0), document.get("completed_tasks", 0))
+        return loop_id, {"type": "loop", "op": operation, "loop": loop}
+    
+    if document is None:
+        return None
+    if operation == "delete" or change.get("fullDocument") is None:
+        return document["loop_id"], {"type": "task", "op": "delete", "id": str(document_id)}
+    return document["loop_id"], {"type": "task", "op": operation, "task": build_task_dict(document)}
+
+def format_sse(event_id: str, event: dict):
+    return f"id: {event_id}\nevent: {event['type']}\ndata: {dump_json(event).decode('utf-8')}\n\n"
+
+live_feed = LiveFeed(LIVE_BUFFER_SIZE)
+
+async def enable_task_pre_images():
+    """Record pre-images on tasks so change stream deletes still say which loop they were in"""
+    try:
+        await db.command("collMod", "tasks", changeStreamPreAndPostImages={"enabled": True})
+    except OperationFailure as e:
+        logger.warning(f"Task delete events won't be routed without change stream pre-images: {e}")
+
+# History Helper Functions
+async def ensure_task_events_collection():
+    """Create task_events as a time-series collection bucketed by owner/loop (MongoDB 5.0+)"""
+    options = {"timeseries": {"timeField": "at", "metaField": "meta", "granularity": "hours"}}
+    if TASK_EVENT_RETENTION_DAYS:
+        options["expireAfterSeconds"] = TASK_EVENT_RETENTION_DAYS * 24 * 60 * 60
+    try:
+        await db.create_collection("task_events", **options)
+    except CollectionInvalid:
+        pass  # already exists
+    except OperationFailure as e:
+        logger.error(f"Failed to create the task_events time-series collection: {e}")
+
+def local_date(timezone_name: Optional[str], at: datetime):
+    """The calendar day in timezone_name for a naive UTC datetime, as YYYY-MM-DD"""
+    return at.replace(tzinfo=timezone.utc).astimezone(ZoneInfo(timezone_name or "UTC")).strftime("%Y-%m-%d")
+
+async def record_task_events(events: List[dict]):
+    """Append completion/reset events and fold them into the daily completion_rollups
+    
+    Each event: owner_id, loop_id, the loop's timezone, type ("completed" or "reset"), plus count and
+    task_id for completions, or total/completed (the period's counts) for resets. History is
+    best-effort: a failure here is logged, never surfaced to the write that caused it.
+    """
+    if not events:
+        return
+    
+    now = datetime.utcnow()
+    documents = []
+    rollups = []
+    for event in events:
+        meta = {"owner_id": event["owner_id"], "loop_id": event["loop_id"]}
+        day = local_date(event.get("timezone"), now)
+        if event["type"] == "completed":
+            fields = {"count": event.get("count", 1)}
+            if event.get("task_id"):
+                fields["task_id"] = event["task_id"]
+            increments = {"completions": fields["count"]}
+        else:
+            fields = {"total": event["total"], "completed": event["completed"]}
+            increments = {"resets": 1, "reset_total": event["total"], "reset_completed": event["completed"]}
+        
+        documents.append({"at": now, "meta": meta, "type": event["type"], **fields})
+        rollups.append(UpdateOne(
+            {"_id": f"{meta['owner_id']}:{meta['loop_id']}:{day}"},
+            {"$setOnInsert": {**meta, "day": day}, "$inc": increments},
+            upsert=True
+        ))
+    
+    try:
+        await asyncio.gather(
+            db.task_events.insert_many(documents, ordered=False),
+            db.completion_rollups.bulk_write(rollups, ordered=False)
+        )
+    except Exception:
+        logger.exception("Failed to record task history")
+
+async def get_completion_stats(owner_id: str, days: int, timezone_name: Optional[str], loop_id: Optional[str] = None):
+    """Completion totals, rate and current streak over the last `days` days, from the daily rollups"""
+    today = datetime.utcnow()
+    first_day = local_date(timezone_name, today - timedelta(days=days - 1))
+    match = {"owner_id": owner_id, "day": {"$gte": first_day}}
+    if loop_id:
+        match["loop_id"] = loop_id
+    
+    daily = await db.completion_rollups.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": "$day",
+            "completions": {"$sum": "$completions"},
+            "resets": {"$sum": "$resets"},
+            "reset_total": {"$sum": "$reset_total"},
+            "reset_completed": {"$sum": "$reset_completed"}
+        }},
+        {"$sort": {"_id": 1}}
+    ]).to_list(None)
+    
+    # Consecutive days with a completion, ending today (or yesterday, if nothing is done yet today)
+    active_days = {row["_id"] for row in daily if row.get("completions")}
+    streak = 0
+    day = today if local_date(timezone_name, today) in active_days else today - timedelta(days=1)
+    while local_date(timezone_name, day) in active_days:
+        streak += 1
+        day -= timedelta(days=1)
+    
+    reset_total = sum(row.get("reset_total", 0) for row in daily)
+    reset_completed = sum(row.get("reset_completed", 0) for row in daily)
+    return {
+        "days": days,
+        "completions": sum(row.get("completions", 0) for row in daily),
+        "resets": sum(row.get("resets", 0) for row in daily),
+        # Share of tasks that were done when their loop reset, over every reset in the window
+        "completion_rate": round(reset_completed / reset_total, 4) if reset_total else None,
+        "streak": streak,
+        "daily": [
+            {
+                "day": row["_id"],
+                "completions": row.get("completions", 0),
+                "resets": row.get("resets", 0),
+                "completion_rate": round(row["reset_completed"] / row["reset_total"], 4) if row.get("reset_total") else None
+            }
+            for row in daily
+        ]
+    }
+
+# Agenda Helper Functions
+def local_day_bounds(timezone_name: Optional[str], now: datetime):
+    """Start and end of the local calendar day containing `now` (naive UTC), as naive UTC"""
+    tz = ZoneInfo(timezone_name or "UTC")
+    local_date = now.replace(tzinfo=timezone.utc).astimezone(tz).date()
+    start = datetime.combine(local_date, datetime.min.time(), tzinfo=tz)
+    end = datetime.combine(local_date + timedelta(days=1), datetime.min.time(), tzinfo=tz)
+    return (
+        start.astimezone(timezone.utc).replace(tzinfo=None),
+        end.astimezone(timezone.utc).replace(tzinfo=None)
+    )
+
+async def get_deleted_loop_ids(owner_id: str):
+    """Ids of the user's loops in the trash, for hiding their tasks from cross-loop queries"""
+    return [str(loop["_id"]) async for loop in db.loops.find({"owner_id": owner_id, "is_deleted": True}, {"_id": 1})]
+
+def to_naive_utc(value: datetime):
+    """Stored datetimes are naive UTC; convert an aware query parameter to match"""
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+# Search Helper Functions
+async def search_collection(collection, match: dict, limit: int, after: Optional[str]):
+    """One page of matches ranked by (text score desc, _id asc); score is 0 without $text"""
+    pipeline = [
+        {"$match": match},
+        {"$addFields": {"score": {"$meta": "textScore"} if "$text" in match else {"$literal": 0}}},
+    ]
+    if after:
+        score, object_id = decode_cursor(after)
+        pipeline.append({"$match": {"$or": [{"score": {"$lt": score}}, {"score": score, "_id": {"$gt": object_id}}]}})
+    pipeline += [{"$sort": {"score": -1, "_id": 1}}, {"$limit": limit + 1}]
+    return await collection.aggregate(pipeline).to_list(limit + 1)
+
+def build_search_result(kind: str, doc):
+    if kind == "loop":
+        item = build_loop_dict(doc, doc.get("total_tasks", 0), doc.get("completed_tasks", 0))
+    else:
+        item = build_task_dict(doc)
+    return {"kind": kind, "score": doc["score"], kind: item}
+
+# Index Helper Functions
+async def ensure_indexes():
+    """Create any missing indexes declared in INDEXES, then drop OBSOLETE_INDEXES"""
+    # Must exist before its indexes, or creating them would make it a regular collection
+    await ensure_task_events_collection()
+    
+    failed = set()
+    for collection_name, indexes in INDEXES.items():
+        try:
+            await db[collection_name].create_indexes(indexes)
+        except OperationFailure as e:
+            # e.g. duplicate emails already stored; keep serving and surface it in the logs
+            logger.error(f"Failed to ensure indexes on {collection_name}: {e}")
+            failed.add(collection_name)
+    
+    # Dropped only after their replacements exist, so queries are never left without an index
+    for collection_name, index_names in OBSOLETE_INDEXES.items():
+        if collection_name in failed:
+            logger.warning(f"Keeping obsolete indexes on {collection_name} until its new indexes are built")
+            continue
+        existing = await db[collection_name].index_information()
+        for index_name in index_names:
+            if index_name in existing:
+                try:
+                    await db[collection_name].drop_index(index_name)
+                except OperationFailure as e:
+                    # Another replica may have dropped it first
+                    logger.warning(f"Failed to drop index {index_name} on {collection_name}: {e}")
+
+async def get_index_stats():
+    """Return per-index usage counters from $indexStats for every indexed collection"""
+    stats = {}
+    for collection_name in INDEXES:
+        stats[collection_name] = [
+            {
+                "name": row["name"],
+                "key": row["key"],
+                "ops": row["accesses"]["ops"],
+                "since": row["accesses"]["since"]
+            }
+            async for row in db[collection_name].aggregate([{"$indexStats": {}}])
+        ]
+    return stats
+
 # Auth Helper Functions
-def create_access_token(user_id: str):
+def create_access_token(user_id: str, email: Optional[str] = None, name: Optional[str] = None,
+                        timezone_name: Optional[str] = None):
     expire = datetime.utcnow() + timedelta(hours=JWT_EXPIRATION_HOURS)
     payload = {"user_id": user_id, "exp": expire}
+    # Identity claims let AUTH_STATELESS deployments skip the users lookup
+    if email is not None:
+        payload["email"] = email
+    if name is not None:
+        payload["name"] = name
+    if timezone_name is not None:
+        payload["timezone"] = timezone_name
     token = jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
     return token
 
+def invalidate_cached_user(user_id: str):
+    """Drop a user from the auth cache; call after any write to their user record"""
+    user_cache.pop(user_id)
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
         payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
@@ -186,11 +2504,24 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         if not user_id:
             raise HTTPException(status_code=401, detail="Invalid token")
         
-        user = await db.users.find_one({"_id": ObjectId(user_id)})
-        if not user:
-            raise HTTPException(status_code=401, detail="User not found")
+        if AUTH_STATELESS and "email" in payload:
+            return {
+                "_id": user_id,
+                "email": payload["email"],
+                "name": payload.get("name"),
+                "timezone": payload.get("timezone", "UTC")
+            }
+        
+        user = user_cache.get(user_id)
+        if user is None:
+            user = await db.users.find_one({"_id": ObjectId(user_id)}, {"password_hash": 0})
+            if not user:
+                raise HTTPException(status_code=401, detail="User not found")
+            user = str_object_id(user)
+            user_cache.set(user_id, user)
         
-        return str_object_id(user)
+        # Hand out a copy so handlers can't mutate the cached entry
+        return dict(user)
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except jwt.InvalidTokenError:
@@ -205,7 +2536,7 @@ async def register(user_data: UserCreate):
         raise HTTPException(status_code=400, detail="Email already registered")
     
     # Hash password
-    password_hash = bcrypt.hashpw(user_data.password.encode('utf-8'), bcrypt.gensalt())
+    password_hash = await password_hasher.hash(user_data.password)
     
     # Create user
     user_doc = {
@@ -213,20 +2544,26 @@ async def register(user_data: UserCreate):
         "email": user_data.email,
         "password_hash": password_hash,
         "name": user_data.name,
+        "timezone": user_data.timezone,
         "created_at": datetime.utcnow(),
         "updated_at": datetime.utcnow()
     }
     
-    await db.users.insert_one(user_doc)
+    try:
+        await db.users.insert_one(user_doc)
+    except DuplicateKeyError:
+        # Lost a race with a concurrent registration for the same email
+        raise HTTPException(status_code=400, detail="Email already registered")
     
     # Create token
-    token = create_access_token(str(user_doc["_id"]))
+    token = create_access_token(str(user_doc["_id"]), user_doc["email"], user_doc["name"], user_doc["timezone"])
     
     # Return response
     user_response = UserResponse(
         id=str(user_doc["_id"]),
         email=user_doc["email"],
         name=user_doc["name"],
+        timezone=user_doc["timezone"],
         created_at=user_doc["created_at"]
     )
     
@@ -240,17 +2577,66 @@ async def login(login_data: UserLogin):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     # Check password
-    if not bcrypt.checkpw(login_data.password.encode('utf-8'), user["password_hash"]):
+    if not await password_hasher.verify(login_data.password, user["password_hash"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     # Create token
-    token = create_access_token(str(user["_id"]))
+    token = create_access_token(str(user["_id"]), user["email"], user["name"], user.get("timezone", "UTC"))
     
     # Return response
     user_response = UserResponse(
         id=str(user["_id"]),
         email=user["email"],
         name=user["name"],
+        timezone=user.get("timezone", "UTC"),
+        created_at=user["created_at"]
+    )
+    
+    return AuthResponse(user=user_response, token=token)
+
+@api_router.put("/users/me", response_model=AuthResponse)
+async def update_current_user(user_data: UserUpdate, current_user = Depends(get_current_user)):
+    """Update the current user's profile; a timezone change reschedules their loop resets"""
+    update_data = {"updated_at": datetime.utcnow()}
+    if user_data.name is not None:
+        update_data["name"] = user_data.name
+    if user_data.timezone is not None:
+        update_data["timezone"] = user_data.timezone
+    
+    user = await db.users.find_one_and_update(
+        {"_id": ObjectId(current_user["_id"])},
+        {"$set": update_data},
+        projection={"password_hash": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    invalidate_cached_user(current_user["_id"])
+    
+    if user_data.timezone is not None:
+        now = datetime.utcnow()
+        for reset_rule in ("daily", "weekly"):
+            await db.loops.update_many(
+                {"owner_id": current_user["_id"], "reset_rule": reset_rule},
+                {"$set": {
+                    "timezone": user_data.timezone,
+                    "next_reset_at": compute_next_reset(reset_rule, user_data.timezone, now)
+                }}
+            )
+        # Manual loops don't reset on a schedule, but their completion history is bucketed by
+        # timezone too, and stats read it back in the user's zone
+        await db.loops.update_many(
+            {"owner_id": current_user["_id"], "reset_rule": {"$nin": ["daily", "weekly"]}},
+            {"$set": {"timezone": user_data.timezone}}
+        )
+    
+    # Stateless deployments read identity from the token, so hand back a fresh one
+    token = create_access_token(str(user["_id"]), user["email"], user["name"], user.get("timezone", "UTC"))
+    user_response = UserResponse(
+        id=str(user["_id"]),
+        email=user["email"],
+        name=user["name"],
+        timezone=user.get("timezone", "UTC"),
         created_at=user["created_at"]
     )
     
@@ -258,38 +2644,36 @@ async def login(login_data: UserLogin):
 
 # Loop Routes
 @api_router.get("/loops", response_model=List[LoopResponse])
-async def get_loops(current_user = Depends(get_current_user)):
+async def get_loops(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
+    current_user = Depends(get_current_user)
+):
+    """List loops ordered by (order, id); pass limit/after to page, the next cursor is in X-Next-Cursor
+    
+    Responses carry an ETag; a matching If-None-Match is answered with 304 without reading the loops.
+    """
+    owner_query = {"owner_id": current_user["_id"], "is_deleted": {"$ne": True}}
+    if RESET_MODE == "lazy":
+        # Due resets change the listing without a write, so apply them before comparing versions
+        await apply_owner_lazy_resets(current_user["_id"])
+    
+    etag = make_etag(current_user["_id"], await get_owner_version(current_user["_id"]), limit, after)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    
     # Only get non-deleted loops
-    loops = await db.loops.find({
-        "owner_id": current_user["_id"],
-        "is_deleted": {"$ne": True}
-    }).to_list(1000)
+    loops, next_cursor = await fetch_page(db.loops, owner_query, "order", limit, after)
+    headers = {"ETag": etag, **({"X-Next-Cursor": next_cursor} if next_cursor else {})}
     
-    # Calculate progress for each loop
-    result = []
-    for loop in loops:
-        # Get task counts
-        total_tasks = await db.tasks.count_documents({"loop_id": str(loop["_id"]), "status": {"$ne": "archived"}})
-        completed_tasks = await db.tasks.count_documents({"loop_id": str(loop["_id"]), "status": "completed"})
-        
-        progress = int((completed_tasks / total_tasks * 100) if total_tasks > 0 else 0)
-        
-        loop_response = LoopResponse(
-            id=str(loop["_id"]),
-            name=loop["name"],
-            description=loop.get("description"),
-            color=loop["color"],
-            owner_id=str(loop["owner_id"]),
-            reset_rule=loop["reset_rule"],
-            created_at=loop["created_at"],
-            updated_at=loop["updated_at"],
-            progress=progress,
-            total_tasks=total_tasks,
-            completed_tasks=completed_tasks
-        )
-        result.append(loop_response)
+    # Calculate progress for all loops in one round-trip
+    if FAST_JSON:
+        return FastJSONResponse(await build_loop_responses(loops, build_loop_dict), headers=headers)
     
-    return result
+    response.headers.update(headers)
+    return await build_loop_responses(loops)
 
 @api_router.post("/loops", response_model=LoopResponse)
 async def create_loop(loop_data: LoopCreate, current_user = Depends(get_current_user)):
@@ -300,11 +2684,17 @@ async def create_loop(loop_data: LoopCreate, current_user = Depends(get_current_
         "color": loop_data.color,
         "owner_id": current_user["_id"],
         "reset_rule": loop_data.reset_rule,
+        "timezone": current_user.get("timezone", "UTC"),
+        "next_reset_at": compute_next_reset(loop_data.reset_rule, current_user.get("timezone"), datetime.utcnow()),
+        "total_tasks": 0,
+        "completed_tasks": 0,
+        "order": await next_loop_order(current_user["_id"]),
         "created_at": datetime.utcnow(),
         "updated_at": datetime.utcnow()
     }
     
     await db.loops.insert_one(loop_doc)
+    await bump_versions([current_user["_id"]], [loop_doc["_id"]])
     
     return LoopResponse(
         id=str(loop_doc["_id"]),
@@ -339,35 +2729,27 @@ async def update_loop(loop_id: str, loop_data: LoopUpdate, current_user = Depend
             update_data["color"] = loop_data.color
         if loop_data.reset_rule is not None:
             update_data["reset_rule"] = loop_data.reset_rule
+            update_data["timezone"] = current_user.get("timezone", "UTC")
+            update_data["next_reset_at"] = compute_next_reset(
+                loop_data.reset_rule, current_user.get("timezone"), datetime.utcnow()
+            )
         
         # Update the loop
         await db.loops.update_one(
             {"_id": ObjectId(loop_id)},
             {"$set": update_data}
         )
+        await bump_versions([current_user["_id"]], [loop["_id"]])
         
         # Fetch and return updated loop with progress
         updated_loop = await db.loops.find_one({"_id": ObjectId(loop_id)})
         
         # Get task counts for progress calculation
-        total_tasks = await db.tasks.count_documents({"loop_id": loop_id, "status": {"$ne": "archived"}})
-        completed_tasks = await db.tasks.count_documents({"loop_id": loop_id, "status": "completed"})
-        progress = int((completed_tasks / total_tasks * 100) if total_tasks > 0 else 0)
-        
-        return LoopResponse(
-            id=str(updated_loop["_id"]),
-            name=updated_loop["name"],
-            description=updated_loop.get("description"),
-            color=updated_loop["color"],
-            owner_id=str(updated_loop["owner_id"]),
-            reset_rule=updated_loop["reset_rule"],
-            created_at=updated_loop["created_at"],
-            updated_at=updated_loop["updated_at"],
-            progress=progress,
-            total_tasks=total_tasks,
-            completed_tasks=completed_tasks
-        )
+        responses = await build_loop_responses([updated_loop])
+        return responses[0]
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to update loop: {str(e)}")
 
@@ -397,6 +2779,7 @@ async def soft_delete_loop(loop_id: str, current_user = Depends(get_current_user
                 }
             }
         )
+        await bump_versions([current_user["_id"]], [object_id])
         
         return {"message": "Loop moved to deleted items"}
         
@@ -419,21 +2802,18 @@ async def reorder_loops(request: LoopReorderRequest, current_user = Depends(get_
                 raise HTTPException(status_code=404, detail=f"Invalid loop ID: {loop_id}")
         
         # Check that all loops exist and belong to user
-        user_loops = await db.loops.find({
+        owned_count = await db.loops.count_documents({
             "_id": {"$in": loop_object_ids},
             "owner_id": current_user["_id"],
             "is_deleted": {"$ne": True}
-        }).to_list(100)
+        })
         
-        if len(user_loops) != len(request.loop_ids):
+        if owned_count != len(set(loop_object_ids)):
             raise HTTPException(status_code=404, detail="Some loops not found or access denied")
         
-        # Update the order field for each loop
-        for index, loop_id in enumerate(request.loop_ids):
-            await db.loops.update_one(
-                {"_id": ObjectId(loop_id)},
-                {"$set": {"order": index, "updated_at": datetime.utcnow()}}
-            )
+        # Update the order field for all loops in one bulk write
+        await apply_order(db.loops, loop_object_ids)
+        await bump_versions([current_user["_id"]], loop_object_ids)
         
         return {"message": "Loops reordered successfully"}
         
@@ -452,18 +2832,16 @@ async def restore_loop(loop_id: str, current_user = Depends(get_current_user)):
         except:
             raise HTTPException(status_code=404, detail="Deleted loop not found")
         
-        # Verify loop ownership and that it's deleted
-        loop = await db.loops.find_one({
-            "_id": object_id, 
-            "owner_id": current_user["_id"],
-            "is_deleted": True
-        })
-        if not loop:
-            raise HTTPException(status_code=404, detail="Deleted loop not found")
-        
-        # Restore the loop
-        await db.loops.update_one(
-            {"_id": object_id},
+        # Verify ownership and restore in one step; loops past retention or claimed by the
+        # purge may already have lost tasks, so they can't be restored
+        result = await db.loops.update_one(
+            {
+                "_id": object_id,
+                "owner_id": current_user["_id"],
+                "is_deleted": True,
+                "deleted_at": {"$gte": datetime.utcnow() - timedelta(days=DELETED_LOOP_RETENTION_DAYS)},
+                "purging": {"$ne": True}
+            },
             {
                 "$unset": {
                     "is_deleted": "",
@@ -474,6 +2852,9 @@ async def restore_loop(loop_id: str, current_user = Depends(get_current_user)):
                 }
             }
         )
+        if not result.matched_count:
+            raise HTTPException(status_code=404, detail="Deleted loop not found")
+        await bump_versions([current_user["_id"]], [object_id])
         
         return {"message": "Loop restored successfully"}
         
@@ -506,6 +2887,8 @@ async def permanently_delete_loop(loop_id: str, current_user = Depends(get_curre
         
         # Delete the loop permanently
         await db.loops.delete_one({"_id": object_id})
+        await record_tombstones(current_user["_id"], "loop", [object_id])
+        await bump_versions([current_user["_id"]])
         
         return {"message": "Loop permanently deleted"}
         
@@ -518,8 +2901,8 @@ async def permanently_delete_loop(loop_id: str, current_user = Depends(get_curre
 async def get_deleted_loops(current_user = Depends(get_current_user)):
     """Get all soft-deleted loops for the current user"""
     try:
-        # Get deleted loops that are less than 30 days old
-        thirty_days_ago = datetime.utcnow() - timedelta(days=30)
+        # Get deleted loops that are less than 30 days old; older ones are removed by purge_worker
+        thirty_days_ago = datetime.utcnow() - timedelta(days=DELETED_LOOP_RETENTION_DAYS)
         
         loops = await db.loops.find({
             "owner_id": current_user["_id"],
@@ -527,19 +2910,12 @@ async def get_deleted_loops(current_user = Depends(get_current_user)):
             "deleted_at": {"$gte": thirty_days_ago}
         }).to_list(1000)
         
-        # Auto-cleanup loops older than 30 days
-        await db.loops.delete_many({
-            "owner_id": current_user["_id"],
-            "is_deleted": True,
-            "deleted_at": {"$lt": thirty_days_ago}
-        })
-        
         # Format response
         result = []
         for loop in loops:
             # Calculate days remaining
             days_since_deleted = (datetime.utcnow() - loop["deleted_at"]).days
-            days_remaining = 30 - days_since_deleted
+            days_remaining = DELETED_LOOP_RETENTION_DAYS - days_since_deleted
             
             loop_response = {
                 "id": str(loop["_id"]),
@@ -560,36 +2936,48 @@ async def get_deleted_loops(current_user = Depends(get_current_user)):
 
 # Task Routes
 @api_router.get("/loops/{loop_id}/tasks", response_model=List[TaskResponse])
-async def get_tasks(loop_id: str, current_user = Depends(get_current_user)):
+async def get_tasks(
+    loop_id: str,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    fields: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
+    current_user = Depends(get_current_user)
+):
+    """List tasks ordered by (order, id); fields=a,b returns only those fields (plus id, loop_id, order)
+    
+    Responses carry an ETag; a matching If-None-Match is answered with 304 without reading the tasks.
+    """
+    selected_fields = parse_task_fields(fields)
+    
     # Verify loop ownership
     loop = await db.loops.find_one({"_id": ObjectId(loop_id), "owner_id": current_user["_id"]})
     if not loop:
         raise HTTPException(status_code=404, detail="Loop not found")
     
-    tasks = await db.tasks.find({"loop_id": loop_id}).sort("order", 1).to_list(1000)
+    if RESET_MODE == "lazy":
+        await apply_lazy_resets([loop])
+    
+    etag = make_etag(loop_id, loop.get("version", 0), limit, after, selected_fields)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    
+    projection = None
+    if selected_fields is not None:
+        projection = {field: 1 for field in ["loop_id", "order", *selected_fields]}
+    
+    tasks, next_cursor = await fetch_page(db.tasks, {"loop_id": loop_id}, "order", limit, after, projection)
+    headers = {"ETag": etag, **({"X-Next-Cursor": next_cursor} if next_cursor else {})}
     
-    result = []
-    for task in tasks:
-        task_response = TaskResponse(
-            id=str(task["_id"]),
-            loop_id=task["loop_id"],
-            description=task["description"],
-            type=task["type"],
-            assigned_user_id=task.get("assigned_user_id"),
-            assigned_email=task.get("assigned_email"),
-            due_date=task.get("due_date"),
-            tags=task.get("tags", []),
-            notes=task.get("notes"),
-            attachments=task.get("attachments", []),
-            status=task["status"],
-            completed_at=task.get("completed_at"),
-            created_at=task["created_at"],
-            updated_at=task["updated_at"],
-            order=task["order"]
-        )
-        result.append(task_response)
+    if selected_fields is not None:
+        # Partial documents don't fit TaskResponse, so bypass response_model
+        return FastJSONResponse([build_task_dict(task, selected_fields) for task in tasks], headers=headers)
+    if FAST_JSON:
+        return FastJSONResponse([build_task_dict(task) for task in tasks], headers=headers)
     
-    return result
+    response.headers.update(headers)
+    return [build_task_response(task) for task in tasks]
 
 @api_router.post("/loops/{loop_id}/tasks", response_model=TaskResponse)
 async def create_task(loop_id: str, task_data: TaskCreate, current_user = Depends(get_current_user)):
@@ -599,60 +2987,66 @@ async def create_task(loop_id: str, task_data: TaskCreate, current_user = Depend
         raise HTTPException(status_code=404, detail="Loop not found")
     
     # Get next order
-    last_task = await db.tasks.find({"loop_id": loop_id}).sort("order", -1).limit(1).to_list(1)
-    next_order = (last_task[0]["order"] + 1) if last_task else 1
+    next_order = await next_task_order(loop_id)
     
-    task_doc = {
-        "_id": ObjectId(),
-        "loop_id": loop_id,
-        "description": task_data.description,
-        "type": task_data.type,
-        "assigned_user_id": task_data.assigned_user_id,
-        "assigned_email": task_data.assigned_email,
-        "due_date": task_data.due_date,
-        "tags": task_data.tags or [],
-        "notes": task_data.notes,
-        "attachments": task_data.attachments or [],
-        "status": "pending",
-        "created_at": datetime.utcnow(),
-        "updated_at": datetime.utcnow(),
-        "order": next_order
-    }
+    task_doc = build_task_doc(loop_id, current_user["_id"], task_data, next_order)
     
     await db.tasks.insert_one(task_doc)
+    await db.loops.update_one(counted_loop(loop["_id"]), {"$inc": counter_changes(None, "pending")})
+    await bump_versions([current_user["_id"]], [loop["_id"]])
     
-    return TaskResponse(
-        id=str(task_doc["_id"]),
-        loop_id=task_doc["loop_id"],
-        description=task_doc["description"],
-        type=task_doc["type"],
-        assigned_user_id=task_doc.get("assigned_user_id"),
-        assigned_email=task_doc.get("assigned_email"),
-        due_date=task_doc.get("due_date"),
-        tags=task_doc.get("tags", []),
-        notes=task_doc.get("notes"),
-        attachments=task_doc.get("attachments", []),
-        status=task_doc["status"],
-        completed_at=task_doc.get("completed_at"),
-        created_at=task_doc["created_at"],
-        updated_at=task_doc["updated_at"],
-        order=task_doc["order"]
-    )
+    return build_task_response(task_doc)
 
-@api_router.put("/tasks/{task_id}/complete")
-async def complete_task(task_id: str, current_user = Depends(get_current_user)):
-    # Find task and verify ownership through loop
-    task = await db.tasks.find_one({"_id": ObjectId(task_id)})
-    if not task:
-        raise HTTPException(status_code=404, detail="Task not found")
+@api_router.post("/loops/{loop_id}/tasks:batch", response_model=List[TaskResponse])
+async def create_tasks_batch(loop_id: str, request: TaskBatchCreateRequest, current_user = Depends(get_current_user)):
+    """Create many tasks in one request, appended in the given order"""
+    # Verify loop ownership
+    loop = await db.loops.find_one({"_id": ObjectId(loop_id), "owner_id": current_user["_id"]})
+    if not loop:
+        raise HTTPException(status_code=404, detail="Loop not found")
+    
+    # Allocate a contiguous order range after the current last task
+    first_order = await next_task_order(loop_id)
+    task_docs = [
+        build_task_doc(loop_id, current_user["_id"], task_data, first_order + i)
+        for i, task_data in enumerate(request.tasks)
+    ]
+    
+    await db.tasks.insert_many(task_docs)
+    await db.loops.update_one(counted_loop(loop["_id"]), {"$inc": {"total_tasks": len(task_docs)}})
+    await bump_versions([current_user["_id"]], [loop["_id"]])
+    
+    return [build_task_response(task_doc) for task_doc in task_docs]
+
+@api_router.post("/loops/{loop_id}/tasks:batchUpdate")
+async def update_tasks_batch(loop_id: str, request: TaskBatchUpdateRequest, current_user = Depends(get_current_user)):
+    """Apply many task updates within one loop using a single bulk write"""
+    # Verify loop ownership
+    loop = await db.loops.find_one({"_id": ObjectId(loop_id), "owner_id": current_user["_id"]})
+    if not loop:
+        raise HTTPException(status_code=404, detail="Loop not found")
     
-    loop = await db.loops.find_one({"_id": ObjectId(task["loop_id"]), "owner_id": current_user["_id"]})
+    task_ids = parse_task_ids([item.id for item in request.updates])
+    operations = [
+        UpdateOne({"_id": task_id, "loop_id": loop_id}, {"$set": build_task_update(item)})
+        for task_id, item in zip(task_ids, request.updates)
+    ]
+    result = await db.tasks.bulk_write(operations, ordered=False)
+    if result.modified_count:
+        await bump_versions([current_user["_id"]], [loop["_id"]])
+    
+    return {"matched": result.matched_count, "modified": result.modified_count}
+
+@api_router.post("/loops/{loop_id}/tasks:batchComplete")
+async def complete_tasks_batch(loop_id: str, request: TaskBatchIdsRequest, current_user = Depends(get_current_user)):
+    """Complete many tasks within one loop"""
+    # Verify loop ownership
+    loop = await db.loops.find_one({"_id": ObjectId(loop_id), "owner_id": current_user["_id"]})
     if not loop:
         raise HTTPException(status_code=404, detail="Loop not found")
     
-    # Update task status
-    await db.tasks.update_one(
-        {"_id": ObjectId(task_id)},
+    result = await db.tasks.update_many(
+        {"_id": {"$in": parse_task_ids(request.task_ids)}, "loop_id": loop_id, "status": {"$ne": "completed"}},
         {
             "$set": {
                 "status": "completed",
@@ -661,6 +3055,97 @@ async def complete_task(task_id: str, current_user = Depends(get_current_user)):
             }
         }
     )
+    if result.modified_count:
+        await refresh_loop_counters([loop_id])
+        await bump_versions([current_user["_id"]], [loop["_id"]])
+        await record_task_events([{
+            "type": "completed",
+            "owner_id": current_user["_id"],
+            "loop_id": loop_id,
+            "timezone": loop.get("timezone"),
+            "count": result.modified_count
+        }])
+    
+    return {"completed": result.modified_count}
+
+@api_router.post("/loops/{loop_id}/tasks:batchDelete")
+async def delete_tasks_batch(loop_id: str, request: TaskBatchIdsRequest, current_user = Depends(get_current_user)):
+    """Delete many tasks within one loop"""
+    # Verify loop ownership
+    loop = await db.loops.find_one({"_id": ObjectId(loop_id), "owner_id": current_user["_id"]})
+    if not loop:
+        raise HTTPException(status_code=404, detail="Loop not found")
+    
+    task_object_ids = parse_task_ids(request.task_ids)
+    # Only tombstone ids that really were tasks of this loop, so clients never see foreign ids
+    existing = await db.tasks.find(
+        {"_id": {"$in": task_object_ids}, "loop_id": loop_id}, {"_id": 1}
+    ).to_list(len(task_object_ids))
+    deleted_ids = [task["_id"] for task in existing]
+    result = await db.tasks.delete_many({"_id": {"$in": deleted_ids}, "loop_id": loop_id})
+    if result.deleted_count:
+        await refresh_loop_counters([loop_id])
+        await record_tombstones(current_user["_id"], "task", deleted_ids)
+        await bump_versions([current_user["_id"]], [loop["_id"]])
+    
+    return {"deleted": result.deleted_count}
+
+@api_router.patch("/loops/{loop_id}/tasks/reorder")
+async def reorder_tasks(loop_id: str, request: TaskReorderRequest, current_user = Depends(get_current_user)):
+    """Reorder tasks within a loop based on provided order"""
+    # Verify loop ownership
+    loop = await db.loops.find_one({"_id": ObjectId(loop_id), "owner_id": current_user["_id"]})
+    if not loop:
+        raise HTTPException(status_code=404, detail="Loop not found")
+    
+    task_object_ids = parse_task_ids(request.task_ids)
+    
+    # Check that all tasks belong to this loop
+    task_count = await db.tasks.count_documents({"_id": {"$in": task_object_ids}, "loop_id": loop_id})
+    if task_count != len(set(task_object_ids)):
+        raise HTTPException(status_code=404, detail="Some tasks not found or access denied")
+    
+    # Task orders start at 1, matching create_task
+    await apply_order(db.tasks, task_object_ids, start=1)
+    await bump_versions([current_user["_id"]], [loop["_id"]])
+    
+    return {"message": "Tasks reordered successfully"}
+
+@api_router.put("/tasks/{task_id}/complete")
+async def complete_task(task_id: str, current_user = Depends(get_current_user)):
+    # Ownership check and update in one query, only counting the transition if it wasn't already completed
+    previous = await mutate_owned_task(task_id, current_user["_id"], lambda query: db.tasks.find_one_and_update(
+        {**query, "status": {"$ne": "completed"}},
+        {
+            "$set": {
+                "status": "completed",
+                "completed_at": datetime.utcnow(),
+                "updated_at": datetime.utcnow()
+            }
+        },
+        projection={"status": 1, "loop_id": 1},
+        return_document=ReturnDocument.BEFORE
+    ))
+    if previous:
+        loop_object_id = ObjectId(previous["loop_id"])
+        # The counter update also reads back the loop's timezone, which history days are bucketed by
+        loop, _ = await asyncio.gather(
+            db.loops.find_one_and_update(
+                counted_loop(loop_object_id),
+                {"$inc": counter_changes(previous["status"], "completed")},
+                projection={"timezone": 1}
+            ),
+            bump_versions([current_user["_id"]], [loop_object_id])
+        )
+        if loop is None:
+            loop = await db.loops.find_one({"_id": loop_object_id}, {"timezone": 1})
+        await record_task_events([{
+            "type": "completed",
+            "owner_id": current_user["_id"],
+            "loop_id": previous["loop_id"],
+            "timezone": (loop or {}).get("timezone"),
+            "task_id": str(previous["_id"])
+        }])
     
     return {"message": "Task completed"}
 
@@ -668,59 +3153,21 @@ async def complete_task(task_id: str, current_user = Depends(get_current_user)):
 async def update_task(task_id: str, task_data: TaskUpdate, current_user = Depends(get_current_user)):
     """Update a task"""
     try:
-        # Find task and verify ownership through loop
-        task = await db.tasks.find_one({"_id": ObjectId(task_id)})
-        if not task:
-            raise HTTPException(status_code=404, detail="Task not found")
-        
-        loop = await db.loops.find_one({"_id": ObjectId(task["loop_id"]), "owner_id": current_user["_id"]})
-        if not loop:
-            raise HTTPException(status_code=404, detail="Loop not found")
-        
         # Build update data
-        update_data = {"updated_at": datetime.utcnow()}
-        if task_data.description is not None:
-            update_data["description"] = task_data.description
-        if task_data.type is not None:
-            update_data["type"] = task_data.type
-        if task_data.assigned_email is not None:
-            update_data["assigned_email"] = task_data.assigned_email
-        if task_data.due_date is not None:
-            update_data["due_date"] = task_data.due_date
-        if task_data.tags is not None:
-            update_data["tags"] = task_data.tags
-        if task_data.notes is not None:
-            update_data["notes"] = task_data.notes
-        if task_data.attachments is not None:
-            update_data["attachments"] = task_data.attachments
-        
-        # Update the task
-        await db.tasks.update_one(
-            {"_id": ObjectId(task_id)},
-            {"$set": update_data}
-        )
+        update_data = build_task_update(task_data)
         
-        # Fetch and return updated task
-        updated_task = await db.tasks.find_one({"_id": ObjectId(task_id)})
-        
-        return TaskResponse(
-            id=str(updated_task["_id"]),
-            loop_id=updated_task["loop_id"],
-            description=updated_task["description"],
-            type=updated_task["type"],
-            assigned_user_id=updated_task.get("assigned_user_id"),
-            assigned_email=updated_task.get("assigned_email"),
-            due_date=updated_task.get("due_date"),
-            tags=updated_task.get("tags", []),
-            notes=updated_task.get("notes"),
-            attachments=updated_task.get("attachments", []),
-            status=updated_task["status"],
-            completed_at=updated_task.get("completed_at"),
-            created_at=updated_task["created_at"],
-            updated_at=updated_task["updated_at"],
-            order=updated_task["order"]
-        )
+        # Verify ownership, update and read back the task in one query
+        updated_task = await mutate_owned_task(task_id, current_user["_id"], lambda query: db.tasks.find_one_and_update(
+            query, {"$set": update_data}, return_document=ReturnDocument.AFTER
+        ))
+        if not updated_task:
+            raise HTTPException(status_code=404, detail="Task not found")
+        await bump_versions([current_user["_id"]], [ObjectId(updated_task["loop_id"])])
         
+        return build_task_response(updated_task)
+        
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to update task: {str(e)}")
 
@@ -728,20 +3175,22 @@ async def update_task(task_id: str, task_data: TaskUpdate, current_user = Depend
 async def delete_task(task_id: str, current_user = Depends(get_current_user)):
     """Delete a task"""
     try:
-        # Find task and verify ownership through loop
-        task = await db.tasks.find_one({"_id": ObjectId(task_id)})
-        if not task:
-            raise HTTPException(status_code=404, detail="Task not found")
-        
-        loop = await db.loops.find_one({"_id": ObjectId(task["loop_id"]), "owner_id": current_user["_id"]})
-        if not loop:
-            raise HTTPException(status_code=404, detail="Loop not found")
-        
-        # Delete the task
-        await db.tasks.delete_one({"_id": ObjectId(task_id)})
+        # Verify ownership and delete in one query
+        deleted = await mutate_owned_task(task_id, current_user["_id"], lambda query: db.tasks.find_one_and_delete(
+            query, projection={"status": 1, "loop_id": 1}
+        ))
+        if deleted:
+            loop_object_id = ObjectId(deleted["loop_id"])
+            changes = counter_changes(deleted["status"], None)
+            if changes:
+                await db.loops.update_one(counted_loop(loop_object_id), {"$inc": changes})
+            await record_tombstones(current_user["_id"], "task", [deleted["_id"]])
+            await bump_versions([current_user["_id"]], [loop_object_id])
         
         return {"message": "Task deleted successfully"}
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to delete task: {str(e)}")
 
@@ -752,27 +3201,9 @@ async def reloop(loop_id: str, current_user = Depends(get_current_user)):
     if not loop:
         raise HTTPException(status_code=404, detail="Loop not found")
     
-    # Reset recurring tasks to pending, archive one-time completed tasks
-    await db.tasks.update_many(
-        {"loop_id": loop_id, "type": "recurring"},
-        {
-            "$set": {
-                "status": "pending",
-                "updated_at": datetime.utcnow()
-            },
-            "$unset": {"completed_at": ""}
-        }
-    )
-    
-    await db.tasks.update_many(
-        {"loop_id": loop_id, "type": "one-time", "status": "completed"},
-        {
-            "$set": {
-                "status": "archived",
-                "updated_at": datetime.utcnow()
-            }
-        }
-    )
+    await reset_loops([loop_id])
+    await db.loops.update_one({"_id": loop["_id"]}, {"$set": {"last_reset_at": datetime.utcnow()}})
+    await bump_versions([current_user["_id"]], [loop["_id"]])
     
     return {"message": "Loop reset successfully"}
 
@@ -800,6 +3231,7 @@ async def toggle_favorite(loop_id: str, current_user = Depends(get_current_user)
                 }
             }
         )
+        await bump_versions([current_user["_id"]], [loop["_id"]])
         
         return {
             "message": f"Loop {'added to' if new_favorite_status else 'removed from'} favorites",
@@ -818,31 +3250,8 @@ async def get_favorite_loops(current_user = Depends(get_current_user)):
             "is_favorite": True
         }).to_list(1000)
         
-        # Calculate progress for each loop
-        result = []
-        for loop in loops:
-            # Get task counts
-            total_tasks = await db.tasks.count_documents({"loop_id": str(loop["_id"]), "status": {"$ne": "archived"}})
-            completed_tasks = await db.tasks.count_documents({"loop_id": str(loop["_id"]), "status": "completed"})
-            
-            progress = int((completed_tasks / total_tasks * 100) if total_tasks > 0 else 0)
-            
-            loop_response = LoopResponse(
-                id=str(loop["_id"]),
-                name=loop["name"],
-                description=loop.get("description"),
-                color=loop["color"],
-                owner_id=str(loop["owner_id"]),
-                reset_rule=loop["reset_rule"],
-                created_at=loop["created_at"],
-                updated_at=loop["updated_at"],
-                progress=progress,
-                total_tasks=total_tasks,
-                completed_tasks=completed_tasks
-            )
-            result.append(loop_response)
-        
-        return result
+        # Calculate progress for all loops in one round-trip
+        return await build_loop_responses(loops)
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get favorites: {str(e)}")
@@ -852,42 +3261,46 @@ async def get_favorite_loops(current_user = Depends(get_current_user)):
 async def ai_generate_loop(request: AILoopRequest, current_user = Depends(get_current_user)):
     """AI-powered loop generation from natural language description"""
     try:
-        chat = await get_ai_chat()
-        
-        prompt = f"""Create a loop for: "{request.description}"
-Category: {request.category or 'general'}
-
-Generate a JSON response with this exact structure:
-{{
-    "name": "Loop name (max 50 chars)",
-    "description": "Brief description",
-    "color": "#{request.category and '#FFC93A' if request.category == 'personal' else '#FF5999' if request.category == 'work' else '#00CAD1' if request.category == 'shared' else '#FFC93A'}",
-    "reset_rule": "daily|weekly|manual",
-    "tasks": [
-        {{
-            "description": "Task description (max 50 chars)",
-            "type": "recurring|one-time"
-        }}
-    ]
-}}
-
-Make 5-8 practical, actionable tasks. Consider what would make sense to repeat."""
-
-        user_message = UserMessage(text=prompt)
-        response = await chat.send_message(user_message)
-        
-        # Parse AI response
-        import json
-        try:
-            ai_data = json.loads(response)
-        except:
-            raise HTTPException(status_code=500, detail="AI response parsing failed")
-        
-        return ai_data
+        return await ask_llm(
+            build_generate_loop_prompt(request),
+            fallback={
+                "name": request.description[:50],
+                "description": request.description,
+                "color": "#FFC93A",
+                "reset_rule": "daily",
+                "tasks": []
+            },
+            owner_id=current_user["_id"]
+        )
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"AI generation failed: {str(e)}")
 
+@api_router.post("/ai/generate-loop/stream")
+async def ai_generate_loop_stream(request: AILoopRequest, current_user = Depends(get_current_user)):
+    """Streaming loop generation: NDJSON events, one per task as soon as it is parsed, then the full loop"""
+    prompt = build_generate_loop_prompt(request)
+    
+    async def events():
+        parser = JsonArrayItemParser("tasks")
+        try:
+            async for chunk in stream_llm_text(prompt, owner_id=current_user["_id"]):
+                for task in parser.feed(chunk):
+                    yield json.dumps({"event": "task", "task": task}) + "\n"
+            
+            ai_data = json.loads(parser.text)
+            await store_llm_response(llm_cache_key(prompt), ai_data)
+            llm_fallbacks.set(llm_cache_key(prompt), ai_data)
+            yield json.dumps({"event": "done", "loop": ai_data}) + "\n"
+        except Exception as e:
+            # Headers are already sent, so failures are reported in-band
+            logger.exception("Streaming AI generation failed")
+            yield json.dumps({"event": "error", "detail": f"AI generation failed: {str(e)}"}) + "\n"
+    
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
 @api_router.post("/ai/suggest-tasks")
 async def ai_suggest_tasks(request: AISuggestTasksRequest, current_user = Depends(get_current_user)):
     """AI-powered task suggestions for an existing loop"""
@@ -897,46 +3310,10 @@ async def ai_suggest_tasks(request: AISuggestTasksRequest, current_user = Depend
         if not loop:
             raise HTTPException(status_code=404, detail="Loop not found")
         
-        # Get existing tasks
-        existing_tasks = await db.tasks.find({"loop_id": request.loop_id}).to_list(100)
-        task_descriptions = [task["description"] for task in existing_tasks]
-        
-        chat = await get_ai_chat()
-        
-        prompt = f"""Suggest additional tasks for this loop:
-Name: {loop['name']}
-Description: {loop.get('description', '')}
-Reset Rule: {loop['reset_rule']}
-Context: {request.context or ''}
-
-Existing tasks:
-{chr(10).join(['- ' + desc for desc in task_descriptions])}
-
-Generate a JSON response with 3-5 new task suggestions:
-{{
-    "suggestions": [
-        {{
-            "description": "Task description (max 50 chars)",
-            "type": "recurring|one-time",
-            "reason": "Brief explanation why this task fits"
-        }}
-    ]
-}}
-
-Don't duplicate existing tasks. Focus on gaps or improvements."""
-
-        user_message = UserMessage(text=prompt)
-        response = await chat.send_message(user_message)
-        
-        # Parse AI response
-        import json
-        try:
-            ai_data = json.loads(response)
-        except:
-            raise HTTPException(status_code=500, detail="AI response parsing failed")
-        
-        return ai_data
+        return await suggest_tasks_for_loop(loop, request.context)
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"AI suggestion failed: {str(e)}")
 
@@ -949,53 +3326,371 @@ async def ai_optimize_loop(request: AIOptimizeLoopRequest, current_user = Depend
         if not loop:
             raise HTTPException(status_code=404, detail="Loop not found")
         
-        tasks = await db.tasks.find({"loop_id": request.loop_id}).sort("order", 1).to_list(100)
+        return await optimize_loop(loop)
         
-        chat = await get_ai_chat()
-        
-        prompt = f"""Analyze and optimize this loop:
-Name: {loop['name']}
-Description: {loop.get('description', '')}
-Reset Rule: {loop['reset_rule']}
-
-Tasks (in current order):
-{chr(10).join([f"{i+1}. {task['description']} ({task['type']})" for i, task in enumerate(tasks)])}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"AI optimization failed: {str(e)}")
 
-Generate optimization suggestions in JSON:
-{{
-    "improvements": [
-        {{
-            "type": "reorder|add|remove|modify",
-            "suggestion": "Specific improvement suggestion",
-            "reason": "Why this would help"
-        }}
-    ],
-    "efficiency_score": 85,
-    "summary": "Overall assessment and key recommendations"
-}}
+@api_router.post("/ai/jobs", response_model=AIJobResponse, status_code=status.HTTP_202_ACCEPTED)
+async def submit_ai_job(request: AIJobRequest, current_user = Depends(get_current_user)):
+    """Queue an AI request (e.g. optimizing a large loop); poll GET /ai/jobs/{job_id} or pass callback_url"""
+    loop = await db.loops.find_one({"_id": ObjectId(request.loop_id), "owner_id": current_user["_id"]})
+    if not loop:
+        raise HTTPException(status_code=404, detail="Loop not found")
+    
+    if request.callback_url:
+        try:
+            await check_callback_url(request.callback_url)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    now = datetime.utcnow()
+    job = {
+        "_id": ObjectId(),
+        "owner_id": current_user["_id"],
+        "kind": request.kind,
+        "payload": {"loop_id": request.loop_id, "context": request.context},
+        "priority": request.priority,
+        "callback_url": request.callback_url,
+        "status": "queued",
+        "attempts": 0,
+        "created_at": now,
+        "updated_at": now
+    }
+    await db.ai_jobs.insert_one(job)
+    
+    return build_ai_job_response(job)
 
-Focus on logical task ordering, missing steps, redundancies, and time efficiency."""
+@api_router.get("/ai/jobs/{job_id}", response_model=AIJobResponse)
+async def get_ai_job(job_id: str, current_user = Depends(get_current_user)):
+    """Get the status and, once finished, the result of an AI job"""
+    try:
+        object_id = ObjectId(job_id)
+    except Exception:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    job = await db.ai_jobs.find_one({"_id": object_id, "owner_id": current_user["_id"]})
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    return build_ai_job_response(job)
+
+# Agenda Routes
+@api_router.get("/agenda", response_model=List[TaskResponse])
+async def get_agenda(
+    response: Response,
+    from_: Optional[datetime] = Query(None, alias="from"),
+    to: Optional[datetime] = None,
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    current_user = Depends(get_current_user)
+):
+    """Pending tasks across all of the user's loops due in [from, to), soonest first
+    
+    Without from/to this is today in the user's timezone; either bound alone leaves the other
+    side open (e.g. only `to` includes overdue tasks). The next page's cursor is in X-Next-Cursor.
+    """
+    if from_ is None and to is None:
+        from_, to = local_day_bounds(current_user.get("timezone"), datetime.utcnow())
+    
+    due_date = {}
+    if from_ is not None:
+        due_date["$gte"] = to_naive_utc(from_)
+    if to is not None:
+        due_date["$lt"] = to_naive_utc(to)
+    if from_ is not None and to is not None and due_date["$lt"] <= due_date["$gte"]:
+        raise HTTPException(status_code=400, detail="`to` must be after `from`")
+    query = {"owner_id": current_user["_id"], "status": "pending", "due_date": due_date}
+    
+    # Tasks of loops in the trash are hidden like the loops themselves
+    deleted_loop_ids = await get_deleted_loop_ids(current_user["_id"])
+    if deleted_loop_ids:
+        query["loop_id"] = {"$nin": deleted_loop_ids}
+    
+    tasks, next_cursor = await fetch_page(db.tasks, query, "due_date", limit, after)
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else {}
+    
+    if FAST_JSON:
+        return FastJSONResponse([build_task_dict(task) for task in tasks], headers=headers)
+    
+    response.headers.update(headers)
+    return [build_task_response(task) for task in tasks]
+
+# Stats Routes
+@api_router.get("/stats/completions")
+async def completion_stats(
+    days: int = Query(90, ge=1, le=366),
+    loop_id: Optional[str] = None,
+    current_user = Depends(get_current_user)
+):
+    """Completions, completion rate at reset and current streak over the last `days` days"""
+    if loop_id:
+        loop = await db.loops.find_one({"_id": ObjectId(loop_id), "owner_id": current_user["_id"]}, {"_id": 1})
+        if not loop:
+            raise HTTPException(status_code=404, detail="Loop not found")
+    
+    return await get_completion_stats(current_user["_id"], days, current_user.get("timezone"), loop_id)
+
+# Search Routes
+@api_router.get("/search")
+async def search(
+    q: Optional[str] = Query(None, max_length=200),
+    tags: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    after: Optional[str] = None,
+    current_user = Depends(get_current_user)
+):
+    """Search the user's loops (name, description) and tasks (description, notes), best matches first
+    
+    tags=a,b restricts results to tasks carrying all of those tags. The next page's cursor is
+    in X-Next-Cursor.
+    """
+    q = (q or "").strip()
+    tag_list = [tag.strip() for tag in (tags or "").split(",") if tag.strip()]
+    if not q and not tag_list:
+        raise HTTPException(status_code=400, detail="Provide q and/or tags")
+    
+    owner_id = current_user["_id"]
+    text_match = {"$text": {"$search": q}} if q else {}
+    
+    # Tasks of loops in the trash are hidden like the loops themselves
+    deleted_loop_ids = await get_deleted_loop_ids(owner_id)
+    task_match = {**text_match, "owner_id": owner_id}
+    if tag_list:
+        task_match["tags"] = {"$all": tag_list}
+    if deleted_loop_ids:
+        task_match["loop_id"] = {"$nin": deleted_loop_ids}
+    
+    searches = [search_collection(db.tasks, task_match, limit, after)]
+    if q and not tag_list:
+        loop_match = {**text_match, "owner_id": owner_id, "is_deleted": {"$ne": True}}
+        searches.append(search_collection(db.loops, loop_match, limit, after))
+    pages = await asyncio.gather(*searches)
+    
+    # Merge the per-collection pages in the same (score desc, _id asc) order
+    ranked = sorted(
+        [("task", doc) for doc in pages[0]] + [("loop", doc) for doc in (pages[1] if len(pages) > 1 else [])],
+        key=lambda item: (-item[1]["score"], item[1]["_id"])
+    )
+    results = ranked[:limit]
+    headers = {}
+    if len(ranked) > limit:
+        headers["X-Next-Cursor"] = encode_cursor(results[-1][1]["score"], results[-1][1]["_id"])
+    
+    return FastJSONResponse([build_search_result(kind, doc) for kind, doc in results], headers=headers)
 
-        user_message = UserMessage(text=prompt)
-        response = await chat.send_message(user_message)
-        
-        # Parse AI response
-        import json
+# Sync Routes
+@api_router.get("/sync")
+async def sync_changes(since: Optional[str] = None, current_user = Depends(get_current_user)):
+    """Loops, tasks and hard deletions changed since the cursor returned by the previous sync
+    
+    Without `since` (or once it is older than the tombstone retention) everything is returned
+    with "full": true and the client should replace its copy. Soft-deleted loops are returned
+    with is_deleted set; "deleted" lists loops/tasks that are gone for good.
+    """
+    owner_id = current_user["_id"]
+    if RESET_MODE == "lazy":
+        await apply_owner_lazy_resets(owner_id)
+    
+    # Read the version before the data, so a write racing this sync is seen again next time
+    versions = await db.versions.find_one({"_id": owner_id}) or {}
+    version = versions.get("version", 0)
+    started_at = datetime.utcnow()
+    full = since is None
+    since_version = 0
+    if since is not None:
+        since_at, since_version = decode_sync_cursor(since)
+        if since_version == version:
+            return FastJSONResponse({"full": False, "loops": [], "tasks": [], "deleted": [], "cursor": since})
+        full = since_at < started_at - timedelta(days=SYNC_TOMBSTONE_RETENTION_DAYS)
+    
+    # A write still holding its change number may be stamped after the reads below, so the
+    # cursor can't move past it; writers that died holding one are forgotten after a while
+    pending = versions.get("pending", {})
+    stale_before = started_at - timedelta(seconds=SYNC_PENDING_SECONDS)
+    stale = [token for token, reserved_at in pending.items() if reserved_at <= stale_before]
+    if stale:
+        await db.versions.update_one({"_id": owner_id}, {"$unset": {f"pending.{token}": "" for token in stale}})
+    if len(pending) > len(stale):
+        version = 0 if full else since_version
+    
+    loop_query = {"owner_id": owner_id}
+    deleted = []
+    if not full:
+        loop_query["seq"] = {"$gt": since_version}
+        async for tombstone in db.tombstones.find({"owner_id": owner_id, "seq": {"$gt": since_version}}):
+            deleted.append({"kind": tombstone["kind"], "id": tombstone["id"]})
+    
+    # Every task write stamps its loop, so a changed loop's tasks are re-sent whole
+    loops = await db.loops.find(loop_query).to_list(None)
+    tasks = await db.tasks.find({"loop_id": {"$in": [str(loop["_id"]) for loop in loops]}}).to_list(None)
+    
+    return FastJSONResponse({
+        "full": full,
+        "loops": await build_loop_responses(loops, build_sync_loop_dict),
+        "tasks": [build_task_dict(task) for task in tasks],
+        "deleted": deleted,
+        "cursor": encode_sync_cursor(started_at, version)
+    })
+
+# Offline mutation kinds: op -> coroutine(mutation, loop_id, task_id, user) calling the route handler
+SYNC_MUTATIONS = {
+    "create_loop": lambda m, loop_id, task_id, user: create_loop(LoopCreate(**m.data), user),
+    "update_loop": lambda m, loop_id, task_id, user: update_loop(loop_id, LoopUpdate(**m.data), user),
+    "delete_loop": lambda m, loop_id, task_id, user: soft_delete_loop(loop_id, user),
+    "reloop": lambda m, loop_id, task_id, user: reloop(loop_id, user),
+    "toggle_favorite": lambda m, loop_id, task_id, user: toggle_favorite(loop_id, user),
+    "create_task": lambda m, loop_id, task_id, user: create_task(loop_id, TaskCreate(**{**m.data, "loop_id": loop_id}), user),
+    "update_task": lambda m, loop_id, task_id, user: update_task(task_id, TaskUpdate(**m.data), user),
+    "complete_task": lambda m, loop_id, task_id, user: complete_task(task_id, user),
+    "delete_task": lambda m, loop_id, task_id, user: delete_task(task_id, user),
+}
+
+async def claim_sync_mutation(key: str, mutation_id: str):
+    """Claim a mutation before applying it; returns None if claimed, else the result to report"""
+    while True:
+        now = datetime.utcnow()
         try:
-            ai_data = json.loads(response)
-        except:
-            raise HTTPException(status_code=500, detail="AI response parsing failed")
-        
-        return ai_data
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"AI optimization failed: {str(e)}")
+            await db.sync_mutations.insert_one({"_id": key, "status": "pending", "created_at": now})
+            return None
+        except DuplicateKeyError:
+            pass
+        
+        # Take over a claim left behind by a request that died mid-mutation
+        stale = await db.sync_mutations.find_one_and_update(
+            {"_id": key, "status": "pending", "created_at": {"$lte": now - timedelta(seconds=SYNC_PENDING_SECONDS)}},
+            {"$set": {"created_at": now}}
+        )
+        if stale:
+            return None
+        
+        stored = await db.sync_mutations.find_one({"_id": key})
+        if stored is None:
+            # The other request failed and released its claim: try again
+            continue
+        if stored.get("status") == "pending":
+            return {"id": mutation_id, "status": 409, "detail": "Mutation is still being applied"}
+        return stored["result"]
+
+async def run_sync_mutation(mutation: SyncMutation, loop_id: Optional[str], task_id: Optional[str], user):
+    """Run one offline mutation through its route handler and capture its status"""
+    try:
+        body = await SYNC_MUTATIONS[mutation.op](mutation, loop_id, task_id, user)
+        return {"id": mutation.id, "status": 200, "result": jsonable_encoder(body)}
+    except HTTPException as e:
+        return {"id": mutation.id, "status": e.status_code, "detail": e.detail}
+    except ValidationError as e:
+        return {"id": mutation.id, "status": 422, "detail": jsonable_encoder(e.errors(include_url=False))}
+    except (InvalidId, TypeError):
+        return {"id": mutation.id, "status": 404, "detail": "Not found"}
+
+@api_router.post("/sync")
+async def apply_sync_mutations(request: SyncMutationsRequest, current_user = Depends(get_current_user)):
+    """Apply a client's queued offline mutations in order; each gets its own status"""
+    results = []
+    created_ids = {}
+    for mutation in request.mutations:
+        key = f"{current_user['_id']}:{mutation.id}"
+        # Claim the key before applying, so concurrent retries of a batch can't both apply it
+        result = await claim_sync_mutation(key, mutation.id)
+        if result is None:
+            loop_id = created_ids.get(mutation.loop_id, mutation.loop_id)
+            task_id = created_ids.get(mutation.task_id, mutation.task_id)
+            try:
+                result = await run_sync_mutation(mutation, loop_id, task_id, current_user)
+            finally:
+                # Server errors aren't remembered, so a retry of the batch tries them again
+                if result is not None and result["status"] < 500:
+                    await db.sync_mutations.update_one(
+                        {"_id": key},
+                        {"$set": {"status": "applied", "result": result}}
+                    )
+                else:
+                    await db.sync_mutations.delete_one({"_id": key, "status": "pending"})
+        
+        if mutation.op in ("create_loop", "create_task") and result["status"] == 200:
+            created_ids[mutation.id] = result["result"]["id"]
+        results.append(result)
+    
+    return {"results": results}
+
+# Live Update Routes
+@api_router.get("/loops/{loop_id}/events")
+async def loop_events(
+    loop_id: str,
+    request: Request,
+    last_event_id: Optional[str] = Header(None),
+    current_user = Depends(get_current_user)
+):
+    """Server-sent events for a loop's tasks and progress; reconnect with Last-Event-ID to resume
+    
+    An event of type "resync" means missed events can't be replayed: refetch, then reconnect.
+    """
+    if not LIVE_UPDATES:
+        raise HTTPException(status_code=503, detail="Live updates are not enabled")
+    
+    loop = await db.loops.find_one({"_id": ObjectId(loop_id), "owner_id": current_user["_id"]}, {"_id": 1})
+    if not loop:
+        raise HTTPException(status_code=404, detail="Loop not found")
+    
+    subscriber, missed = live_feed.subscribe(loop_id, last_event_id)
+    
+    async def events():
+        try:
+            if missed is None:
+                yield "event: resync\ndata: {}\n\n"
+                return
+            for event_id, event in missed:
+                yield format_sse(event_id, event)
+            
+            while not await request.is_disconnected():
+                if subscriber.overflowed:
+                    yield "event: resync\ndata: {}\n\n"
+                    return
+                try:
+                    event_id, event = await asyncio.wait_for(subscriber.queue.get(), LIVE_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    # Comment line: keeps proxies from closing an idle connection
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_sse(event_id, event)
+        finally:
+            live_feed.unsubscribe(subscriber)
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 # Test route
 @api_router.get("/")
 async def root():
     return {"message": "Doloop API is running"}
 
+def require_metrics_token(x_metrics_token: Optional[str] = Header(None)):
+    """Only scrapers holding METRICS_TOKEN may read runtime metrics"""
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_metrics_token or not hmac.compare_digest(x_metrics_token.encode(), METRICS_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+
+@api_router.get("/metrics", dependencies=[Depends(require_metrics_token)])
+async def metrics():
+    """In-process runtime metrics for this API worker"""
+    return {
+        "password_hasher": password_hasher.stats(),
+        "user_cache": {"size": len(user_cache), "max_size": user_cache.max_size},
+        "reset_scheduler": reset_scheduler_stats,
+        "llm_cache": {**llm_cache_stats, "size": len(llm_cache), "persistent": LLM_CACHE_PERSISTENT},
+        "llm_pool": llm_pool.stats(),
+        "llm_calls": {**llm_call_stats, "breaker": llm_breaker.stats()},
+        "live_feed": live_feed.stats(),
+        "purge": purge_stats
+    }
+
 # Include the router in the main app
 app.include_router(api_router)
 
@@ -1005,6 +3700,7 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor"],
 )
 
 # Configure logging
@@ -1014,6 +3710,31 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Background tasks started with the app and cancelled on shutdown
+background_tasks = []
+
+@app.on_event("startup")
+async def startup_ensure_indexes():
+    await ensure_indexes()
+
+@app.on_event("startup")
+async def startup_background_tasks():
+    if RESET_MODE == "scheduler":
+        background_tasks.append(asyncio.create_task(reset_scheduler()))
+    if PURGE_WORKER:
+        background_tasks.append(asyncio.create_task(purge_worker()))
+    for _ in range(AI_JOB_WORKERS):
+        background_tasks.append(asyncio.create_task(ai_job_worker()))
+    if LIVE_UPDATES:
+        await enable_task_pre_images()
+        background_tasks.append(asyncio.create_task(live_feed.run()))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await release_lease("reset-scheduler")
+    await release_lease("deleted-loop-purge")
     client.close()
+    password_hasher.shutdown()
@@ -119,18 +119,19 @@ const AICreateLoopScreen: React.FC = () => {
 
       const newLoop = await loopResponse.json();
 
-      // Create all tasks
-      for (const task of aiResponse.tasks) {
-        await fetch(`${API_BASE_URL}/api/loops/${newLoop.id}/tasks`, {
+      // Create all tasks in a single request
+      if (aiResponse.tasks.length > 0) {
+        await fetch(`${API_BASE_URL}/api/loops/${newLoop.id}/tasks:batch`, {
           method: 'POST',
           headers: {
             'Authorization': `Bearer ${token}`,
             'Content-Type': 'application/json',
           },
           body: JSON.stringify({
-            loop_id: newLoop.id,
-            description: task.description,
-            type: task.type,
+            tasks: aiResponse.tasks.map((task) => ({
+              description: task.description,
+              type: task.type,
+            })),
           }),
         });
       }
@@ -55,11 +55,45 @@ const LibraryScreen: React.FC = () => {
   const [searchText, setSearchText] = useState('');
   const [refreshing, setRefreshing] = useState(false);
   const [userLoops, setUserLoops] = useState<Loop[]>([]);
+  const [searchResults, setSearchResults] = useState<any[]>([]);
 
   useEffect(() => {
     fetchUserLoops();
   }, []);
 
+  useEffect(() => {
+    const query = searchText.trim();
+    if (!query) {
+      setSearchResults([]);
+      return;
+    }
+
+    // Debounce so typing doesn't send a request per keystroke
+    const timeout = setTimeout(() => searchLibrary(query), 300);
+    return () => clearTimeout(timeout);
+  }, [searchText]);
+
+  const searchLibrary = async (query: string) => {
+    try {
+      const response = await fetch(`${API_BASE_URL}/api/search?q=${encodeURIComponent(query)}`, {
+        headers: {
+          'Authorization': `Bearer ${token}`,
+          'Content-Type': 'application/json',
+        },
+      });
+
+      if (response.ok) {
+        const data = await response.json();
+        setSearchResults(data.map((result: any) => result.kind === 'loop'
+          ? { id: result.loop.id, name: result.loop.name, color: result.loop.color, loopId: result.loop.id }
+          : { id: result.task.id, name: result.task.description, color: Colors.light.secondary, loopId: result.task.loop_id }
+        ));
+      }
+    } catch (error) {
+      console.log('Error searching library:', error);
+    }
+  };
+
   const fetchUserLoops = async () => {
     try {
       const response = await fetch(`${API_BASE_URL}/api/loops`, {
@@ -171,6 +205,24 @@ const LibraryScreen: React.FC = () => {
           </View>
         </View>
 
+        {/* Search Results */}
+        {searchText.trim() !== '' && (
+          <View style={styles.categorySection}>
+            <View style={styles.categoryHeader}>
+              <Text style={styles.categoryTitle}>Search Results</Text>
+            </View>
+            <View style={styles.categoryItems}>
+              {searchResults.map((item) => (
+                <LibraryItem
+                  key={item.id}
+                  item={item}
+                  onPress={() => router.push(`/loop/${item.loopId}`)}
+                />
+              ))}
+            </View>
+          </View>
+        )}
+
         {/* Category Sections */}
         {shouldShowCategory('favorites') && (
           <CategorySection 
@@ -0,0 +1,309 @@
+import asyncio
+import copy
+import os
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+# server.py reads these at import time; the client connects lazily, so no mongod is needed
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "doloop_test")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+from pymongo import DeleteOne, InsertOne, ReturnDocument, UpdateMany, UpdateOne  # noqa: E402
+from pymongo.errors import DuplicateKeyError  # noqa: E402
+
+
+def get_field(doc, path):
+    for part in path.split("."):
+        if not isinstance(doc, dict) or part not in doc:
+            return None, False
+        doc = doc[part]
+    return doc, True
+
+
+def sort_key(value):
+    # Missing and null values sort before everything else, as in MongoDB
+    return (value is not None, value)
+
+
+def matches_condition(value, exists, condition):
+    if not (isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition)):
+        return value == condition or (isinstance(value, list) and condition in value)
+
+    for operator, operand in condition.items():
+        if operator == "$exists":
+            ok = exists == bool(operand)
+        elif operator == "$eq":
+            ok = value == operand
+        elif operator == "$ne":
+            ok = value != operand
+        elif operator == "$in":
+            ok = value in operand
+        elif operator == "$nin":
+            ok = value not in operand
+        elif operator == "$all":
+            ok = isinstance(value, list) and all(item in value for item in operand)
+        elif operator in ("$gt", "$gte", "$lt", "$lte"):
+            if value is None:
+                ok = False
+            else:
+                ok = {
+                    "$gt": value > operand,
+                    "$gte": value >= operand,
+                    "$lt": value < operand,
+                    "$lte": value <= operand,
+                }[operator]
+        else:
+            raise NotImplementedError(f"FakeCollection doesn't support {operator}")
+        if not ok:
+            return False
+    return True
+
+
+def matches(doc, query):
+    for key, condition in (query or {}).items():
+        if key == "$or":
+            if not any(matches(doc, clause) for clause in condition):
+                return False
+        elif key == "$and":
+            if not all(matches(doc, clause) for clause in condition):
+                return False
+        elif not matches_condition(*get_field(doc, key), condition):
+            return False
+    return True
+
+
+def parent_of(doc, path):
+    *parents, key = path.split(".")
+    for part in parents:
+        doc = doc.setdefault(part, {})
+    return doc, key
+
+
+def apply_update(doc, update, inserting=False):
+    for path, value in update.get("$set", {}).items():
+        parent, key = parent_of(doc, path)
+        parent[key] = value
+    if inserting:
+        for path, value in update.get("$setOnInsert", {}).items():
+            parent, key = parent_of(doc, path)
+            parent[key] = value
+    for path, value in update.get("$inc", {}).items():
+        parent, key = parent_of(doc, path)
+        parent[key] = parent.get(key, 0) + value
+    for path in update.get("$unset", {}):
+        parent, key = parent_of(doc, path)
+        parent.pop(key, None)
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, key, direction=1):
+        keys = key if isinstance(key, list) else [(key, direction)]
+        for field, field_direction in reversed(keys):
+            self.docs.sort(key=lambda doc: sort_key(get_field(doc, field)[0]), reverse=field_direction == -1)
+        return self
+
+    def limit(self, count):
+        if count:
+            self.docs = self.docs[:count]
+        return self
+
+    async def to_list(self, length):
+        return self.docs if length is None else self.docs[:length]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self.docs:
+            yield doc
+
+
+class FakeCollection:
+    """In-memory stand-in for a motor collection: enough query and update operators for the unit tests
+
+    Every call yields to the event loop once before it reads or writes, so concurrent callers
+    interleave, and then matches and writes without yielding, as a single mongod operation would.
+    Projections are ignored; deep copies of whole documents are returned.
+    """
+
+    def __init__(self, docs=()):
+        self.docs = {}
+        self.seed(*docs)
+
+    def seed(self, *docs):
+        for doc in docs:
+            self.docs[doc["_id"]] = copy.deepcopy(doc)
+        return self
+
+    def matching(self, query):
+        return [doc for doc in self.docs.values() if matches(doc, query)]
+
+    def find(self, query=None, projection=None):
+        return FakeCursor([copy.deepcopy(doc) for doc in self.matching(query)])
+
+    async def find_one(self, query=None, projection=None):
+        await asyncio.sleep(0)
+        found = self.matching(query)
+        return copy.deepcopy(found[0]) if found else None
+
+    async def count_documents(self, query):
+        await asyncio.sleep(0)
+        return len(self.matching(query))
+
+    def _insert(self, doc):
+        doc = copy.deepcopy(doc)
+        doc.setdefault("_id", len(self.docs) + 1)
+        if doc["_id"] in self.docs:
+            raise DuplicateKeyError(f"duplicate key: {doc['_id']}")
+        self.docs[doc["_id"]] = doc
+        return doc["_id"]
+
+    async def insert_one(self, doc):
+        await asyncio.sleep(0)
+        return SimpleNamespace(inserted_id=self._insert(doc))
+
+    async def insert_many(self, docs, ordered=True):
+        await asyncio.sleep(0)
+        return SimpleNamespace(inserted_ids=[self._insert(doc) for doc in docs])
+
+    def _update(self, query, update, many=False, upsert=False):
+        found = self.matching(query)
+        if not many:
+            found = found[:1]
+        for doc in found:
+            apply_update(doc, update)
+        upserted_id = None
+        if not found and upsert:
+            doc = {key: value for key, value in query.items() if not key.startswith("$") and not isinstance(value, dict)}
+            apply_update(doc, update, inserting=True)
+            upserted_id = self._insert(doc)
+        return SimpleNamespace(matched_count=len(found), modified_count=len(found), upserted_id=upserted_id)
+
+    async def update_one(self, query, update, upsert=False):
+        await asyncio.sleep(0)
+        return self._update(query, update, upsert=upsert)
+
+    async def update_many(self, query, update, upsert=False):
+        await asyncio.sleep(0)
+        return self._update(query, update, many=True, upsert=upsert)
+
+    async def find_one_and_update(
+        self, query, update, projection=None, sort=None, upsert=False, return_document=ReturnDocument.BEFORE
+    ):
+        await asyncio.sleep(0)
+        found = self.matching(query)
+        if sort:
+            found = FakeCursor(found).sort(sort).docs
+        if not found:
+            if upsert:
+                upserted_id = self._update(query, update, upsert=True).upserted_id
+                if return_document == ReturnDocument.AFTER:
+                    return copy.deepcopy(self.docs[upserted_id])
+            return None
+        before = copy.deepcopy(found[0])
+        apply_update(found[0], update)
+        return copy.deepcopy(found[0]) if return_document == ReturnDocument.AFTER else before
+
+    async def find_one_and_delete(self, query, projection=None):
+        await asyncio.sleep(0)
+        found = self.matching(query)
+        if not found:
+            return None
+        return self.docs.pop(found[0]["_id"])
+
+    def _delete(self, query, many=False):
+        found = self.matching(query)
+        if not many:
+            found = found[:1]
+        for doc in found:
+            del self.docs[doc["_id"]]
+        return SimpleNamespace(deleted_count=len(found))
+
+    async def delete_one(self, query):
+        await asyncio.sleep(0)
+        return self._delete(query)
+
+    async def delete_many(self, query):
+        await asyncio.sleep(0)
+        return self._delete(query, many=True)
+
+    async def bulk_write(self, operations, ordered=True):
+        await asyncio.sleep(0)
+        for operation in operations:
+            if isinstance(operation, (UpdateOne, UpdateMany)):
+                self._update(operation._filter, operation._doc, many=isinstance(operation, UpdateMany), upsert=operation._upsert)
+            elif isinstance(operation, InsertOne):
+                self._insert(operation._doc)
+            elif isinstance(operation, DeleteOne):
+                self._delete(operation._filter)
+            else:
+                raise NotImplementedError(f"FakeCollection doesn't support {type(operation).__name__}")
+
+    def aggregate(self, pipeline):
+        docs = [copy.deepcopy(doc) for doc in self.docs.values()]
+        for stage in pipeline:
+            (operator, spec), = stage.items()
+            if operator == "$match":
+                docs = [doc for doc in docs if matches(doc, spec)]
+            elif operator == "$group":
+                groups = {}
+                for doc in docs:
+                    key = get_field(doc, spec["_id"][1:])[0] if isinstance(spec["_id"], str) else spec["_id"]
+                    group = groups.setdefault(key, {"_id": key})
+                    for field, accumulator in spec.items():
+                        if field == "_id":
+                            continue
+                        (name, operand), = accumulator.items()
+                        if name != "$sum":
+                            raise NotImplementedError(f"FakeCollection doesn't support {name}")
+                        value = get_field(doc, operand[1:])[0] if isinstance(operand, str) else operand
+                        group[field] = group.get(field, 0) + (value or 0)
+                docs = list(groups.values())
+            elif operator == "$addFields":
+                for field, expression in spec.items():
+                    if not (isinstance(expression, dict) and set(expression) == {"$literal"}):
+                        raise NotImplementedError(f"FakeCollection doesn't support {expression}")
+                    for doc in docs:
+                        doc[field] = expression["$literal"]
+            elif operator == "$sort":
+                docs = FakeCursor(docs).sort(list(spec.items())).docs
+            elif operator == "$limit":
+                docs = docs[:spec]
+            else:
+                raise NotImplementedError(f"FakeCollection doesn't support {operator}")
+        return FakeCursor(docs)
+
+
+class FakeDatabase:
+    """Collections are created empty on first use, like MongoDB's"""
+
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = FakeCollection()
+        return self.collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return self[name]
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    """Swap server.db for an in-memory database; seed it with fake_db.<collection>.seed(...)"""
+    import server
+
+    db = FakeDatabase()
+    monkeypatch.setattr(server, "db", db)
+    return db
@@ -0,0 +1,25 @@
+"""
+Unit tests for the date bounds behind GET /api/agenda
+"""
+
+from datetime import datetime, timedelta, timezone
+
+import server
+
+
+def test_today_is_the_local_calendar_day():
+    # 02:30 UTC on March 10 is still March 9 in New York (UTC-4 after the DST change)
+    start, end = server.local_day_bounds("America/New_York", datetime(2026, 3, 10, 2, 30))
+    assert start == datetime(2026, 3, 9, 4, 0)
+    assert end == datetime(2026, 3, 10, 4, 0)
+
+
+def test_dst_change_day_is_23_hours():
+    start, end = server.local_day_bounds("America/New_York", datetime(2026, 3, 8, 12, 0))
+    assert end - start == timedelta(hours=23)
+
+
+def test_aware_bounds_are_converted_to_naive_utc():
+    aware = datetime(2026, 3, 10, 9, 0, tzinfo=timezone(timedelta(hours=2)))
+    assert server.to_naive_utc(aware) == datetime(2026, 3, 10, 7, 0)
+    assert server.to_naive_utc(datetime(2026, 3, 10, 7, 0)) == datetime(2026, 3, 10, 7, 0)
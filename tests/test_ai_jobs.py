@@ -0,0 +1,68 @@
+"""
+Unit tests for AI jobs: callbacks only reach public, allowed hosts, and abandoned jobs are failed
+"""
+
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+import requests
+
+import server
+
+
+@pytest.mark.parametrize("url", [
+    "http://127.0.0.1/hook",
+    "http://169.254.169.254/latest/meta-data/",
+    "https://10.0.0.5/hook",
+    "http://[::1]:8080/hook",
+    "http://[::ffff:192.168.1.1]/hook",
+    "ftp://8.8.8.8/hook",
+])
+def test_non_public_callbacks_are_rejected(url):
+    with pytest.raises(ValueError):
+        asyncio.run(server.check_callback_url(url))
+
+
+def test_public_callback_is_accepted():
+    asyncio.run(server.check_callback_url("https://8.8.8.8/hook"))
+
+
+def test_allowlist_is_enforced(monkeypatch):
+    monkeypatch.setattr(server, "AI_JOB_CALLBACK_HOSTS", {"hooks.example.com"})
+    with pytest.raises(ValueError):
+        asyncio.run(server.check_callback_url("https://8.8.8.8/hook"))
+
+
+def test_callback_connects_to_the_checked_address(monkeypatch):
+    sent = {}
+
+    def send(adapter, request, **kwargs):
+        sent["url"] = request.url
+        sent["host"] = request.headers["Host"]
+        sent["pool"] = adapter.poolmanager.connection_pool_kw
+        response = requests.Response()
+        response.status_code = 204
+        return response
+
+    monkeypatch.setattr(server.PinnedHostAdapter, "send", send)
+    server.post_callback("https://hooks.example.com:8443/done?x=1", "93.184.216.34", {"status": "completed"})
+
+    assert sent["url"] == "https://93.184.216.34:8443/done?x=1"
+    assert sent["host"] == "hooks.example.com:8443"
+    assert sent["pool"]["server_hostname"] == sent["pool"]["assert_hostname"] == "hooks.example.com"
+
+
+def test_jobs_out_of_attempts_are_failed_once_their_lock_expires(fake_db):
+    now = datetime.utcnow()
+    fake_db.ai_jobs.seed(
+        {"_id": 1, "status": "running", "attempts": server.AI_JOB_MAX_ATTEMPTS, "locked_until": now - timedelta(seconds=1)},
+        {"_id": 2, "status": "running", "attempts": 1, "locked_until": now - timedelta(seconds=1)},
+        {"_id": 3, "status": "running", "attempts": server.AI_JOB_MAX_ATTEMPTS, "locked_until": now + timedelta(minutes=1)},
+    )
+
+    asyncio.run(server.fail_abandoned_ai_jobs())
+
+    abandoned = fake_db.ai_jobs.docs[1]
+    assert abandoned["status"] == "failed" and "finished_at" in abandoned and "locked_until" not in abandoned
+    assert [fake_db.ai_jobs.docs[job_id]["status"] for job_id in (2, 3)] == ["running", "running"]
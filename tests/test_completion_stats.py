@@ -0,0 +1,59 @@
+"""
+Unit tests for the completion stats computed from daily rollups, and the loop timezones they are bucketed by
+"""
+
+import asyncio
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+import server
+
+
+def day(offset):
+    return (datetime.utcnow() - timedelta(days=offset)).strftime("%Y-%m-%d")
+
+
+def stats(fake_db, rows):
+    # One loop's rollup per day, plus another user's that must not be counted
+    fake_db.completion_rollups.seed(
+        *[{**row, "_id": f"user-1:loop-1:{row['day']}", "owner_id": "user-1", "loop_id": "loop-1"} for row in rows],
+        {"_id": f"user-2:loop-2:{day(1)}", "owner_id": "user-2", "loop_id": "loop-2", "day": day(1), "completions": 9}
+    )
+    return asyncio.run(server.get_completion_stats("user-1", 90, "UTC"))
+
+
+def test_rate_is_completed_over_total_at_reset(fake_db):
+    result = stats(fake_db, [
+        {"day": day(2), "completions": 3, "resets": 1, "reset_total": 4, "reset_completed": 3},
+        {"day": day(1), "completions": 1, "resets": 1, "reset_total": 4, "reset_completed": 1},
+    ])
+    assert result["completions"] == 4
+    assert result["completion_rate"] == 0.5
+    assert [row["completion_rate"] for row in result["daily"]] == [0.75, 0.25]
+
+
+def test_streak_counts_back_from_yesterday_until_a_gap(fake_db):
+    result = stats(fake_db, [
+        {"day": day(5), "completions": 2},
+        {"day": day(3), "completions": 1},
+        {"day": day(2), "completions": 1},
+        {"day": day(1), "completions": 4},
+    ])
+    assert result["streak"] == 3
+    assert result["completion_rate"] is None
+
+
+def test_backfill_gives_loops_from_before_timezones_their_owners(fake_db):
+    owner_id = ObjectId()
+    fake_db.users.seed({"_id": owner_id, "timezone": "Asia/Tokyo"})
+    fake_db.loops.seed(
+        {"_id": 1, "owner_id": str(owner_id), "reset_rule": "manual"},
+        {"_id": 2, "owner_id": str(owner_id), "reset_rule": "daily"},
+        {"_id": 3, "owner_id": str(owner_id), "reset_rule": "manual", "timezone": "UTC"},
+    )
+
+    assert asyncio.run(server.backfill_next_resets()) == 2
+    assert [fake_db.loops.docs[loop_id].get("timezone") for loop_id in (1, 2, 3)] == ["Asia/Tokyo", "Asia/Tokyo", "UTC"]
+    assert "next_reset_at" not in fake_db.loops.docs[1]
+    assert "next_reset_at" in fake_db.loops.docs[2]
@@ -0,0 +1,22 @@
+"""
+Unit tests for the conditional GET helpers behind the loop and task listings
+"""
+
+import server
+
+
+def test_etag_changes_with_version_and_query():
+    etag = server.make_etag("loop", 3, None, None, None)
+    assert etag == server.make_etag("loop", 3, None, None, None)
+    assert etag != server.make_etag("loop", 4, None, None, None)
+    assert etag != server.make_etag("loop", 3, 50, None, None)
+    assert etag.startswith('"') and etag.endswith('"')
+
+
+def test_if_none_match_parsing():
+    etag = server.make_etag("loop", 1)
+    assert server.etag_matches(etag, etag)
+    assert server.etag_matches(f'"other", W/{etag}', etag)
+    assert server.etag_matches("*", etag)
+    assert not server.etag_matches(None, etag)
+    assert not server.etag_matches('"other"', etag)
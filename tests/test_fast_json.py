@@ -0,0 +1,54 @@
+"""
+The FAST_JSON path must produce the same JSON as the response_model path it replaces
+"""
+
+import json
+from datetime import datetime
+
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+
+import server
+
+NOW = datetime(2024, 5, 17, 8, 30, 15, 123000)
+
+TASK = {
+    "_id": ObjectId(),
+    "loop_id": str(ObjectId()),
+    "description": "Stretch for 5 minutes ✓",
+    "type": "recurring",
+    "due_date": NOW,
+    "tags": ["morning"],
+    "attachments": [{"name": "plan.pdf", "uploaded_at": NOW}],
+    "status": "completed",
+    "completed_at": NOW,
+    "created_at": NOW,
+    "updated_at": NOW,
+    "order": 3,
+}
+
+LOOP = {
+    "_id": ObjectId(),
+    "name": "Morning",
+    "color": "#FFC93A",
+    "owner_id": ObjectId(),
+    "reset_rule": "daily",
+    "created_at": NOW,
+    "updated_at": NOW,
+}
+
+
+def test_task_matches_response_model():
+    expected = jsonable_encoder(server.build_task_response(TASK))
+    assert json.loads(server.dump_json(server.build_task_dict(TASK))) == expected
+
+
+def test_loop_matches_response_model():
+    expected = jsonable_encoder(server.build_loop_response(LOOP, 4, 1))
+    assert json.loads(server.dump_json(server.build_loop_dict(LOOP, 4, 1))) == expected
+
+
+def test_standard_json_fallback(monkeypatch):
+    monkeypatch.setattr(server, "orjson", None)
+    expected = jsonable_encoder(server.build_task_response(TASK))
+    assert json.loads(server.dump_json(server.build_task_dict(TASK))) == expected
@@ -0,0 +1,114 @@
+"""
+Unit tests for loop resets: concurrent readers and scheduler batches racing the same due loop
+"""
+
+import asyncio
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+import server
+
+
+def make_loop(next_reset_at):
+    return {
+        "_id": ObjectId(),
+        "owner_id": str(ObjectId()),
+        "reset_rule": "daily",
+        "timezone": "UTC",
+        "next_reset_at": next_reset_at,
+        "total_tasks": 3,
+        "completed_tasks": 3,
+    }
+
+
+def patch_server(monkeypatch, fake_db, loop):
+    fake_loops = fake_db.loops.seed(loop)
+    reset_calls = []
+
+    async def fake_reset_loops(loop_ids):
+        reset_calls.append(list(loop_ids))
+        return {loop_id: (3, 0) for loop_id in loop_ids}
+
+    async def fake_bump_versions(owner_ids, loop_ids=()):
+        pass
+
+    monkeypatch.setattr(server, "reset_loops", fake_reset_loops)
+    monkeypatch.setattr(server, "bump_versions", fake_bump_versions)
+    return fake_loops, reset_calls
+
+
+def test_concurrent_reads_reset_a_due_loop_once(monkeypatch, fake_db):
+    now = datetime(2026, 3, 10, 9, 30)
+    loop = make_loop(next_reset_at=now - timedelta(hours=9, minutes=30))
+    fake_loops, reset_calls = patch_server(monkeypatch, fake_db, loop)
+
+    # Every reader loaded the same stale document before any of them reset it
+    readers = [dict(loop) for _ in range(25)]
+
+    async def race():
+        return await asyncio.gather(*[server.apply_lazy_resets([reader], now=now) for reader in readers])
+
+    results = asyncio.run(race())
+
+    winners = [reset_ids for reset_ids in results if reset_ids]
+    assert winners == [[str(loop["_id"])]]
+    assert sum(len(call) for call in reset_calls) == 1
+    assert fake_loops.docs[loop["_id"]]["next_reset_at"] == datetime(2026, 3, 11)
+    assert fake_loops.docs[loop["_id"]]["last_reset_at"] == now
+
+
+def test_winner_sees_reset_counts(monkeypatch, fake_db):
+    now = datetime(2026, 3, 10, 9, 30)
+    loop = make_loop(next_reset_at=now - timedelta(minutes=1))
+    patch_server(monkeypatch, fake_db, loop)
+
+    reader = dict(loop)
+    asyncio.run(server.apply_lazy_resets([reader], now=now))
+
+    assert (reader["total_tasks"], reader["completed_tasks"]) == (3, 0)
+    assert reader["next_reset_at"] == datetime(2026, 3, 11)
+
+
+def test_loops_not_yet_due_are_left_alone(monkeypatch, fake_db):
+    now = datetime(2026, 3, 10, 9, 30)
+    loop = make_loop(next_reset_at=now + timedelta(hours=1))
+    fake_loops, reset_calls = patch_server(monkeypatch, fake_db, loop)
+
+    assert asyncio.run(server.apply_lazy_resets([dict(loop)], now=now)) == []
+    assert fake_loops.docs[loop["_id"]]["next_reset_at"] == loop["next_reset_at"]
+    assert reset_calls == []
+
+
+def test_a_later_read_after_the_reset_does_not_reset_again(monkeypatch, fake_db):
+    now = datetime(2026, 3, 10, 9, 30)
+    loop = make_loop(next_reset_at=now - timedelta(minutes=1))
+    fake_loops, reset_calls = patch_server(monkeypatch, fake_db, loop)
+
+    asyncio.run(server.apply_lazy_resets([dict(loop)], now=now))
+    fresh = dict(fake_loops.docs[loop["_id"]])
+    assert asyncio.run(server.apply_lazy_resets([fresh], now=now + timedelta(minutes=5))) == []
+    assert sum(len(call) for call in reset_calls) == 1
+
+
+def test_concurrent_scheduler_batches_reset_a_due_loop_once(monkeypatch, fake_db):
+    now = datetime(2026, 3, 10, 9, 30)
+    loop = make_loop(next_reset_at=now - timedelta(minutes=1))
+    _, reset_calls = patch_server(monkeypatch, fake_db, loop)
+
+    async def race():
+        return await asyncio.gather(server.run_due_resets(now=now), server.run_due_resets(now=now))
+
+    asyncio.run(race())
+
+    assert reset_calls == [[str(loop["_id"])]]
+
+
+def test_scheduler_stops_once_its_lease_is_lost(monkeypatch, fake_db):
+    now = datetime(2026, 3, 10, 9, 30)
+    loop = make_loop(next_reset_at=now - timedelta(minutes=1))
+    _, reset_calls = patch_server(monkeypatch, fake_db, loop)
+    fake_db.leases.seed({"_id": "reset-scheduler", "holder": "other-replica", "expires_at": datetime.utcnow() + timedelta(minutes=1)})
+
+    assert asyncio.run(server.run_due_resets(now=now, lease="reset-scheduler")) == 0
+    assert reset_calls == []
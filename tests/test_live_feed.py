@@ -0,0 +1,77 @@
+"""
+Unit tests for the per-loop fan-out and Last-Event-ID replay of the live update feed
+"""
+
+from datetime import datetime
+
+from bson import ObjectId
+
+import server
+
+NOW = datetime(2026, 3, 10, 9, 30)
+
+
+def task_change(token, loop_id, operation="update", with_post_image=True):
+    task = {
+        "_id": ObjectId(),
+        "loop_id": loop_id,
+        "description": "Drink water",
+        "type": "recurring",
+        "status": "completed",
+        "created_at": NOW,
+        "updated_at": NOW,
+        "order": 1,
+    }
+    return {
+        "_id": {"_data": token},
+        "operationType": operation,
+        "ns": {"db": "test", "coll": "tasks"},
+        "documentKey": {"_id": task["_id"]},
+        "fullDocument": task if with_post_image else None,
+        "fullDocumentBeforeChange": None if with_post_image else task,
+    }
+
+
+def test_events_reach_only_subscribers_of_their_loop():
+    feed = server.LiveFeed(10)
+    mine, _ = feed.subscribe("loop-a")
+    other, _ = feed.subscribe("loop-b")
+
+    feed.publish(task_change("01", "loop-a"))
+    feed.publish(task_change("02", "loop-a", operation="delete", with_post_image=False))
+
+    assert mine.queue.qsize() == 2
+    assert other.queue.empty()
+    _, event = mine.queue.get_nowait()
+    assert event["type"] == "task" and event["task"]["status"] == "completed"
+    _, event = mine.queue.get_nowait()
+    assert event["op"] == "delete"
+
+
+def test_reconnect_replays_missed_events_for_the_loop():
+    feed = server.LiveFeed(10)
+    for token, loop_id in [("01", "loop-a"), ("02", "loop-b"), ("03", "loop-a"), ("04", "loop-a")]:
+        feed.publish(task_change(token, loop_id))
+
+    _, missed = feed.subscribe("loop-a", last_event_id="01")
+    assert [event_id for event_id, _ in missed] == ["03", "04"]
+
+
+def test_reconnect_past_the_buffer_must_resync():
+    feed = server.LiveFeed(2)
+    for token in ["01", "02", "03"]:
+        feed.publish(task_change(token, "loop-a"))
+
+    _, missed = feed.subscribe("loop-a", last_event_id="01")
+    assert missed is None
+
+
+def test_slow_subscriber_is_flagged_instead_of_blocking(monkeypatch):
+    monkeypatch.setattr(server, "LIVE_QUEUE_SIZE", 1)
+    feed = server.LiveFeed(10)
+    subscriber, _ = feed.subscribe("loop-a")
+
+    feed.publish(task_change("01", "loop-a"))
+    feed.publish(task_change("02", "loop-a"))
+
+    assert subscriber.overflowed
@@ -0,0 +1,155 @@
+"""
+Unit tests for the LLM resilience layer, run against a local fake LLM stub
+"""
+
+import asyncio
+import json
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+class FakeLlm:
+    """Stands in for LlmChat: replays a script of replies, exceptions and delays"""
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.calls = 0
+
+    def factory(self, provider, model):
+        fake = self
+
+        class FakeChat:
+            def __init__(self):
+                self.messages = [{"role": "system"}]
+
+            async def send_message(self, message):
+                fake.calls += 1
+                step = fake.script.pop(0) if fake.script else json.dumps({"ok": True})
+                if isinstance(step, float):
+                    await asyncio.sleep(step)
+                    return json.dumps({"slow": True})
+                if isinstance(step, Exception):
+                    raise step
+                self.messages.append(message)
+                return step
+
+        return FakeChat()
+
+
+class ProviderError(Exception):
+    """A provider error carrying an HTTP status, as the provider SDKs raise"""
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    def install(*script):
+        fake = FakeLlm(script)
+        monkeypatch.setattr(server, "llm_pool", server.LlmClientPool(fake.factory, 4, 4))
+        return fake
+
+    monkeypatch.setattr(server, "llm_breaker", server.CircuitBreaker(failure_threshold=2, reset_seconds=60))
+    monkeypatch.setattr(server, "llm_cache", server.TTLCache(100, 60))
+    monkeypatch.setattr(server, "llm_fallbacks", server.TTLCache(100, 60))
+    monkeypatch.setattr(server, "LLM_CACHE_PERSISTENT", False)
+    monkeypatch.setattr(server, "LLM_MAX_RETRIES", 2)
+    monkeypatch.setattr(server, "LLM_RETRY_BASE_DELAY_SECONDS", 0)
+    monkeypatch.setattr(server, "LLM_TIMEOUT_SECONDS", 0.05)
+    return install
+
+
+def test_transient_errors_are_retried(fake_llm):
+    fake = fake_llm(ConnectionError("reset by peer"), ProviderError("Service Unavailable", 503), json.dumps({"a": 1}))
+
+    assert asyncio.run(server.ask_llm("prompt")) == {"a": 1}
+    assert fake.calls == 3
+    assert server.llm_breaker.state == "closed"
+
+
+def test_slow_calls_hit_the_deadline_and_are_retried(fake_llm):
+    fake = fake_llm(1.0, json.dumps({"a": 1}))
+
+    assert asyncio.run(server.ask_llm("prompt")) == {"a": 1}
+    assert fake.calls == 2
+
+
+def test_non_transient_errors_are_not_retried(fake_llm):
+    fake = fake_llm(ProviderError("invalid api key", 401))
+
+    with pytest.raises(ProviderError):
+        asyncio.run(server.call_llm("prompt"))
+    assert fake.calls == 1
+
+
+def test_errors_are_classified_by_status_not_message():
+    assert server.is_transient_llm_error(ProviderError("rate limited", 429))
+    assert not server.is_transient_llm_error(ValueError("task 503 not found"))
+
+    wrapped = RuntimeError("provider call failed")
+    wrapped.__cause__ = ConnectionError("reset by peer")
+    assert server.is_transient_llm_error(wrapped)
+
+
+def test_breaker_opens_and_fails_fast_with_template_fallback(fake_llm):
+    fake = fake_llm(*[ConnectionError("down")] * 6)
+    template = {"suggestions": []}
+
+    for _ in range(2):
+        assert asyncio.run(server.ask_llm("prompt", fallback=template)) == {"suggestions": [], "fallback": True}
+    assert server.llm_breaker.state == "open"
+
+    calls_before = fake.calls
+    assert asyncio.run(server.ask_llm("prompt", fallback=template))["fallback"] is True
+    assert fake.calls == calls_before
+
+
+def test_last_good_reply_is_preferred_over_the_template(fake_llm):
+    fake_llm(json.dumps({"suggestions": ["old"]}), *[ConnectionError("down")] * 3)
+
+    asyncio.run(server.ask_llm("prompt v1", fallback_key="suggest-tasks:loop1"))
+    reply = asyncio.run(server.ask_llm("prompt v2", fallback_key="suggest-tasks:loop1", fallback={"suggestions": []}))
+
+    assert reply == {"suggestions": ["old"], "fallback": True}
+
+
+def test_unavailable_without_fallback_is_a_503(fake_llm):
+    fake_llm(*[ConnectionError("down")] * 3)
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(server.ask_llm("prompt"))
+    assert error.value.status_code == 503
+
+
+def test_half_open_breaker_closes_after_a_successful_trial(fake_llm, monkeypatch):
+    fake_llm(json.dumps({"a": 1}))
+    breaker = server.CircuitBreaker(failure_threshold=1, reset_seconds=0)
+    breaker.record_failure()
+    monkeypatch.setattr(server, "llm_breaker", breaker)
+
+    assert breaker.state == "half_open"
+    assert asyncio.run(server.ask_llm("prompt")) == {"a": 1}
+    assert breaker.state == "closed"
+
+
+def test_cancelled_trial_releases_the_half_open_breaker(fake_llm, monkeypatch):
+    fake_llm(5.0, json.dumps({"a": 1}))
+    monkeypatch.setattr(server, "LLM_TIMEOUT_SECONDS", 10)
+    breaker = server.CircuitBreaker(failure_threshold=1, reset_seconds=0)
+    breaker.record_failure()
+    monkeypatch.setattr(server, "llm_breaker", breaker)
+
+    async def cancel_trial():
+        trial = asyncio.create_task(server.call_llm("prompt"))
+        await asyncio.sleep(0.01)
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+
+    asyncio.run(cancel_trial())
+    assert breaker.allow()
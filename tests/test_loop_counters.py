@@ -0,0 +1,53 @@
+"""
+Unit tests for the denormalized total_tasks/completed_tasks counters on loops
+"""
+
+import asyncio
+
+from bson import ObjectId
+
+import server
+
+USER = {"_id": "user-1", "timezone": "UTC"}
+
+
+def test_counter_changes_per_status_transition():
+    assert server.counter_changes(None, "pending") == {"total_tasks": 1}
+    assert server.counter_changes("pending", "completed") == {"completed_tasks": 1}
+    assert server.counter_changes("completed", None) == {"total_tasks": -1, "completed_tasks": -1}
+    assert server.counter_changes("completed", "archived") == {"total_tasks": -1, "completed_tasks": -1}
+    assert server.counter_changes("archived", None) == {}
+    assert server.counter_changes("pending", "pending") == {}
+
+
+def add_task(loop_id):
+    task = server.TaskCreate(loop_id=loop_id, description="Water", type="recurring")
+    return asyncio.run(server.create_task(loop_id, task, USER))
+
+
+def test_writes_before_the_first_read_leave_uncounted_loops_for_the_backfill(fake_db):
+    # A loop from before counters existed, already holding tasks
+    loop_id = ObjectId()
+    fake_db.loops.seed({"_id": loop_id, "owner_id": USER["_id"]})
+    tasks = [
+        {"_id": ObjectId(), "loop_id": str(loop_id), "owner_id": USER["_id"], "status": "completed", "order": order}
+        for order in range(1, 11)
+    ]
+    fake_db.tasks.seed(*tasks)
+
+    asyncio.run(server.delete_task(str(tasks[0]["_id"]), USER))
+    created = add_task(str(loop_id))
+    asyncio.run(server.complete_task(created.id, USER))
+
+    assert "total_tasks" not in fake_db.loops.docs[loop_id]
+    assert "completed_tasks" not in fake_db.loops.docs[loop_id]
+
+
+def test_counted_loops_are_incremented(fake_db):
+    loop_id = ObjectId()
+    fake_db.loops.seed({"_id": loop_id, "owner_id": USER["_id"], "total_tasks": 2, "completed_tasks": 1})
+
+    created = add_task(str(loop_id))
+    asyncio.run(server.complete_task(created.id, USER))
+
+    assert (fake_db.loops.docs[loop_id]["total_tasks"], fake_db.loops.docs[loop_id]["completed_tasks"]) == (3, 2)
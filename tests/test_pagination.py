@@ -0,0 +1,71 @@
+"""
+Unit tests for keyset pagination: cursor encoding and paging over (field, _id) with nulls first
+"""
+
+import asyncio
+from datetime import datetime
+
+import pytest
+from bson import ObjectId
+from fastapi import HTTPException
+
+import server
+
+
+def page_through(collection, sort_field, limit):
+    """Follow next cursors from the first page to the last; returns the pages' _ids"""
+    pages, after = [], None
+    while True:
+        documents, after = asyncio.run(server.fetch_page(collection, {"loop_id": "loop-1"}, sort_field, limit, after))
+        pages.append([doc["_id"] for doc in documents])
+        if after is None:
+            return pages
+
+
+@pytest.mark.parametrize("value", [3, 2.5, "b", None, datetime(2026, 3, 10, 9, 30, 15, 123000)])
+def test_cursor_round_trip(value):
+    object_id = ObjectId()
+    assert server.decode_cursor(server.encode_cursor(value, object_id)) == (value, object_id)
+
+
+@pytest.mark.parametrize("cursor", ["not base64!", "bm90IGpzb24=", server.encode_cursor(1, ObjectId())[:-4]])
+def test_malformed_cursor_is_a_400(cursor):
+    with pytest.raises(HTTPException) as exc:
+        server.decode_cursor(cursor)
+    assert exc.value.status_code == 400
+
+
+def test_null_cursor_matches_later_nulls_and_every_value():
+    object_id = ObjectId()
+    assert server.keyset_filter("due_date", server.encode_cursor(None, object_id)) == {
+        "$or": [{"due_date": {"$ne": None}}, {"due_date": None, "_id": {"$gt": object_id}}]
+    }
+
+
+def test_pages_cover_every_document_once_with_nulls_first(fake_db):
+    ids = sorted(ObjectId() for _ in range(7))
+    due_dates = [datetime(2026, 3, 2), None, datetime(2026, 3, 1), None, datetime(2026, 3, 1), "missing", None]
+    fake_db.tasks.seed(*[
+        {"_id": object_id, "loop_id": "loop-1", **({} if due_date == "missing" else {"due_date": due_date})}
+        for object_id, due_date in zip(ids, due_dates)
+    ])
+    fake_db.tasks.seed({"_id": ObjectId(), "loop_id": "loop-2", "due_date": None})
+
+    # Null and missing due dates by _id, then dates by (due_date, _id)
+    expected = [ids[1], ids[3], ids[5], ids[6], ids[2], ids[4], ids[0]]
+    for limit in (1, 2, 3, 7):
+        pages = page_through(fake_db.tasks, "due_date", limit)
+        assert [object_id for page in pages for object_id in page] == expected
+        assert all(len(page) == limit for page in pages[:-1])
+
+
+def test_last_page_and_unlimited_listing_have_no_cursor(fake_db):
+    fake_db.tasks.seed(*[{"_id": ObjectId(), "loop_id": "loop-1", "order": order} for order in range(3)])
+
+    documents, after = asyncio.run(server.fetch_page(fake_db.tasks, {"loop_id": "loop-1"}, "order", 3, None))
+    assert [doc["order"] for doc in documents] == [0, 1, 2]
+    assert after is None
+
+    documents, after = asyncio.run(server.fetch_page(fake_db.tasks, {"loop_id": "loop-1"}, "order", None, None))
+    assert len(documents) == 3
+    assert after is None
@@ -0,0 +1,35 @@
+"""
+Unit tests for the task-list compaction behind the loop-scoped AI prompts
+"""
+
+import server
+
+
+def numbered(number, description, task_type):
+    return f"{number}. {description} ({task_type})"
+
+
+def test_duplicates_are_collapsed_with_a_count():
+    tasks = [
+        {"description": "Drink water", "type": "recurring"},
+        {"description": "drink  water", "type": "recurring"},
+        {"description": "Stretch", "type": "recurring"},
+    ]
+    assert server.compact_task_lines(tasks, numbered) == [
+        "1. Drink water (recurring) (x2)",
+        "2. Stretch (recurring)",
+    ]
+
+
+def test_long_descriptions_are_truncated():
+    tasks = [{"description": "x" * 500, "type": "one-time"}]
+    (line,) = server.compact_task_lines(tasks, numbered)
+    assert line.endswith("… (one-time)")
+    assert len(line) < 500
+
+
+def test_list_is_cut_off_at_the_token_budget():
+    tasks = [{"description": f"Task number {i}", "type": "recurring"} for i in range(200)]
+    lines = server.compact_task_lines(tasks, numbered, token_budget=100)
+    assert lines[-1] == f"(+{200 - (len(lines) - 1)} more tasks not shown)"
+    assert sum(server.estimate_tokens(line) for line in lines[:-1]) <= 100
@@ -0,0 +1,79 @@
+"""
+Unit tests for GET /api/search: merging the task and loop pages and resuming from X-Next-Cursor
+"""
+
+import asyncio
+import json
+from datetime import datetime
+
+from bson import ObjectId
+
+import server
+
+USER = {"_id": "user-1"}
+
+
+def search_all(q=None, tags=None, limit=2):
+    """Follow X-Next-Cursor from the first page to the last; returns the pages' (kind, id) pairs"""
+    pages, after = [], None
+    while True:
+        response = asyncio.run(server.search(q=q, tags=tags, limit=limit, after=after, current_user=USER))
+        pages.append([(item["kind"], item[item["kind"]]["id"]) for item in json.loads(response.body)])
+        after = response.headers.get("x-next-cursor")
+        if after is None:
+            return pages
+
+
+def test_tag_search_pages_through_matching_tasks_by_id(fake_db):
+    trashed = ObjectId()
+    fake_db.loops.seed({"_id": trashed, "owner_id": USER["_id"], "is_deleted": True})
+    ids = sorted(ObjectId() for _ in range(5))
+    fake_db.tasks.seed(*[
+        {"_id": object_id, "owner_id": USER["_id"], "loop_id": "loop-1", "order": 0, "tags": ["home", "weekly"]}
+        for object_id in ids
+    ])
+    fake_db.tasks.seed(
+        {"_id": ObjectId(), "owner_id": USER["_id"], "loop_id": "loop-1", "order": 0, "tags": ["home"]},
+        {"_id": ObjectId(), "owner_id": USER["_id"], "loop_id": str(trashed), "order": 0, "tags": ["home", "weekly"]},
+        {"_id": ObjectId(), "owner_id": "user-2", "loop_id": "loop-9", "order": 0, "tags": ["home", "weekly"]},
+    )
+
+    pages = search_all(tags="weekly, home")
+    assert [len(page) for page in pages] == [2, 2, 1]
+    assert [object_id for page in pages for _, object_id in page] == [str(object_id) for object_id in ids]
+
+
+def test_task_and_loop_pages_merge_by_score_then_id(monkeypatch, fake_db):
+    async def ranked_search(collection, match, limit, after):
+        # Stands in for $text: each seeded document carries its score
+        docs = sorted(collection.docs.values(), key=lambda doc: (-doc["score"], doc["_id"]))
+        if after:
+            score, object_id = server.decode_cursor(after)
+            docs = [doc for doc in docs if (-doc["score"], doc["_id"]) > (-score, object_id)]
+        return [dict(doc) for doc in docs[:limit + 1]]
+
+    monkeypatch.setattr(server, "search_collection", ranked_search)
+    ids = sorted(ObjectId() for _ in range(7))
+    created_at = datetime(2026, 3, 1)
+    tasks = [(ids[0], 1.5), (ids[2], 3.0), (ids[3], 2.0), (ids[6], 2.0)]
+    loops = [(ids[1], 2.0), (ids[4], 0.75), (ids[5], 3.0)]
+    fake_db.tasks.seed(*[
+        {"_id": object_id, "score": score, "owner_id": USER["_id"], "loop_id": "loop-1", "order": 0}
+        for object_id, score in tasks
+    ])
+    fake_db.loops.seed(*[
+        {
+            "_id": object_id, "score": score, "owner_id": USER["_id"], "name": "loop", "color": "#000000",
+            "reset_rule": "manual", "created_at": created_at, "updated_at": created_at
+        }
+        for object_id, score in loops
+    ])
+
+    expected = sorted(
+        [("task", object_id, score) for object_id, score in tasks] + [("loop", object_id, score) for object_id, score in loops],
+        key=lambda item: (-item[2], item[1])
+    )
+    for limit in (1, 2, 3, 7):
+        pages = search_all(q="plan", limit=limit)
+        assert [item for page in pages for item in page] == [(kind, str(object_id)) for kind, object_id, _ in expected]
+        assert all(len(page) == limit for page in pages[:-1])
@@ -0,0 +1,141 @@
+"""
+Unit tests for /api/ai/generate-loop/stream: the incremental parser and token streaming
+"""
+
+import asyncio
+import json
+
+import pytest
+
+import server
+
+REPLY = json.dumps({
+    "name": "Morning {routine}",
+    "description": "Tasks \"to\" start [the] day",
+    "color": "#FFC93A",
+    "reset_rule": "daily",
+    "tasks": [
+        {"description": "Drink water", "type": "recurring"},
+        {"description": "Stretch {5 min}", "type": "recurring"},
+        {"description": "Plan \"top 3\" [priorities]", "type": "one-time", "meta": {"tags": ["a", "b"]}},
+    ],
+})
+
+
+def feed_in_chunks(text, size):
+    parser = server.JsonArrayItemParser("tasks")
+    items = []
+    for start in range(0, len(text), size):
+        items.extend(parser.feed(text[start:start + size]))
+    return parser, items
+
+
+def test_items_match_full_parse_for_any_chunking():
+    expected = json.loads(REPLY)["tasks"]
+    for size in (1, 2, 7, 64, len(REPLY)):
+        parser, items = feed_in_chunks(REPLY, size)
+        assert items == expected
+        assert json.loads(parser.text) == json.loads(REPLY)
+
+
+def test_each_item_is_emitted_as_soon_as_it_closes():
+    parser = server.JsonArrayItemParser("tasks")
+    first_close = REPLY.index("\"recurring\"}") + len("\"recurring\"}")
+
+    assert parser.feed(REPLY[:first_close - 1]) == []
+    assert parser.feed(REPLY[first_close - 1:first_close]) == [{"description": "Drink water", "type": "recurring"}]
+
+
+def test_arrays_under_other_keys_are_ignored():
+    reply = json.dumps({"improvements": [{"type": "add"}], "tasks": [{"description": "x"}]})
+    _, items = feed_in_chunks(reply, 3)
+    assert items == [{"description": "x"}]
+
+
+@pytest.fixture
+def streaming(monkeypatch, fake_db):
+    monkeypatch.setattr(server, "LLM_STREAM_API_KEY", "test-key")
+    monkeypatch.setattr(server, "LLM_CACHE_PERSISTENT", False)
+    monkeypatch.setattr(server, "llm_cache", server.TTLCache(100, 60))
+    monkeypatch.setattr(server, "llm_breaker", server.CircuitBreaker(failure_threshold=2, reset_seconds=60))
+
+    def install(*steps):
+        def deltas(prompt, stopped):
+            for step in steps:
+                if isinstance(step, Exception):
+                    raise step
+                yield step
+        monkeypatch.setattr(server, "iter_chat_completion_deltas", deltas)
+
+    return install
+
+
+def collect(prompt):
+    async def run():
+        return [chunk async for chunk in server.stream_llm_text(prompt)]
+    return asyncio.run(run())
+
+
+def test_provider_tokens_are_passed_through_as_they_arrive(streaming):
+    chunks = [REPLY[start:start + 16] for start in range(0, len(REPLY), 16)]
+    streaming(*chunks)
+
+    assert collect("prompt") == chunks
+
+
+def test_stream_failing_before_its_first_token_falls_back_to_a_full_reply(streaming, monkeypatch):
+    streaming(ConnectionError("refused"))
+
+    async def call_llm(prompt):
+        return REPLY
+
+    monkeypatch.setattr(server, "call_llm", call_llm)
+    assert collect("prompt") == [REPLY]
+
+
+def test_stream_failing_midway_is_an_error(streaming):
+    streaming(REPLY[:20], ConnectionError("reset by peer"))
+
+    with pytest.raises(ConnectionError):
+        collect("prompt")
+
+
+def test_task_events_precede_the_done_event(streaming):
+    streaming(*[REPLY[start:start + 16] for start in range(0, len(REPLY), 16)])
+    request = server.AILoopRequest(description="Morning routine")
+
+    async def run():
+        response = await server.ai_generate_loop_stream(request, {"_id": "user-1"})
+        return [json.loads(line) async for line in response.body_iterator]
+
+    events = asyncio.run(run())
+    assert [event["event"] for event in events] == ["task", "task", "task", "done"]
+    assert events[-1]["loop"] == json.loads(REPLY)
+
+
+def test_server_sent_chat_completion_chunks_are_parsed(monkeypatch):
+    lines = [
+        'data: {"choices": [{"delta": {"role": "assistant"}}]}',
+        "",
+        'data: {"choices": [{"delta": {"content": "{\\"tasks\\": "}}]}',
+        ": keep-alive",
+        'data: {"choices": [{"delta": {"content": "[]}"}}]}',
+        "data: [DONE]",
+    ]
+
+    class FakeResponse:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            return False
+
+        def raise_for_status(self):
+            pass
+
+        def iter_lines(self, decode_unicode=False):
+            return iter(lines)
+
+    monkeypatch.setattr(server.requests, "post", lambda *args, **kwargs: FakeResponse())
+    deltas = server.iter_chat_completion_deltas("prompt", server.threading.Event())
+    assert list(deltas) == ['{"tasks": ', "[]}"]
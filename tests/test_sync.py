@@ -0,0 +1,173 @@
+"""
+Unit tests for /api/sync: change-number deltas, per-mutation results, id substitution and idempotent replays
+"""
+
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+from fastapi import HTTPException
+
+import server
+
+USER = {"_id": "user-1"}
+LOOP_A = ObjectId()
+LOOP_B = ObjectId()
+
+
+def seed_loops(fake_db):
+    created_at = datetime(2026, 3, 1)
+    fake_db.loops.seed(*[
+        {
+            "_id": loop_id, "name": name, "color": "#000000", "owner_id": USER["_id"], "reset_rule": "manual",
+            "total_tasks": 1, "completed_tasks": 0, "created_at": created_at, "updated_at": created_at
+        }
+        for loop_id, name in [(LOOP_A, "A"), (LOOP_B, "B")]
+    ])
+    fake_db.tasks.seed(*[
+        {"_id": ObjectId(), "loop_id": str(loop_id), "order": 0, "description": "task", "status": "pending"}
+        for loop_id in (LOOP_A, LOOP_B)
+    ])
+
+
+def sync(since=None):
+    return json.loads(asyncio.run(server.sync_changes(since, USER)).body)
+
+
+def patch_server(monkeypatch):
+    calls = []
+
+    async def create_task(m, loop_id, task_id, user):
+        calls.append(("create_task", loop_id))
+        return {"id": f"task-{len(calls)}"}
+
+    async def complete_task(m, loop_id, task_id, user):
+        calls.append(("complete_task", task_id))
+        if task_id == "missing":
+            raise HTTPException(status_code=404, detail="Task not found")
+        if task_id == "broken":
+            raise HTTPException(status_code=500, detail="Failed to complete task")
+        return {"message": "Task completed"}
+
+    monkeypatch.setattr(server, "SYNC_MUTATIONS", {"create_task": create_task, "complete_task": complete_task})
+    return calls
+
+
+def apply(mutations):
+    request = server.SyncMutationsRequest(mutations=mutations)
+    return asyncio.run(server.apply_sync_mutations(request, USER))["results"]
+
+
+def test_later_mutations_can_reference_a_created_task(monkeypatch, fake_db):
+    calls = patch_server(monkeypatch)
+    results = apply([
+        {"id": "m1", "op": "create_task", "loop_id": "loop-1", "data": {"description": "Water", "type": "recurring"}},
+        {"id": "m2", "op": "complete_task", "task_id": "m1"},
+        {"id": "m3", "op": "complete_task", "task_id": "missing"},
+    ])
+
+    assert [result["status"] for result in results] == [200, 200, 404]
+    assert calls == [("create_task", "loop-1"), ("complete_task", "task-1"), ("complete_task", "missing")]
+
+
+def test_replayed_batch_is_not_applied_twice(monkeypatch, fake_db):
+    calls = patch_server(monkeypatch)
+    batch = [{"id": "m1", "op": "create_task", "loop_id": "loop-1", "data": {}}]
+
+    first = apply(batch)
+    second = apply(batch)
+
+    assert first == second
+    assert len(calls) == 1
+
+
+def test_mutation_claimed_by_another_request_is_not_applied(monkeypatch, fake_db):
+    calls = patch_server(monkeypatch)
+    fake_db.sync_mutations.seed({"_id": "user-1:m1", "status": "pending", "created_at": datetime.utcnow()})
+
+    results = apply([{"id": "m1", "op": "complete_task", "task_id": "task-1"}])
+
+    assert results[0]["status"] == 409
+    assert calls == []
+
+
+def test_stale_claim_is_taken_over(monkeypatch, fake_db):
+    calls = patch_server(monkeypatch)
+    fake_db.sync_mutations.seed({"_id": "user-1:m1", "status": "pending", "created_at": datetime(2026, 1, 1)})
+
+    results = apply([{"id": "m1", "op": "complete_task", "task_id": "task-1"}])
+
+    assert results[0]["status"] == 200
+    assert calls == [("complete_task", "task-1")]
+
+
+def test_server_errors_release_the_claim(monkeypatch, fake_db):
+    calls = patch_server(monkeypatch)
+    batch = [{"id": "m1", "op": "complete_task", "task_id": "broken"}]
+
+    apply(batch)
+    apply(batch)
+
+    assert len(calls) == 2
+    assert fake_db.sync_mutations.docs == {}
+
+
+def test_sync_cursor_round_trip():
+    started_at = datetime(2026, 3, 10, 9, 30, 15, 123000)
+    assert server.decode_sync_cursor(server.encode_sync_cursor(started_at, 42)) == (started_at, 42)
+
+
+def test_sync_returns_what_changed_after_the_cursor(monkeypatch, fake_db):
+    monkeypatch.setattr(server, "RESET_MODE", "scheduler")
+    seed_loops(fake_db)
+    asyncio.run(server.bump_versions([USER["_id"]], [LOOP_A, LOOP_B]))
+
+    first = sync()
+    assert first["full"] is True
+    assert {loop["id"] for loop in first["loops"]} == {str(LOOP_A), str(LOOP_B)}
+    assert len(first["tasks"]) == 2
+
+    asyncio.run(server.bump_versions([USER["_id"]], [LOOP_B]))
+    asyncio.run(server.record_tombstones(USER["_id"], "task", ["gone"]))
+    second = sync(first["cursor"])
+    assert second["full"] is False
+    assert [loop["id"] for loop in second["loops"]] == [str(LOOP_B)]
+    assert [task["loop_id"] for task in second["tasks"]] == [str(LOOP_B)]
+    assert second["deleted"] == [{"kind": "task", "id": "gone"}]
+
+    third = sync(second["cursor"])
+    assert (third["loops"], third["tasks"], third["deleted"]) == ([], [], [])
+
+
+def test_cursor_stops_before_a_change_number_still_being_stamped(monkeypatch, fake_db):
+    monkeypatch.setattr(server, "RESET_MODE", "scheduler")
+    seed_loops(fake_db)
+    asyncio.run(server.bump_versions([USER["_id"]], [LOOP_A, LOOP_B]))
+    cursor = sync()["cursor"]
+
+    async def write_stamped_after_a_sync():
+        async with server.owner_change(USER["_id"]) as seq:
+            synced = await server.sync_changes(cursor, USER)
+            await fake_db.loops.update_one({"_id": LOOP_A}, {"$set": {"seq": seq}})
+        return json.loads(synced.body)
+
+    during = asyncio.run(write_stamped_after_a_sync())
+    assert during["loops"] == []
+    assert server.decode_sync_cursor(during["cursor"])[1] == server.decode_sync_cursor(cursor)[1]
+
+    after = sync(during["cursor"])
+    assert [loop["id"] for loop in after["loops"]] == [str(LOOP_A)]
+    assert fake_db.versions.docs[USER["_id"]]["pending"] == {}
+
+
+def test_change_numbers_left_by_dead_writers_are_forgotten(monkeypatch, fake_db):
+    monkeypatch.setattr(server, "RESET_MODE", "scheduler")
+    seed_loops(fake_db)
+    reserved_at = datetime.utcnow() - timedelta(seconds=server.SYNC_PENDING_SECONDS + 1)
+    fake_db.versions.seed({"_id": USER["_id"], "version": 3, "pending": {"dead": reserved_at}})
+
+    synced = sync()
+    assert server.decode_sync_cursor(synced["cursor"])[1] == 3
+    assert fake_db.versions.docs[USER["_id"]]["pending"] == {}
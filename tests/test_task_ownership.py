@@ -0,0 +1,44 @@
+"""
+Unit tests for the one-query ownership check on task mutations, including pre-owner_id tasks
+"""
+
+import asyncio
+
+import pytest
+from bson import ObjectId
+from fastapi import HTTPException
+from pymongo import ReturnDocument
+
+import server
+
+OWNER = "user-1"
+
+
+def rename(query):
+    return server.db.tasks.find_one_and_update(
+        query, {"$set": {"description": "Renamed"}}, return_document=ReturnDocument.AFTER
+    )
+
+
+def test_foreign_task_is_not_found(fake_db):
+    loop = {"_id": ObjectId(), "owner_id": "someone-else"}
+    task = {"_id": ObjectId(), "loop_id": str(loop["_id"]), "owner_id": "someone-else", "description": "Water"}
+    tasks = fake_db.tasks.seed(task)
+    fake_db.loops.seed(loop)
+
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(server.mutate_owned_task(str(task["_id"]), OWNER, rename))
+    assert error.value.status_code == 404
+    assert tasks.docs[task["_id"]]["description"] == "Water"
+
+
+def test_legacy_task_is_verified_through_its_loop_and_stamped(fake_db):
+    loop = {"_id": ObjectId(), "owner_id": OWNER}
+    task = {"_id": ObjectId(), "loop_id": str(loop["_id"]), "description": "Water"}
+    tasks = fake_db.tasks.seed(task)
+    fake_db.loops.seed(loop)
+
+    updated = asyncio.run(server.mutate_owned_task(str(task["_id"]), OWNER, rename))
+
+    assert updated["description"] == "Renamed"
+    assert tasks.docs[task["_id"]]["owner_id"] == OWNER